@@ -24,11 +24,13 @@ import xbmcplugin
 import xbmcgui
 import os
 from libs.common import connectionValidated, getIPInfo, isVPNConnected, getVPNProfile, getVPNProfileFriendly
-from libs.common import getFriendlyProfileList, connectVPN, disconnectVPN, setVPNState, requestVPNCycle, getFilteredProfileList
+from libs.common import connectVPN, disconnectVPN, setVPNState, requestVPNCycle
 from libs.common import isVPNMonitorRunning, setVPNMonitorState, getVPNMonitorState, wizard
 from libs.common import getIconPath, getSystemData
 from libs.platform import getPlatform, platforms, getPlatformString
-from libs.vpnproviders import getAddonList
+from libs.vpnproviders import getVPNLocation
+from libs.catalog import getCatalog
+from libs.latency import getLatencyList
 from libs.utility import debugTrace, errorTrace, infoTrace
 
 
@@ -126,9 +128,10 @@ def listConnections():
     debugTrace("Listing the connections available for " + vpn_provider)
     if vpn_provider != "":
         # Get the list of connections and add them to the directory
-        all_connections = getAddonList(vpn_provider, "*.ovpn")
-        ovpn_connections = getFilteredProfileList(all_connections, addon.getSetting("vpn_protocol"), None)
-        connections = getFriendlyProfileList(ovpn_connections)
+        records = getCatalog(vpn_provider).getProfiles(addon.getSetting("vpn_protocol"))
+        ovpn_connections = [record.path for record in records]
+        connections = [record.name for record in records]
+        latency = getLatencyList(ovpn_connections, getVPNLocation(vpn_provider))
         inc = 0
         for connection in ovpn_connections:
             url = base_url + "?change?" + ovpn_connections[inc]
@@ -151,6 +154,7 @@ def listConnections():
                 else:
                     conn_text = connections[inc] + conn_primary
                 icon = getIconPath()+"locked.png"                
+            if not latency[inc] == "": conn_text = conn_text + "  " + latency[inc]
             li = xbmcgui.ListItem(conn_text, iconImage=icon)
             xbmcplugin.addDirectoryItem(handle=addon_handle, url=url, listitem=li)
             inc = inc + 1
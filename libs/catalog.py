@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Zomboided
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Catalog of the VPN profiles available for the VPN Manager for OpenVPN add-on.
+
+import os
+from collections import namedtuple
+import libs.vpnproviders as vpnproviders
+from libs.utility import debugTrace, errorTrace
+from libs.platform import getAddonPath
+from libs.vpnproviders import getVPNLocation, getAddonList, getGeneratedInfo, loadLocations, getTranslations
+
+
+# Everything known about a profile.  The servers, ports and modifiers come from the locations
+# file so are only available for generated profiles, the translation is the server name shown
+# in the server view of the connection list.
+ProfileRecord = namedtuple("ProfileRecord", ["name", "path", "servers", "proto", "ports", "modifiers", "translation"])
+
+
+# Friendly names are asked for all the time by the service, the cycle code and the connection
+# lists so are kept once they're known, keyed on the full path of the profile
+friendly_names = {}
+
+
+def getProfileName(ovpn_connection):
+    # The friendly name of a profile is its file name without the .ovpn
+    name = friendly_names.get(ovpn_connection)
+    if name == None:
+        name = os.path.basename(ovpn_connection)
+        if name.endswith(".ovpn"): name = name[:-5]
+        friendly_names[ovpn_connection] = name
+    return name
+
+
+def getProfileCountry(name):
+    # Return the part of a profile name that's shared by servers in the same country,
+    # so "UK - London 02 (UDP)" is "UK" and "France 12 (TCP)" is "France"
+    name = name.strip()
+    if name.endswith(")") and "(" in name:
+        name = name[:name.rfind("(")].strip()
+    if " - " in name:
+        return name[:name.find(" - ")]
+    words = name.split()
+    while len(words) > 1 and words[-1].lstrip("#").isdigit(): words.pop()
+    return " ".join(words)
+
+
+def getProfileProtocol(ovpn_connection):
+    # The protocol as it's used to filter the connection lists
+    if "(UDP" in ovpn_connection: return "UDP"
+    if "(TCP" in ovpn_connection: return "TCP"
+    return ""
+
+
+class ProfileCatalog():
+
+    def __init__(self, vpn_provider):
+        self.vpn_provider = vpn_provider
+        self.records = []
+        self.by_path = {}
+        self.by_protocol = {}
+        self.by_country = {}
+        self.by_server = {}
+        self.stamp = None
+
+    def getStamp(self):
+        # The catalog is out of date if the profiles have been generated since it was loaded,
+        # either by this interpreter or (going by the manifest) by another one
+        try:
+            stat = os.stat(getAddonPath(True, self.vpn_provider + "/GENERATED.txt"))
+            return (vpnproviders.generation_count, stat.st_mtime, stat.st_size)
+        except:
+            return (vpnproviders.generation_count, 0, 0)
+
+    def isCurrent(self):
+        return self.stamp == self.getStamp()
+
+    def load(self):
+        vpn_provider = self.vpn_provider
+        stamp = self.getStamp()
+        records = []
+        translations = getTranslations(vpn_provider)
+        if translations == None: translations = {}
+        generated = getGeneratedInfo(vpn_provider)
+        locations = None
+        if "template" in generated or generated.get("lazy") == "true":
+            locations = loadLocations(vpn_provider, generated.get("locations", ""))
+        if not locations == None:
+            # Generated profiles are all in the locations file, the last line for a location wins
+            found = {}
+            generated_profiles = generated["profiles"]
+            for location in locations:
+                location_values = location.split(",")
+                if len(location_values) < 4 or location_values[0].strip() == "": continue
+                name = location_values[0]
+                if len(generated_profiles) > 0 and not name in generated_profiles: continue
+                path = getAddonPath(True, vpn_provider + "/" + name + ".ovpn")
+                modifiers = ""
+                if len(location_values) > 4: modifiers = location_values[4].strip(' \t\n\r')
+                found[path] = ProfileRecord(name, path, tuple(location_values[1].split()), location_values[2].strip(),
+                                            tuple(location_values[3].split()), modifiers, translations.get(name, name))
+            records = found.values()
+        else:
+            for path in getAddonList(vpn_provider, "*.ovpn"):
+                name = getProfileName(path)
+                records.append(ProfileRecord(name, path, (), getProfileProtocol(path).lower(), (), "", translations.get(name, name)))
+        records.sort(key=lambda record: record.path)
+
+        by_path = {}
+        by_protocol = {"UDP" : [], "TCP" : [], "" : []}
+        by_country = {}
+        by_server = {}
+        for record in records:
+            by_path[record.path] = record
+            friendly_names[record.path] = record.name
+            by_protocol[getProfileProtocol(record.path)].append(record)
+            by_country.setdefault(getProfileCountry(record.name), []).append(record)
+            for server in record.servers:
+                by_server.setdefault(server, []).append(record)
+
+        # Swap everything over at once
+        self.records = records
+        self.by_path = by_path
+        self.by_protocol = by_protocol
+        self.by_country = by_country
+        self.by_server = by_server
+        self.stamp = stamp
+        debugTrace("Loaded catalog of " + str(len(records)) + " profiles for " + vpn_provider)
+
+    def getProfiles(self, filter = "UDP and TCP", used = None):
+        # Return the profiles for the protocols in the filter, leaving out any that are already used.  A
+        # profile with no protocol in its name only shows up if both protocols are wanted
+        if "TCP" in filter and "UDP" in filter:
+            records = self.records
+        else:
+            records = []
+            if "TCP" in filter: records = records + self.by_protocol["TCP"]
+            if "UDP" in filter: records = records + self.by_protocol["UDP"]
+            records.sort(key=lambda record: record.path)
+        if used == None or len(used) == 0: return list(records)
+        return [record for record in records if not record.path in used]
+
+    def getProfile(self, ovpn_connection):
+        return self.by_path.get(ovpn_connection)
+
+    def getCountryProfiles(self, country, protocol = None):
+        # Return the profiles in a country, optionally for just one protocol
+        records = self.by_country.get(country, [])
+        if protocol == None: return list(records)
+        return [record for record in records if getProfileProtocol(record.path) == protocol]
+
+    def getServerProfiles(self, server):
+        # Return the profiles that use a server
+        return list(self.by_server.get(server, []))
+
+
+catalogs = {}
+
+
+def getCatalog(vpn_provider):
+    # Return the catalog for a provider, loading it again if the profiles have been generated since
+    vpn_provider = getVPNLocation(vpn_provider)
+    catalog = catalogs.get(vpn_provider)
+    if catalog == None:
+        catalog = ProfileCatalog(vpn_provider)
+        catalogs[vpn_provider] = catalog
+    if not catalog.isCurrent():
+        try:
+            catalog.load()
+        except Exception as e:
+            errorTrace("catalog.py", "Couldn't load the profiles for " + vpn_provider)
+            errorTrace("catalog.py", str(e))
+    return catalog
+
+
+def getUsedProfiles(addon):
+    # Return the profiles already being used as primary VPNs
+    used = []
+    # Adjust the 11 below to change conn_max
+    for i in range(1, 11):
+        s = addon.getSetting(str(i) + "_vpn_validated")
+        if not s == "": used.append(s)
+    return used
@@ -22,160 +22,145 @@ import xbmcaddon
 import xbmcvfs
 import xbmc
 import os
-import re
 import urllib2
 import xbmcgui
 import xbmc
 import glob
 import sys
-from libs.platform import getVPNLogFilePath, fakeConnection, isVPNTaskRunning, stopVPN9, stopVPN, startVPN, getAddonPath, getSeparator, getUserDataPath
+import time
+from libs.platform import getVPNLogFilePath, fakeConnection, fakeManagement, isVPNTaskRunning, stopVPN9, stopVPN, startVPN, getAddonPath, getSeparator, getUserDataPath
 from libs.platform import getVPNConnectionStatus, connection_status, getPlatform, platforms, writeVPNLog, checkVPNInstall, checkVPNCommand
 from libs.platform import getPlatformString, checkPlatform, useSudo, getKeyMapsPath, getKeyMapsFileName
+from libs.platform import canSwitchVPN, startStandbyVPN, getStandbyVPNStatus, stopStandbyVPN, promoteStandbyVPN
 from libs.utility import debugTrace, infoTrace, errorTrace, ifDebug, newPrint
-from libs.vpnproviders import getVPNLocation, getRegexPattern, getAddonList, provider_display, usesUserKeys, usesSingleKey, gotKeys
-from libs.vpnproviders import ovpnFilesAvailable, ovpnGenerated, fixOVPNFiles, getLocationFiles, removeGeneratedFiles, copyKeyAndCert
-from libs.vpnproviders import usesPassAuth, cleanPassFiles, isUserDefined
-from libs.ipinfo import getIPInfoFrom, getIPSources, getNextSource, getAutoSource, isAutoSelect, getErrorValue, getIndex
+from libs.vpnproviders import getVPNLocation, getAddonList, getProviderDisplayList, usesUserKeys, usesSingleKey, gotKeys
+from libs.vpnproviders import ovpnFilesAvailable, ovpnFilesCurrent, ovpnGenerated, fixOVPNFiles, getLocationFiles, removeGeneratedFiles, copyKeyAndCert
+from libs.vpnproviders import usesPassAuth, cleanPassFiles, isUserDefined, generateOVPNFile
+from libs.httpclient import closeConnections
+from libs.ipinfo import getIPInfoFrom, getIPInfoHedged, getHedgedSources, getIPSources, getAutoSource, isAutoSelect
 from libs.logbox import popupOpenVPNLog
 from libs.userdefined import importWizard
+from libs.state import getState, setState, startStateBatch, endStateBatch
+from libs.catalog import getCatalog, getUsedProfiles, getProfileName, getProfileCountry, getProfileProtocol
+from libs.latency import probeProfiles, addLatencyToList, getServers, getServersLatency, NO_RESPONSE, probe_timeout
+
+
+# When connecting to the best server for a primary VPN, similar servers are found and ranked
+# by how quickly they respond and how often connecting to them has worked.  The results are
+# only kept by the service, keyed by profile, and are [successes, failures, last failure time]
+server_candidates = {}
+server_results = {}
+# How long a server that's failed is moved to the back of the list, how many servers to
+# try before giving up and the score of a server that hasn't responded
+server_failure_time = 900
+best_server_attempts = 3
+probe_timeout_score = probe_timeout * 1000
+
+# The IP info is kept for this many seconds, or until the VPN connection changes
+ip_info_ttl = 600
 
 
 def getIconPath():
     return getAddonPath(True, "/resources/")    
     
 
-def getFilteredProfileList(ovpn_connections, filter, addon):
-    # Filter out the profiles that we're not using
+def getFriendlyProfileName(ovpn_connection):
+    # Make the VPN profile names more readable to the user to select from
+    return getProfileName(ovpn_connection)
     
-    apply_filter = True
-    # Filter based on protocol type
-    if "TCP" in filter:
-        filterTCP = "(TCP"
-    else:
-        filterTCP = "()"
-    if "UDP" in filter:
-        filterUDP = "(UDP"
+
+def getSimilarProfiles(vpn_profile, vpn_provider):
+    # Return all of the profiles for a provider in the same country, using the same protocol, as the one given
+    country = getProfileCountry(getProfileName(vpn_profile))
+    profiles = []
+    for record in getCatalog(vpn_provider).getCountryProfiles(country, getProfileProtocol(vpn_profile)):
+        profiles.append(record.path)
+    if not vpn_profile in profiles: profiles.insert(0, vpn_profile)
+    return profiles
+
+
+def recordServerResult(vpn_profile, connected):
+    # Remember how connecting to a server went so it can be taken into account next time
+    results = server_results.get(vpn_profile, [0, 0, 0])
+    if connected:
+        results[0] = results[0] + 1
     else:
-        filterUDP = "()"
+        results[1] = results[1] + 1
+        results[2] = time.time()
+    server_results[vpn_profile] = results
 
-    # A TCP and UDP filter will work for the non-user defined ovpn files but for user 
-    # defined profiles we should be more relaxed if the user is looking for all protocols
-    if "TCP" in filter and "UDP" in filter : apply_filter = False
-        
-    # Filter out connections already in use.  If we don't wanna filter
-    # the primary connections, just pass 'None' in as the addon
-    used = []
-    if not addon == None:
-        i = 1
-        # Adjust the 11 below to change conn_max
-        while i < 11:
-            s = addon.getSetting(str(i) + "_vpn_validated")
-            if not s == "" : used.append(s)
-            i = i + 1
-        
-    connections = []
-    for connection in ovpn_connections:
-        if apply_filter == False or (filterTCP in connection or filterUDP in connection):
-            if not connection in used:
-                connections.append(connection)                 
-    return connections
-
-    
-def getFriendlyProfileList(ovpn_connections):
-    # Munge a ovpn full path name is something more friendly
-    connections = []
-    regex_str = getRegexPattern()
-    # Deal with some Windows nonsense
-    if getPlatform() == platforms.WINDOWS:
-        regex_str = regex_str.replace(r"/", r"\\")
-    # Produce a compiled pattern and interate around the list of connections
-    pattern = re.compile(regex_str)
-    for connection in ovpn_connections:
-        connections.append(pattern.search(connection).group(1))        
-    return connections
-    
-
-def getTranslatedProfileList(ovpn_connections, vpn_provider):
-    connections = list(ovpn_connections)
-    try:
-        debugTrace("Opening translate file for " + vpn_provider)
-        translate_file = open(getAddonPath(True, vpn_provider + "/TRANSLATE.txt"), 'r')
-        debugTrace("Opened translate file for " + vpn_provider)
-        translate = translate_file.readlines()
-        translate_file.close()
-    except Exception as e:
-        errorTrace("vpnproviders.py", "Couldn't open the translate file for " + vpn_provider)
-        errorTrace("vpnproviders.py", str(e))
-        return ovpn_connections
-    
-    for entry in translate:
-        try:
-            server, dns = entry.split(",")
-            i = connections.index(server)
-            connections[i] = dns
-        except:
-            pass
-            
-    return connections
 
-    
-def getFriendlyProfileName(ovpn_connection):
-    # Make the VPN profile names more readable to the user to select from
-    regex_str = getRegexPattern()
-    # Deal with some Windows nonsense
-    if getPlatform() == platforms.WINDOWS:
-        regex_str = regex_str.replace(r"/", r"\\")
-    # Return friendly version of string
-    match = re.search(regex_str, ovpn_connection)
-    return match.group(1)
-    
+def getServerScore(vpn_profile, servers):
+    # Lower is better.  Servers that failed recently go to the back, the rest are ordered by
+    # their response time, made worse by how often connecting to them has failed
+    successes, failures, last_failure = server_results.get(vpn_profile, [0, 0, 0])
+    rtt = getServersLatency(servers)
+    if rtt == None or rtt == NO_RESPONSE: rtt = probe_timeout_score
+    rtt = rtt * (1 + (2.0 * failures / (successes + failures + 1)))
+    return (time.time() - last_failure < server_failure_time, rtt)
+
+
+def getBestServers(vpn_profile, vpn_provider):
+    # Return the servers to try when connecting to a primary VPN, best first.  The
+    # candidates are found once and then their response times checked on each connect
+    if not vpn_profile in server_candidates:
+        server_candidates[vpn_profile] = getSimilarProfiles(vpn_profile, vpn_provider)
+    candidates = server_candidates[vpn_profile]
+    if len(candidates) == 1: return candidates
+    servers = getServers(candidates, getVPNLocation(vpn_provider))
+    probeProfiles(candidates, getVPNLocation(vpn_provider))
+    candidates = sorted(candidates, key=lambda candidate: getServerScore(candidate, servers[candidate]))
+    debugTrace("Best servers for " + vpn_profile + " are " + ", ".join(candidates[:best_server_attempts]))
+    return candidates[:best_server_attempts]
+
+
+def clearBestServers():
+    # The primary VPNs have changed so the candidates need finding again
+    server_candidates.clear()
+
 
 def getIPInfo(addon):
     # Generate request to find out where this IP is based
     # Return ip info source, ip, location, isp
+    # The last good answer is used if the connection hasn't changed since
+    generation = getState("tunnel_generation")
+    profile = getVPNProfile()
+    cached = getState("ip_info")
+    if len(cached) == 7 and cached[0] == generation and cached[1] == profile and time.time() - cached[2] < ip_info_ttl:
+        debugTrace("Using IP info from " + str(int(time.time() - cached[2])) + " seconds ago")
+        info = []
+        for value in cached[3:]:
+            if isinstance(value, unicode): value = value.encode("utf-8")
+            info.append(value)
+        return info[0], info[1], info[2], info[3]
+    
     source = addon.getSetting("ip_info_source")
     if (not source in getIPSources()):
         addon.setSetting("ip_info_source", getIPSources()[0])
         source = getIPSources()[0]    
-    original_source = source
         
     if isAutoSelect(source):
-        source = getAutoSource()
-        
-    debugTrace("Getting IP info from " + source)
-    retry = 0
-    bad_response = False
-    while retry < 6:
-        ip, country, region, city, isp = getIPInfoFrom(source)
-
-        if ip == "no info":
-            # Got a response but couldn't format it.  No point retrying, move to next service or quit
-            if isAutoSelect(original_source):
-                errorTrace("common.py", "No location information was returned for IP using " + source + ", using next service")
-                source = getNextSource(source)
-            else:
+        # Start with the best source and ask the others if it doesn't answer quickly
+        source, ip, country, region, city, isp = getIPInfoHedged(getHedgedSources(getAutoSource()))
+    else:
+        debugTrace("Getting IP info from " + source)
+        retry = 0
+        while retry < 3:
+            ip, country, region, city, isp = getIPInfoFrom(source)
+            if ip == "no info":
+                # Got a response but couldn't format it.  No point retrying
                 errorTrace("common.py", "No location information was returned for IP using " + source)
                 break
-        elif ip == "error":
-            errorTrace("common.py", "Didn't get a good response from "  + source)
-            if isAutoSelect(original_source):
-                # Only want to retry if this is the first time we've seen an error (recently) otherwise
-                # we assume it was broken before and it's still broken now and move to the next
-                if getErrorValue(getIndex(source)) > 1:
-                    source = getNextSource(source)
-                else:
-                    debugTrace("Retrying "  + source + ", in 3 seconds")
-                    xbmc.sleep(3000)
+            elif ip == "error":
+                # Only want to retry 2 times as service is likely broken rather than busy
+                errorTrace("common.py", "Didn't get a good response from "  + source)
             else:
-                # Only want to retry 2 times if it's not auto select as service is likely broken rather than busy
-                if retry == 2: break                    
-        else:
-            # Worked, exit loop
-            break
-        retry = retry + 1
+                # Worked, exit loop
+                break
+            retry = retry + 1
 
-    # Check to see if the call was good (after 5 retries)
-    if ip == "no_info" or ip == "error":
+    # Check to see if the call was good
+    if ip == "no info" or ip == "error":
         return source, "no info", "unknown", "unknown"
 
     
@@ -187,8 +172,20 @@ def getIPInfo(addon):
     if location == "": location = "Unknown"
 
     infoTrace("common.py", "Received connection info from "  + source + ", IP " + ip + " location " + location + ", ISP " + isp)
+    # Keep this for the connection it was looked up on.  If it's changed since, it won't get used
+    setState("ip_info", [generation, profile, time.time(), source, ip, location, isp])
     return source, ip, location, isp
 
+
+def clearIPInfo():
+    # The VPN connection is changing so any IP info is out of date
+    startStateBatch()
+    setState("tunnel_generation", getState("tunnel_generation") + 1)
+    setState("ip_info", [])
+    endStateBatch()
+    # Connections kept for the lookups would still go the old way
+    closeConnections()
+
     
 def resetVPNConfig(addon, starting):    
     # Reset all of the connection config options
@@ -207,8 +204,11 @@ def connectionValidated(addon):
 
 def stopVPNConnection():
     # Kill the running VPN task and reset the current VPN window properties
+    startStateBatch()
     setVPNProfile("")
     setVPNProfileFriendly("")
+    clearIPInfo()
+    endStateBatch()
     debugTrace("Stopping VPN")
 
     # End any existing openvpn process
@@ -220,12 +220,12 @@ def stopVPNConnection():
         # Send the kill command to end the openvpn process.
         # After 10 seconds hit it with the -9 hammer
         if i < 20:
-            stopVPN()
+            stopped = stopVPN()
         else:
-            stopVPN9()
+            stopped = stopVPN9()
     
         # Wait half a second just to make sure the process has time to die
-        xbmc.sleep(500)
+        if not stopped: xbmc.sleep(500)
 
         # See if the openvpn process is still alive
         waiting = isVPNConnected()
@@ -237,6 +237,8 @@ def stopVPNConnection():
 def startVPNConnection(vpn_profile):  
     # Start the VPN, wait for connection, return the result
 
+    generateOVPNFile(vpn_profile)
+    clearIPInfo()
     startVPN(vpn_profile)
     debugTrace("Waiting for VPN to connect")
     i = 0
@@ -249,17 +251,54 @@ def startVPNConnection(vpn_profile):
         if not state == connection_status.UNKNOWN: break
         i = i + 2
 
-    if fakeConnection(): state = connection_status.CONNECTED
+    if fakeConnection() and not fakeManagement(): state = connection_status.CONNECTED
     
     if state == connection_status.CONNECTED:
+        startStateBatch()
         setVPNProfile(getVPNRequestedProfile())
         setVPNProfileFriendly(getVPNRequestedProfileFriendly())
         setVPNState("started")
+        clearIPInfo()
+        endStateBatch()
         debugTrace("VPN connection to " + getVPNProfile() + " successful")
 
     return state
     
 
+def switchVPNConnection(vpn_profile):
+    # Start the new VPN alongside the current one and only stop the current one once the new
+    # one has connected.  Return the result, the current VPN is left running if it fails
+    generateOVPNFile(vpn_profile)
+    if not startStandbyVPN(vpn_profile): return connection_status.ERROR
+    debugTrace("Waiting for standby VPN to connect")
+    i = 0
+    loop_max = 77
+    if fakeConnection(): loop_max = 2
+
+    while i <= loop_max:
+        xbmc.sleep(1000)
+        state = getStandbyVPNStatus()
+        if not state == connection_status.UNKNOWN: break
+        i = i + 1
+
+    if fakeConnection() and not fakeManagement(): state = connection_status.CONNECTED
+    
+    if state == connection_status.CONNECTED:
+        promoteStandbyVPN()
+        startStateBatch()
+        setVPNProfile(getVPNRequestedProfile())
+        setVPNProfileFriendly(getVPNRequestedProfileFriendly())
+        setVPNState("started")
+        clearIPInfo()
+        endStateBatch()
+        debugTrace("VPN switch to " + getVPNProfile() + " successful")
+    else:
+        stopStandbyVPN()
+        errorTrace("common.py", "Couldn't switch to VPN " + vpn_profile + " before disconnecting, error was " + str(state))
+        
+    return state
+    
+    
 def isVPNConnected():
     # Return True if the VPN task is still running, or the VPN connection is still active
     # Return False if the VPN task is no longer running and the connection is not active
@@ -273,91 +312,89 @@ def isVPNConnected():
     
 def setVPNLastConnectedProfile(profile_name):
     # Store full profile path name
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Last_Profile_Name", profile_name)
+    setState("last_profile", profile_name)
     return
 
     
 def getVPNLastConnectedProfile():
     # Return full profile path name
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Last_Profile_Name")
+    return getState("last_profile")
 
     
 def setVPNLastConnectedProfileFriendly(profile_name):
     # Store shortened profile name
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Last_Profile_Friendly_Name", profile_name)
+    setState("last_profile_friendly", profile_name)
     return 
     
     
 def getVPNLastConnectedProfileFriendly():
     # Return shortened profile name
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Last_Profile_Friendly_Name")       
+    return getState("last_profile_friendly")       
     
     
 def setVPNRequestedProfile(profile_name):
     # Store full profile path name
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Requested_Profile_Name", profile_name)
+    setState("requested_profile", profile_name)
     return
 
     
 def getVPNRequestedProfile():
     # Return full profile path name
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Requested_Profile_Name")
+    return getState("requested_profile")
 
     
 def setVPNRequestedProfileFriendly(profile_name):
     # Store shortened profile name
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Requested_Profile_Friendly_Name", profile_name)
+    setState("requested_profile_friendly", profile_name)
     return 
     
     
 def getVPNRequestedProfileFriendly():
     # Return shortened profile name
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Requested_Profile_Friendly_Name")    
+    return getState("requested_profile_friendly")    
 
 
 def setVPNProfile(profile_name):
     # Store full profile path name
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Connected_Profile_Name", profile_name)
+    setState("connected_profile", profile_name)
     return
 
     
 def getVPNProfile():
     # Return full profile path name
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Connected_Profile_Name")
+    return getState("connected_profile")
 
     
 def setVPNProfileFriendly(profile_name):
     # Store shortened profile name
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Connected_Profile_Friendly_Name", profile_name)
+    setState("connected_profile_friendly", profile_name)
     return 
     
     
 def getVPNProfileFriendly():
     # Return shortened profile name
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Connected_Profile_Friendly_Name")    
+    return getState("connected_profile_friendly")    
 
 
 def setConnectionErrorCount(count):
     # Return the number of times a connection retry has failed
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Connection_Errors", str(count))
+    setState("connection_errors", count)
 
 
 def getConnectionErrorCount():
     # Return the number of times a connection retry has failed
-    err = xbmcgui.Window(10000).getProperty("VPN_Manager_Connection_Errors")
-    if err == "": return 0
-    return int(xbmcgui.Window(10000).getProperty("VPN_Manager_Connection_Errors"))
+    return getState("connection_errors")
 
     
 def setVPNState(state):
 	# Store current state - "off" (deliberately), "stopped", "started", "" (at boot) or "unknown" (error)
-    xbmcgui.Window(10000).setProperty("VPN_Manager_VPN_State", state)
+    setState("vpn_state", state)
     return
 
     
 def getVPNState():
 	# Store current state
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_VPN_State")
+    return getState("vpn_state")
 
 
 def getSystemData(addon, vpn, network, vpnm, system):
@@ -436,14 +473,15 @@ def fixKeymaps():
 def startService():
     # Routine for config to call to request that service starts.  Can time out if there's no response
     # Check to see if service is not already running (shouldn't be...)
-    if not xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Control") == "stopped": return True
+    if not getState("service_control") == "stopped": return True
     
     debugTrace("Requesting service restarts")
     # Update start property and wait for service to respond or timeout
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Control", "start")
+    setState("service_control", "start")
+    wakeService()
     for i in range (0, 30):
         xbmc.sleep(1000)
-        if xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Control") == "started": return True
+        if getState("service_control") == "started": return True
     # No response in 30 seconds, service is probably dead
     errorTrace("common.py", "Couldn't communicate with VPN monitor service, didn't acknowledge a start")
     return False
@@ -451,26 +489,27 @@ def startService():
     
 def ackStart():
     # Routine for service to call to acknowledge service has started
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Control", "started")
+    setState("service_control", "started")
 
     
 def startRequested():
     # Service routine should call this to wait for permission to restart.  
-    if xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Control") == "start": return True
+    if getState("service_control") == "start": return True
     return False
 
     
 def stopService():
     # Routine for config to call to request service stops and waits until that happens
     # Check to see if the service has stopped previously
-    if xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Control") == "stopped": return True
+    if getState("service_control") == "stopped": return True
     
     debugTrace("Requesting service stops")
     # Update start property and wait for service to respond or timeout
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Control", "stop")
+    setState("service_control", "stop")
+    wakeService()
     for i in range (0, 30):
         xbmc.sleep(1000)
-        if xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Control") == "stopped": return True
+        if getState("service_control") == "stopped": return True
     # Haven't had a response in 30 seconds which is badness
     errorTrace("common.py", "Couldn't communicate with VPN monitor service, didn't acknowledge a stop")
     return False
@@ -478,63 +517,69 @@ def stopService():
     
 def stopRequested():
     # Routine for service to call in order to determine whether to stop
-    if xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Control") == "stop": return True
+    if getState("service_control") == "stop": return True
     return False
     
     
 def ackStop():    
     # Routine for service to call to acknowledge service has stopped
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Control", "stopped")
+    setState("service_control", "stopped")
 
     
 def updateService(reason):
     # Set a windows property to tell the background service to update using the latest config data
     debugTrace("Update service requested " + reason)
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Update", "update")
+    setState("service_update", "update")
+    wakeService()
 
     
+def wakeService():
+    # The service sleeps until it has something to do, so poke it to look at any new requests now
+    xbmc.executebuiltin("NotifyAll(service.vpn.manager, wake)")
+    
+
 def ackUpdate():
     # Acknowledge that the update has been received
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Update", "updated")
+    setState("service_update", "updated")
 
 
 def forceCycleLock():
     # Loop until we get the lock, or have waited for 10 seconds
     i = 0
-    while i < 10 and not xbmcgui.Window(10000).getProperty("VPN_Manager_Cycle_Lock") == "":
+    while i < 10 and not getState("cycle_lock") == "":
         xbmc.sleep(1000)
         i = i + 1
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Cycle_Lock", "Forced Locked")
+    setState("cycle_lock", "Forced Locked")
     
     
 def getCycleLock():
     # If the lock is forced, don't wait, just return (ie don't queue)
-    if xbmcgui.Window(10000).getProperty("VPN_Manager_Cycle_Lock") == "Forced Locked" : return False
+    if getState("cycle_lock") == "Forced Locked" : return False
     # If there's already a queue on the lock, don't wait, just return
-    if not xbmcgui.Window(10000).getProperty("VPN_Manager_Cycle_Lock_Queued") == "" : return False
+    if not getState("cycle_lock_queued") == "" : return False
     # Loop until we get the lock or time out after 5 seconds
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Cycle_Lock_Queued", "Queued")
+    setState("cycle_lock_queued", "Queued")
     i = 0
-    while i < 5 and not xbmcgui.Window(10000).getProperty("VPN_Manager_Cycle_Lock") == "":
+    while i < 5 and not getState("cycle_lock") == "":
         xbmc.sleep(1000)
         i = i + 1
     # Free the queue so another call can wait on it
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Cycle_Lock_Queued", "")   
+    setState("cycle_lock_queued", "")   
     # Return false if a forced lock happened whilst we were queuing
-    if xbmcgui.Window(10000).getProperty("VPN_Manager_Cycle_Lock") == "Forced Locked" : return False
+    if getState("cycle_lock") == "Forced Locked" : return False
     # Return false if the lock wasn't obtained because of a time out
     if i == 5 : return False 
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Cycle_Lock", "Locked")
+    setState("cycle_lock", "Locked")
     return True
 
     
 def freeCycleLock():
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Cycle_Lock", "")
+    setState("cycle_lock", "")
     
     
 def updateServiceRequested():
     # Check to see if an update is requred
-    return (xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Update") == "update")
+    return (getState("service_update") == "update")
 
     
 def requestVPNCycle():
@@ -616,11 +661,12 @@ def requestVPNCycle():
         
     
 def getVPNCycle():
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Service_Cycle")
+    return getState("cycle")
 
     
 def setVPNCycle(profile):
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Service_Cycle", profile)
+    setState("cycle", profile)
+    if not profile == "": wakeService()
 
     
 def clearVPNCycle():
@@ -628,11 +674,12 @@ def clearVPNCycle():
 
 
 def getAPICommand():
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_API_Command")
+    return getState("api_command")
 
     
 def setAPICommand(profile):
-    xbmcgui.Window(10000).setProperty("VPN_Manager_API_Command", profile)
+    setState("api_command", profile)
+    if not profile == "": wakeService()
 
     
 def clearAPICommand():
@@ -640,18 +687,19 @@ def clearAPICommand():
     
     
 def isVPNMonitorRunning():
-    if xbmcgui.Window(10000).getProperty("VPN_Manager_Monitor_State") == "Started":
+    if getState("monitor_state") == "Started":
         return True
     else:
         return False
     
     
 def setVPNMonitorState(state):
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Monitor_State", state)
+    setState("monitor_state", state)
+    wakeService()
     
     
 def getVPNMonitorState():
-    return xbmcgui.Window(10000).getProperty("VPN_Manager_Monitor_State")
+    return getState("monitor_state")
 
 
 def resetVPNConnections(addon):
@@ -781,11 +829,9 @@ def wizard():
     if xbmcgui.Dialog().yesno(addon_name, "No primary VPN connection has been set up.  Would you like to do this using the set up wizard or using the Settings dialog?", "", "", "Settings", "Wizard"):
         
         # Select the VPN provider
-        provider_list = list(provider_display)
-        provider_list.sort()
+        provider_list = getProviderDisplayList()
         vpn = xbmcgui.Dialog().select("Select your VPN provider.", provider_list)
-        vpn = provider_display.index(provider_list[vpn])
-        vpn_provider = provider_display[vpn]
+        vpn_provider = provider_list[vpn]
         
         success = True
         # If User Defined VPN then offer to run the wizard
@@ -1019,6 +1065,16 @@ def connectVPN(connection_order, vpn_profile):
                 # User selected cancel on dialog box
                 provider_gen = False
                 cancel_attempt = True
+        elif not ovpnFilesCurrent(getVPNLocation(vpn_provider), addon.getSetting("vpn_locations_list")):
+            # Something that goes into the profiles has changed, only the ones affected get updated
+            progress_message = "Updating VPN provider " + vpn_provider + " (please wait)."
+            progress.update(11, progress_title, progress_message)
+            try:
+                provider_gen = fixOVPNFiles(getVPNLocation(vpn_provider), addon.getSetting("vpn_locations_list"))
+            except Exception as e:
+                errorTrace("common.py", "Couldn't update the .ovpn files")
+                errorTrace("common.py", str(e))
+                provider_gen = False
 
     if provider_gen:
         if not progress.iscanceled():
@@ -1054,17 +1110,18 @@ def connectVPN(connection_order, vpn_profile):
                 else: ip_view = False
                 
                 # Build ths list of connections and the server/IP alternative
-                all_connections = getAddonList(vpn_provider, "*.ovpn")
-                ovpn_connections = getFilteredProfileList(all_connections, vpn_protocol, addon)
+                catalog = getCatalog(vpn_provider)
+                used = getUsedProfiles(addon)
+                records = catalog.getProfiles(vpn_protocol, used)
                 none_filter = "UDP and TCP"
                 # If there are no connections, reset the filter to show everything and try again
-                if len(ovpn_connections) == 0 and isUserDefined(vpn_provider):
+                if len(records) == 0 and isUserDefined(vpn_provider):
                     infoTrace("common.py", "No .ovpn files found for " + vpn_protocol + ", removing protocol filter and retrying.")
                     addon.setSetting("vpn_protocol", none_filter)
                     vpn_protocol = addon.getSetting("vpn_protocol")
-                    ovpn_connections = getFilteredProfileList(all_connections, vpn_protocol, addon)
-                ovpn_connections.sort()
-                location_connections = getFriendlyProfileList(ovpn_connections)
+                    records = catalog.getProfiles(vpn_protocol, used)
+                ovpn_connections = [record.path for record in records]
+                location_connections = [record.name for record in records]
                 if existing_connection == "":
                     cancel_text = "[I]Cancel connection attempt[/I]"
                 else:
@@ -1073,7 +1130,12 @@ def connectVPN(connection_order, vpn_profile):
                 location_connections.append(cancel_text)
                 switch_text =  "[I]Switch between location and server views[/I]"
                 location_connections.insert(0, switch_text)
-                ip_connections = getTranslatedProfileList(location_connections, getVPNLocation(vpn_provider))
+                ip_connections = [switch_text] + [record.translation for record in records] + [cancel_text]
+
+                # Show how quickly each of the servers responds, checking any that haven't been recently
+                probeProfiles(ovpn_connections, getVPNLocation(vpn_provider), progress, progress_title)
+                location_connections = addLatencyToList(location_connections, ovpn_connections, getVPNLocation(vpn_provider), 1)
+                ip_connections = addLatencyToList(ip_connections, ovpn_connections, getVPNLocation(vpn_provider), 1)
                 
                 while switch:
                     debugTrace("Displaying list of connections with filter " + vpn_protocol)
@@ -1116,7 +1178,7 @@ def connectVPN(connection_order, vpn_profile):
                         xbmcgui.Dialog().ok(addon_name, vpn_provider + " requires key and certificate files unique to you in order to authenticate.  These are typically called [I]client.key and client.crt[/I] or [I]user.key and user.crt[/I] or can be embedded within [I].ovpn[/I] files.")
                         
                     # Get the last directory browsed to avoid starting from the top
-                    start_dir = xbmcgui.Window(10000).getProperty("VPN_Manager_User_Directory")
+                    start_dir = getState("user_directory")
                     if usesSingleKey(getVPNLocation(vpn_provider)): 
                         xbmcgui.Dialog().ok(addon_name, vpn_provider + " uses the same key and certificate for all connections. Make either the .key and .crt, or the a .ovpn file available on an accessable drive or USB key.")
                         select_title = "Select key or ovpn for all connections"
@@ -1136,7 +1198,7 @@ def connectVPN(connection_order, vpn_profile):
                             crt_file = key_file
                         if crt_file.endswith(".crt") or crt_file.endswith(".ovpn"):
                             start_dir = os.path.dirname(crt_file)
-                            xbmcgui.Window(10000).setProperty("VPN_Manager_User_Directory", start_dir)
+                            setState("user_directory", start_dir)
                             keys_copied = copyKeyAndCert(getVPNLocation(vpn_provider), ovpn_name, key_file, crt_file)
                             got_keys = keys_copied
                         else:
@@ -1144,6 +1206,10 @@ def connectVPN(connection_order, vpn_profile):
                     else:
                         got_keys = False
                         
+        # The profile might not exist yet if they're only created when they're used
+        if (not progress.iscanceled()) and (not ovpn_name == "") and not generateOVPNFile(ovpn_connection):
+            errorTrace("common.py", "Couldn't create the profile " + ovpn_connection)
+            
         # Try and connect to the VPN provider using the entered credentials        
         if (not progress.iscanceled()) and (not ovpn_name == "") and got_keys:    
             progress_message = "Connecting using profile " + ovpn_name + "."
@@ -1167,7 +1233,7 @@ def connectVPN(connection_order, vpn_profile):
                 percent = percent + 2
 
     # Mess with the state to make it look as if we've connected to a VPN
-    if fakeConnection() and not progress.iscanceled() and provider_gen and not ovpn_name == "" and got_keys: state = connection_status.CONNECTED
+    if fakeConnection() and not fakeManagement() and not progress.iscanceled() and provider_gen and not ovpn_name == "" and got_keys: state = connection_status.CONNECTED
     
     log_option = True
     # Determine what happened during the connection attempt        
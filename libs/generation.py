@@ -24,56 +24,17 @@
 import xbmc
 import xbmcgui
 import xbmcvfs
+import os
 import glob
 import string
+import zipfile
+import threading
+import time
+import Queue
 from libs.utility import debugTrace, errorTrace, infoTrace, newPrint
 from libs.platform import getAddonPath, getUserDataPath, fakeConnection
 from libs.common import getFriendlyProfileName
 
-def generateAll():
-    infoTrace("generation.py", "Generating Location files")
-    generateVPNac()
-    generateNordVPN()
-    return
-    generateCyberGhost()
-    generateVPNUnlim()
-    generateVyprVPN()
-    generateExpressVPN()
-    generatePureVPN()
-    generatePIA()
-    generateNordVPN()
-    generateSmartDNSProxy()
-    generateIVPN()
-    generateCelo()
-    generateHMA()
-    generateRA4W()
-    generateVPNSecure()
-    generateIPVanish()
-    generateHideIPVPN()
-    generateExpressVPN()
-    generateSecureVPN()
-    generateLimeVPN()
-    generateSecureVPN()
-    generateNordVPN()
-    generateproXPN()
-    generateWindscribe()
-    generateWiTopia()
-    generateVPNht()
-    generateTotalVPN()    
-    generateSaferVPN()
-    generateBTGuard()
-    generateHideMe()
-    generateHideIPVPN()
-    generateVyprVPN()
-    generateTorGuard()
-    generateibVPN()
-    generatePP()    
-    generateAirVPN()
-    generatePIA()
-    generateLiquidVPN()
-    generatetigerVPN()   
-    generateIPVanish()    
-
 def getLocations(vpn_provider, path_ext):
     if path_ext == "":
         location_path = "/LOCATIONS.txt"
@@ -82,9 +43,61 @@ def getLocations(vpn_provider, path_ext):
     return open(getAddonPath(True, vpn_provider + location_path), 'w')
 
 
+# Profiles that are being read straight out of a provider's zip file, keyed on the path they'd
+# have if the zip had been extracted.  Each is [zip file, entry name].  The zip files are
+# kept open, keyed on their path, until closeBundles is called
+bundle_profiles = {}
+bundles = {}
+
+
 def getProfileList(vpn_provider):
+    # Return the profiles in the provider data directory.  If there aren't any but there's a
+    # providers/<provider>.zip, as downloaded from the provider, the profiles in that are used
+    # instead without needing to extract it.  openProfile is used to read them either way
     path = getUserDataPath("providers/" + vpn_provider + "/*.ovpn")
-    return glob.glob(path)      
+    profiles = glob.glob(path)
+    if len(profiles) > 0: return profiles
+    return getBundleList(vpn_provider)
+
+
+def getBundleList(vpn_provider):
+    bundle_path = getUserDataPath("providers/" + vpn_provider + ".zip")
+    if not os.path.exists(bundle_path): return []
+    bundle = bundles.get(bundle_path)
+    if bundle == None:
+        try:
+            bundle = zipfile.ZipFile(bundle_path, 'r')
+        except Exception as e:
+            errorTrace("generation.py", "Couldn't open " + bundle_path)
+            errorTrace("generation.py", str(e))
+            return []
+        bundles[bundle_path] = bundle
+    directory = getUserDataPath("providers/" + vpn_provider)
+    profiles = []
+    for entry in bundle.infolist():
+        name = os.path.basename(entry.filename)
+        if not name.endswith(".ovpn"): continue
+        profile = os.path.join(directory, name)
+        bundle_profiles[profile] = [bundle, entry.filename]
+        profiles.append(profile)
+    debugTrace("Found " + str(len(profiles)) + " profiles in " + bundle_path)
+    return profiles
+
+
+def openProfile(profile):
+    # Open a profile from the provider data directory, or stream it out of the zip it's in
+    if profile in bundle_profiles:
+        bundle, entry = bundle_profiles[profile]
+        return bundle.open(entry, 'r')
+    return open(profile, 'r')
+
+
+def closeBundles():
+    # Close any zip files that profiles have been read from
+    for bundle_path in bundles.keys():
+        bundles[bundle_path].close()
+    bundles.clear()
+    bundle_profiles.clear()
 
     
 def generateVPNac():
@@ -111,10 +124,8 @@ def generateVPNac():
         servers = ""
         ports = ""
         writeline = ""
-        profile_file = open(profile, 'r')
-        lines = profile_file.readlines()
-        profile_file.close()
-        for line in lines:
+        profile_file = openProfile(profile)
+        for line in profile_file:
             if line.startswith("remote "):
                 _, server, port = line.split()
                 proto = proto.lower()
@@ -122,6 +133,7 @@ def generateVPNac():
                 servers = servers + server
                 if not ports == "" : ports = ports + " "
                 ports = ports + port
+        profile_file.close()
         output_line = geo + " (" + proto.upper() + ")," + servers + "," + proto + "," + ports + "\n" 
         location_file.write(output_line)
     location_file.close()   
@@ -165,7 +177,7 @@ def generateSmartDNSProxy():
             else:
                 geo = geo + " (TCP)"
         geo = geo.replace("  ", " ")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -215,7 +227,7 @@ def generateRA4W():
         geo = geo.replace("stpetersburg", "St Petersburg")
         geo = geo.replace("panamacity", "Panama City")
         geo = resolveCountry(geo[0:2].upper()) + " - " + string.capwords(geo[3:])
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -238,7 +250,7 @@ def generateVPNSecure():
     location_file = getLocations("VPNSecure", "")
     for profile in profiles:
         geo = profile[profile.rfind("\\")+1:profile.index(".ovpn")][0:3]
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -271,7 +283,7 @@ def generateSecureVPN():
         shortname = shortname[:shortname.index(".")]
         proto = "(UDP)"
         filename = shortname + " " + proto + ".ovpn"
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         output_file = open(destination_path + filename, 'w')
         profile_contents = profile_file.readlines()
         profile_file.close()
@@ -300,7 +312,7 @@ def generateIVPN():
     location_file = getLocations("IVPN", "")
     for profile in profiles:
         geo = profile[profile.rfind("\\")+1:profile.index(".ovpn")]
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -414,7 +426,7 @@ def generateCelo():
         geo_cert = (geo + "_ca.crt").replace(" ", "_")
         geo_key_file = open(getAddonPath(True, "Celo/" + geo_key), 'w')
         geo_cert_file = open(getAddonPath(True, "Celo/" + geo_cert), 'w')
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         servers_udp = ""
@@ -505,7 +517,7 @@ def generateSaferVPN():
     for profile in profiles:
         geo = profile[profile.index("SaferVPN")+9:]
         geo = geo.replace(".ovpn", "")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -533,7 +545,7 @@ def generateExpressVPN():
         geo = geo.replace("Usa ", "USA ")
         geo = geo.replace(" Cbd", " CBD")
         geo = geo.replace(" Dc", " DC")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -557,7 +569,7 @@ def generateBTGuard():
             geo = geo.replace("- ","")
             geo = geo.replace("(Fastest)", "Fastest")
             geo = geo.replace(".ovpn", "")
-            profile_file = open(profile, 'r')
+            profile_file = openProfile(profile)
             lines = profile_file.readlines()
             profile_file.close()
             for line in lines:
@@ -593,7 +605,7 @@ def generateLimeVPN():
             shortname = ""
         proto = " (UDP)"
         filename = countryname + shortname + proto + ".ovpn"
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         output_file = open(destination_path + filename, 'w')
         profile_contents = profile_file.readlines()
         profile_file.close()
@@ -635,7 +647,7 @@ def generateHideIPVPN():
         geo = geo.replace("us", "United States ")
         geo = geo.replace("TCP", "(TCP)")
         geo = geo.replace("UDP", "(UDP)")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         servers = ""
@@ -670,7 +682,7 @@ def generateCyberGhost():
         geo = resolveCountry(geo[0:2]) + geo[2:]
         geo = geo.replace("TCP", "(TCP)")
         geo = geo.replace("UDP", "(UDP)")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         servers = ""
@@ -704,7 +716,7 @@ def generateTorGuard():
         geo = geo.replace(".Stealth.TCP", " Stealth")
         geo = geo.replace(".Stealth.UDP", " Stealth")
         geo = geo.replace("-", " - ")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         servers = ""
@@ -763,7 +775,7 @@ def generatePP():
         geo_key = geo + "_ta.key"
         if not xbmcvfs.exists(getAddonPath(True, "PerfectPrivacy/" + geo_key)):
             geo = "****ERROR****"
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         servers = ""
@@ -785,7 +797,7 @@ def generateHideMe():
     location_file = getLocations("HideMe", "")
     profiles = getProfileList("HideMe")
     for profile in profiles:
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         geo = profile[profile.rfind("\\")+1:profile.index(".ovpn")]
@@ -840,7 +852,7 @@ def generateAirVPN():
     for directory in directories:
         profiles = getProfileList("AirVPN/" + directory)
         for profile in profiles:
-            profile_file = open(profile, 'r')
+            profile_file = openProfile(profile)
             lines = profile_file.readlines()
             profile_file.close()
             tokens = (profile[profile.rfind("\\")+1:profile.index(".ovpn")]).split("_")
@@ -864,7 +876,7 @@ def generateLiquidVPN():
     for directory in directories:
         profiles = getProfileList("LiquidVPN/" + directory)
         for profile in profiles:
-            profile_file = open(profile, 'r')
+            profile_file = openProfile(profile)
             lines = profile_file.readlines()
             profile_file.close()
             server = ""
@@ -924,7 +936,7 @@ def generateibVPN():
         geo = profile[profile.index("ibVPN ")+6:]
         geo = geo.replace(".ovpn", "")
         geo = geo.replace("-", " - ")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         servers = ""
@@ -956,7 +968,7 @@ def generatePIA():
     for profile in profiles:
         geo = profile[profile.index("PIA")+4:]
         geo = geo.replace(".ovpn", "")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -1011,7 +1023,7 @@ def generateVyprVPN():
     for profile in profiles:        
         geo = profile[profile.index("VyprVPN\\")+8:]
         geo = geo.replace(".ovpn", "")
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -1108,7 +1120,7 @@ def generatePureVPN():
         if virtual_found: geo = geo + " Virtual"
         if udp_found: geo = geo + " (UDP)"
         if tcp_found: geo = geo + " (TCP)"
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         lines = profile_file.readlines()
         profile_file.close()
         for line in lines:
@@ -1149,21 +1161,21 @@ def generateNordVPN():
         if "tcp443" in profile: proto = "(TCP)"
         if "udp1194" in profile: proto = "(UDP)"
         filename = shortname + " " + proto + ".ovpn"
-        profile_file = open(profile, 'r')
+        profile_file = openProfile(profile)
         output_file = open(destination_path + filename, 'w')
-        profile_contents = profile_file.readlines()
-        profile_file.close()
-        output = ""
         i = 0
-        for line in profile_contents:
+        for line in profile_file:
             line = line.strip(' \t\n\r')
             if not line == "" and not line.startswith("#mute") and not (i < 15 and line.startswith("#")):
                 output_file.write(line + "\n")
             i = i + 1
+        profile_file.close()
+        output_file.close()
    
    
-def resolveCountry(code):   
-    Countries = {'Afghanistan': 'AF',
+# Country names keyed on their two letter code, used to turn the codes in provider
+# server names into something readable
+countries = {'Afghanistan': 'AF',
         'Albania': 'AL',
         'Algeria': 'DZ',
         'American Samoa': 'AS',
@@ -1415,14 +1427,107 @@ def resolveCountry(code):
         'Zambia': 'ZM',
         'Zimbabwe': 'ZW',
         'Åland Islands': 'AX',
-        'Kosovo': 'XK'}   
-    for c in Countries:
-        if Countries[c] == code: return c        
-    return code + " is unknown"
+        'Kosovo': 'XK'}
+country_names = {}
+for country in countries:
+    if not countries[country] in country_names: country_names[countries[country]] = country
+
+
+def resolveCountry(code):   
+    return country_names.get(code, code + " is unknown")
 
 
 def generateVPNs():
     # Return True if the set of location files for the VPNs should be generated
     # This is governed by the existance of 'GENERATEVPNS.txt' in the userdata directory.
     return xbmcvfs.exists(getUserDataPath("GENERATEVPNS.txt"))  
-   
\ No newline at end of file
+
+
+# **** ADD MORE VPN PROVIDERS HERE ****
+# The function which generates the location files (or profiles) for each provider from the data
+# downloaded into userdata/providers/<provider>.  Each only writes to its own provider directory
+ingestors = {"AirVPN" : generateAirVPN,
+             "BTGuard" : generateBTGuard,
+             "Celo" : generateCelo,
+             "CyberGhost" : generateCyberGhost,
+             "ExpressVPN" : generateExpressVPN,
+             "HMA" : generateHMA,
+             "HideIPVPN" : generateHideIPVPN,
+             "HideMe" : generateHideMe,
+             "IPVanish" : generateIPVanish,
+             "IVPN" : generateIVPN,
+             "LimeVPN" : generateLimeVPN,
+             "LiquidVPN" : generateLiquidVPN,
+             "NordVPN" : generateNordVPN,
+             "PIA" : generatePIA,
+             "PerfectPrivacy" : generatePP,
+             "PureVPN" : generatePureVPN,
+             "RA4WVPN" : generateRA4W,
+             "SaferVPN" : generateSaferVPN,
+             "SecureVPN" : generateSecureVPN,
+             "SmartDNSProxy" : generateSmartDNSProxy,
+             "TorGuard" : generateTorGuard,
+             "TotalVPN" : generateTotalVPN,
+             "VPN.ac" : generateVPNac,
+             "VPN.ht" : generateVPNht,
+             "VPNSecure" : generateVPNSecure,
+             "VPNUnlimited" : generateVPNUnlim,
+             "VyprVPN" : generateVyprVPN,
+             "WiTopia" : generateWiTopia,
+             "Windscribe" : generateWindscribe,
+             "ibVPN" : generateibVPN,
+             "proXPN" : generateproXPN,
+             "tigerVPN" : generatetigerVPN}
+
+# The providers that generateAll regenerates, change this to None to do all of them
+generate_providers = ["VPN.ac", "NordVPN"]
+# How many providers to generate at once
+generate_threads = 8
+
+
+def generateAll(vpn_providers = None):
+    # Generate the location files for the providers given, or those in generate_providers
+    if vpn_providers == None: vpn_providers = generate_providers
+    if vpn_providers == None: vpn_providers = sorted(ingestors.keys())
+    infoTrace("generation.py", "Generating Location files for " + ", ".join(vpn_providers))
+    queue = Queue.Queue()
+    for vpn_provider in vpn_providers:
+        if vpn_provider in ingestors: queue.put(vpn_provider)
+        else: errorTrace("generation.py", "Don't know how to generate the location files for " + vpn_provider)
+    # Keyed on the provider, each is [seconds taken, True if it worked]
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                vpn_provider = queue.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                ingestors[vpn_provider]()
+                worked = True
+            except Exception as e:
+                errorTrace("generation.py", "Couldn't generate the location files for " + vpn_provider)
+                errorTrace("generation.py", str(e))
+                worked = False
+            results[vpn_provider] = [time.time() - start, worked]
+
+    start = time.time()
+    threads = []
+    for i in range(0, min(generate_threads, queue.qsize())):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    closeBundles()
+
+    # Report how long each one took, slowest first
+    for vpn_provider in sorted(results, key=lambda vpn_provider: results[vpn_provider][0], reverse=True):
+        duration, worked = results[vpn_provider]
+        if worked: outcome = "Generated "
+        else: outcome = "Failed to generate "
+        infoTrace("generation.py", outcome + vpn_provider + " in " + "%.2f" % duration + " seconds")
+    infoTrace("generation.py", "Generated " + str(len(results)) + " providers in " + "%.2f" % (time.time() - start) + " seconds")
+    return results
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Zomboided
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Makes HTTP requests for the VPN Manager for OpenVPN add-on.
+
+import httplib
+import socket
+import threading
+import time
+import urlparse
+from libs.utility import debugTrace
+from libs.state import getState
+
+
+# How long to wait to connect and then for each read, in seconds, if the caller doesn't say
+default_connect_timeout = 5
+default_read_timeout = 10
+# The most that will be read from a response, anything bigger is treated as an error
+default_max_response = 262144
+# Connections are kept open for reuse for this long after they were last used, and only until
+# the VPN connection changes as they'd still be going out the way the old connection did
+keep_alive_time = 30
+# How many redirects to follow
+max_redirects = 3
+
+user_agent = "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:38.0) Gecko/20100101 Firefox/38.0"
+
+
+class HTTPError(Exception):
+    pass
+
+
+class ConnectionPool():
+
+    def __init__(self):
+        # Keyed by scheme, host and port, each is a list of [connection, time last used, tunnel generation]
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, connect_timeout):
+        # Return an idle connection to reuse, or a new one, and whether it's being reused
+        now = time.time()
+        generation = getState("tunnel_generation")
+        self.lock.acquire()
+        connections = self.idle.get(key, [])
+        connection = None
+        while len(connections) > 0:
+            connection, last_used, connection_generation = connections.pop()
+            if now - last_used < keep_alive_time and connection_generation == generation: break
+            connection.close()
+            connection = None
+        self.lock.release()
+        if not connection == None: return connection, True
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=connect_timeout), False
+        return httplib.HTTPConnection(host, port, timeout=connect_timeout), False
+
+    def put(self, key, connection, generation):
+        # Keep a connection to use again
+        self.lock.acquire()
+        self.idle.setdefault(key, []).append([connection, time.time(), generation])
+        self.lock.release()
+
+    def closeAll(self):
+        self.lock.acquire()
+        for key in self.idle:
+            for connection, last_used, generation in self.idle[key]:
+                connection.close()
+        self.idle = {}
+        self.lock.release()
+
+
+pool = ConnectionPool()
+
+
+def getKey(url):
+    # Return the scheme, host and port a URL is for, and the path to ask for
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    if not scheme == "http" and not scheme == "https": raise HTTPError("Can't fetch " + url)
+    port = parts.port
+    if port == None:
+        if scheme == "https": port = 443
+        else: port = 80
+    path = parts.path
+    if path == "": path = "/"
+    if not parts.query == "": path = path + "?" + parts.query
+    return (scheme, parts.hostname, port), path
+
+
+def request(key, path, connect_timeout, read_timeout, max_response):
+    # Make one request, reusing a connection if there is one.  Returns the response and the body
+    generation = getState("tunnel_generation")
+    connection, reused = pool.get(key, connect_timeout)
+    try:
+        if connection.sock == None: connection.connect()
+        connection.sock.settimeout(read_timeout)
+        connection.putrequest("GET", path)
+        connection.putheader("User-Agent", user_agent)
+        connection.putheader("Connection", "keep-alive")
+        connection.endheaders()
+        response = connection.getresponse()
+        body = response.read(max_response + 1)
+    except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        # The server may have closed a connection that was being kept, so try once with a new one
+        if reused: return request(key, path, connect_timeout, read_timeout, max_response)
+        raise
+    if len(body) > max_response:
+        connection.close()
+        raise HTTPError("Response from " + key[1] + " is bigger than " + str(max_response) + " bytes")
+    # Only keep the connection if all of the response has been read and the server will keep it open
+    if response.will_close or not response.isclosed():
+        connection.close()
+    else:
+        pool.put(key, connection, generation)
+    return response, body
+
+
+def fetch(url, connect_timeout = default_connect_timeout, read_timeout = default_read_timeout, max_response = default_max_response):
+    # Return the body of the response to a GET for a URL, following any redirects.  Raises
+    # HTTPError, or the underlying socket or httplib error, if it can't be fetched
+    for i in range(0, max_redirects + 1):
+        key, path = getKey(url)
+        response, body = request(key, path, connect_timeout, read_timeout, max_response)
+        if response.status in [301, 302, 303, 307, 308]:
+            location = response.getheader("Location")
+            if location == None: break
+            url = urlparse.urljoin(url, location)
+            debugTrace("Redirected to " + url)
+            continue
+        if not response.status == 200: raise HTTPError("Got " + str(response.status) + " " + response.reason + " from " + url)
+        return body
+    raise HTTPError("Too many redirects fetching " + url)
+
+
+def closeConnections():
+    # Close any connections being kept for reuse
+    pool.closeAll()
@@ -18,35 +18,103 @@
 #
 #    Shared code to return info about an IP connection.
 
+import os
 import re
-import urllib2
+import json
+import time
+import threading
+import Queue
 import xbmcaddon
 import xbmcgui
 from libs.utility import debugTrace, infoTrace, errorTrace, ifDebug, newPrint
+from libs.httpclient import fetch
+from libs.platform import getUserDataPath
 
 
 
 ip_sources = ["Auto select", "IP-API", "IPInfoDB", "freegeoip.net"]
 ip_urls = ["", "http://ip-api.com/json", "http://www.ipinfodb.com/my_ip_location.php", "http://freegeoip.net/json/"] 
-LIST_DEFAULT = "0,0,0"
+# How long to wait to connect to each source and for each read, in seconds
+ip_timeouts = [[0, 0], [4, 6], [4, 10], [4, 6]]
+# The most that's read from a source, IPInfoDB returns a whole web page
+ip_max_response = [0, 16384, 262144, 16384]
 
-MAX_ERROR = 64
+# The sources are ranked by how quickly they're likely to answer.  The average response time and
+# success rate of each are kept in memory and written to a file in userdata at most this often
+scores_file = "IPSOURCES.txt"
+score_save_interval = 300
+# How much the latest lookup counts towards the averages
+score_weight = 0.3
+# The response time assumed for a source that's not been used, in seconds
+default_response_time = 2.0
+min_success_rate = 0.05
 
-def getIPInfoFrom(source):
+# When auto selecting, the sources are asked one after another this many seconds apart (or as soon
+# as the previous one fails) and the first good answer is used.  Sources not asked by then aren't
+hedge_delay = 1.5
+# How long to wait for any answer at all
+hedge_timeout = 30
+
+def getIPInfoHedged(sources):
+    # Ask each of the sources in turn without waiting for the previous one to finish, returning
+    # source, ip, country, region, city, isp from the first good answer, or from the last failure
+    results = Queue.Queue()
+    answered = threading.Event()
+
+    def lookup(source):
+        results.put([source] + list(getIPInfoFrom(source, answered)))
+
+    failure = [sources[0], "error", "error", "error", "call failed", ""]
+    start = time.time()
+    next_start = start
+    asked = 0
+    waiting = 0
+    while asked < len(sources) or waiting > 0:
+        now = time.time()
+        if asked < len(sources) and now >= next_start:
+            debugTrace("Getting IP info from " + sources[asked])
+            thread = threading.Thread(target=lookup, args=(sources[asked],))
+            thread.daemon = True
+            thread.start()
+            asked = asked + 1
+            waiting = waiting + 1
+            next_start = now + hedge_delay
+        if asked < len(sources): timeout = next_start - now
+        else: timeout = start + hedge_timeout - now
+        if timeout <= 0 and asked == len(sources): break
+        try:
+            result = results.get(True, max(timeout, 0.01))
+        except Queue.Empty:
+            continue
+        waiting = waiting - 1
+        if result[1] == "no info" or result[1] == "error":
+            errorTrace("ipinfo.py", "Didn't get a good response from " + result[0])
+            failure = result
+            # No point waiting any longer to ask the next one
+            next_start = time.time()
+        else:
+            # Anything still being asked can finish on its own, but won't be used
+            answered.set()
+            xbmcgui.Window(10000).setProperty("VPN_Manager_Last_IP_Service", result[0])
+            return result
+    answered.set()
+    if waiting > 0: errorTrace("ipinfo.py", "Gave up waiting for a response after " + str(hedge_timeout) + " seconds")
+    return failure
+
+
+def getIPInfoFrom(source, answered = None):
     # Generate request to find out where this IP is based
     # Successful return is ip, country, region, city, isp 
     # No info generated from call is "no info", "unknown", "unknown", "unknown", url response
     # Or general error is "error", "error", "error", reason, url response
     link = ""
+    start = time.time()
     try:      
         # Determine the URL, make the call and read the response
         url = getIPSourceURL(source)
         if url == "": return "error", "error", "error", "unknown source", ""
-        req = urllib2.Request(url)
-        req.add_header("User-Agent", "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:38.0) Gecko/20100101 Firefox/38.0")
-        response = urllib2.urlopen(req)
-        link = response.read()
-        response.close()
+        i = ip_sources.index(source)
+        link = fetch(url, ip_timeouts[i][0], ip_timeouts[i][1], ip_max_response[i])
 
         # Call the right routine to parse the reply using regex.
         # If the website changes, this parsing can fail...sigh
@@ -54,14 +122,15 @@ def getIPInfoFrom(source):
         if source == "IP-API": match = getIPAPI(link)
         if source == "freegeoip.net": match = getFreeGeoIP(link)
         if len(match) > 0:
-            recordWorking(source)
+            # If another source has already answered, this one still worked but isn't the one in use
+            recordWorking(source, answered == None or not answered.is_set(), time.time() - start)
             for ip, country, region, city, isp in match:
                 return ip, country, region, city, isp
         else:
-            recordError(source)
+            recordError(source, time.time() - start)
             return "no info", "unknown location", "unknown location", "no matches", link
     except:
-        recordError(source)
+        recordError(source, time.time() - start)
         return "error", "error", "error", "call failed", link
 
 
@@ -106,118 +175,138 @@ def getIPSourceURL(source):
     return ip_urls[i]
 
 
+def getHedgedSources(first_source):
+    # Return all of the sources, starting with the one given and then in the order they're ranked
+    sources = [first_source]
+    for source in scoreboard.getRanked():
+        if not source in sources: sources.append(source)
+    return sources
+
+
 def getNextSource(current_source):
     next = ip_sources.index(current_source)
     next = next + 1
     if next == len(ip_sources): next = 1
-    # Record that we're using another source
-    source = xbmcgui.Window(10000).getProperty("VPN_Manager_Last_IP_Service")
     return ip_sources[next]
     
 
-def recordError(source):
-    # Double the error value each time to 64
-    i = ip_sources.index(source)
-    error = getErrorValue(i)
-    if error == 0 : error = 1
-    else : error = error * 2
-    if error > MAX_ERROR : error = MAX_ERROR
-    setErrorValue(i, error)
+class SourceScoreboard():
 
-    
-def recordWorking(source):
-    i = ip_sources.index(source)
-    # If a service works (starts working again), set the error value to 0
-    setErrorValue(i, 0)
-    working = getWorkingValue(i)
-    working = working + 1
-    if working > MAX_ERROR : working = 0
-    setWorkingValue(i, working)
-    xbmcgui.Window(10000).setProperty("VPN_Manager_Last_IP_Service", source)
+    def __init__(self):
+        # Keyed by source, each is [average response time, success rate, lookups].  Both are
+        # weighted averages so what's happened recently counts for more
+        self.scores = {}
+        # The VPN provider the scores are for
+        self.vpn = ""
+        self.lock = threading.Lock()
+        self.loaded = 0
+        # The first change is written straight away, the scripts don't run for long
+        self.saved = 0
+        self.changed = False
+
+    def load(self):
+        # Pick up anything else has written since we last looked, unless there's something to write here
+        path = getUserDataPath(scores_file)
+        try:
+            modified = os.path.getmtime(path)
+            if modified == self.loaded or self.changed: return
+            scores_file_handle = open(path, 'r')
+            data = json.load(scores_file_handle)
+            scores_file_handle.close()
+        except Exception as e:
+            return
+        self.lock.acquire()
+        self.scores = {}
+        for source in data.get("scores", {}):
+            self.scores[source.encode("utf-8")] = data["scores"][source]
+        self.vpn = data.get("vpn", "").encode("utf-8")
+        self.loaded = modified
+        self.lock.release()
+
+    def save(self):
+        self.lock.acquire()
+        data = json.dumps({"vpn" : self.vpn, "scores" : self.scores})
+        self.changed = False
+        self.saved = time.time()
+        self.lock.release()
+        try:
+            path = getUserDataPath(scores_file)
+            scores_file_handle = open(path, 'w')
+            scores_file_handle.write(data)
+            scores_file_handle.close()
+            self.loaded = os.path.getmtime(path)
+        except Exception as e:
+            errorTrace("ipinfo.py", "Couldn't write the IP source scores to " + scores_file)
+            errorTrace("ipinfo.py", str(e))
+
+    def saveIfDue(self):
+        if self.changed and time.time() - self.saved > score_save_interval: self.save()
+
+    def record(self, source, worked, duration):
+        self.lock.acquire()
+        score = self.scores.get(source)
+        if score == None:
+            score = [default_response_time, 1.0, 0]
+            self.scores[source] = score
+        if worked:
+            score[0] = score[0] + score_weight * (duration - score[0])
+            score[1] = score[1] + score_weight * (1.0 - score[1])
+        else:
+            # A failure costs at least as much as waiting for the source to time out, however
+            # quickly it happened, otherwise a source that fails straight away looks quick
+            duration = max(duration, ip_timeouts[ip_sources.index(source)][1])
+            score[0] = score[0] + score_weight * (duration - score[0])
+            score[1] = score[1] - score_weight * score[1]
+        score[2] = score[2] + 1
+        self.changed = True
+        self.lock.release()
+        self.saveIfDue()
+
+    def getExpectedTime(self, source):
+        # How long it's likely to take to get an answer, allowing for having to try again if it fails
+        score = self.scores.get(source)
+        if score == None: return default_response_time
+        return score[0] / max(score[1], min_success_rate)
 
+    def getRanked(self):
+        # Return the sources, quickest to answer first.  Those that are equal stay in the usual order
+        return sorted(ip_sources[1:], key=self.getExpectedTime)
+
+    def reset(self, vpn):
+        self.lock.acquire()
+        self.scores = {}
+        self.vpn = vpn
+        self.changed = True
+        self.lock.release()
+        self.save()
+
+
+scoreboard = SourceScoreboard()
+
+
+def recordError(source, duration = 0):
+    scoreboard.record(source, False, duration)
+
+    
+def recordWorking(source, in_use = True, duration = 0):
+    scoreboard.record(source, True, duration)
+    if in_use: xbmcgui.Window(10000).setProperty("VPN_Manager_Last_IP_Service", source)
 
     
 def getAutoSource():
     # If the VPN has changed, then reset all the numbers        
-    addon = xbmcaddon.Addon("service.vpn.manager")
-    last_vpn = addon.getSetting("ip_service_last_vpn")
-    current_vpn = addon.getSetting("vpn_provider_validated")
-    if (not last_vpn == current_vpn):
-        addon.setSetting("ip_service_last_vpn", current_vpn)
-        resetIPServices()
-
-    # Get the last source we tried to use from the home window or use the first if this is first time through
-    source = xbmcgui.Window(10000).getProperty("VPN_Manager_Last_IP_Service")
-    if source == "":
-        # Record that we're using the first one
-        xbmcgui.Window(10000).setProperty("VPN_Manager_Last_IP_Service", ip_sources[1])
-        return ip_sources[1]
-    else:
-    	index = ip_sources.index(source)
-        if index > 1:
-            if getWorkingValue(index) >= getErrorValue(index - 1):
-                setWorkingValue(index, 0)
-                index = index - 1
-        return ip_sources[index]
+    scoreboard.load()
+    current_vpn = xbmcaddon.Addon("service.vpn.manager").getSetting("vpn_provider_validated")
+    if not scoreboard.vpn == current_vpn: scoreboard.reset(current_vpn)
+    # Use whichever source is likely to answer quickest
+    return scoreboard.getRanked()[0]
 
 
 def resetIPServices():
-    addon = xbmcaddon.Addon("service.vpn.manager")
-    addon.setSetting("ip_service_errors", LIST_DEFAULT)
-    addon.setSetting("ip_service_values", LIST_DEFAULT)
+    scoreboard.reset(xbmcaddon.Addon("service.vpn.manager").getSetting("vpn_provider_validated"))
     xbmcgui.Window(10000).setProperty("VPN_Manager_Last_IP_Service", ip_sources[1])
 
 
-def getIndex(source):
-    return ip_sources.index(source)
-    
-def getErrorValue(index):
-    index -= 1
-    errors = xbmcaddon.Addon("service.vpn.manager").getSetting("ip_service_errors")
-    if not errors == "":
-        list = errors.split(",")
-        if not index > len(list):
-            return int(list[index])
-    return 0
-    
-    
-def setErrorValue(index, value):
-    index -= 1
-    errors = xbmcaddon.Addon("service.vpn.manager").getSetting("ip_service_errors")    
-    if errors == "": errors = LIST_DEFAULT
-    list = errors.split(",")
-    i = 0
-    output = ""
-    while i < (len(list)):
-        if i > 0: output = output + ","
-        if i == index: output = output + str(value)
-        else: output = output + str(list[i])
-        i += 1
-    xbmcaddon.Addon("service.vpn.manager").setSetting("ip_service_errors", output)
-    
-    
-def getWorkingValue(index):
-    index -= 1
-    values = xbmcaddon.Addon("service.vpn.manager").getSetting("ip_service_values")
-    if not values == "":
-        list = values.split(",")
-        if not index > len(list):
-            return int(list[index])
-    return 0
-    
-    
-def setWorkingValue(index, value):
-    index -= 1
-    values = xbmcaddon.Addon("service.vpn.manager").getSetting("ip_service_values")    
-    if values == "": values = LIST_DEFAULT
-    list = values.split(",")
-    i = 0
-    output = ""
-    while i < (len(list)):
-        if i > 0: output = output + ","
-        if i == index: output = output + str(value)
-        else: output = output + str(list[i])
-        i += 1
-    xbmcaddon.Addon("service.vpn.manager").setSetting("ip_service_values", output)
-    
-        
\ No newline at end of file
+def saveIPServices():
+    # Write out any changes to the scores
+    if scoreboard.changed: scoreboard.save()
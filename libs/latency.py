@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Zomboided
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Measures how quickly the VPN servers respond for the VPN Manager for OpenVPN add-on.
+
+import os
+import errno
+import json
+import socket
+import threading
+import time
+import Queue
+import xbmcaddon
+from libs.utility import debugTrace, errorTrace, infoTrace
+from libs.platform import getUserDataPath, getAddonPath
+from libs.settings import getSettingValue
+from libs.vpnproviders import getLocationsFileName
+
+
+# Results are shared between the service and the scripts using a file in userdata, they're
+# only used for this long before the server needs to be checked again
+latency_ttl = 3600
+latency_file = "LATENCY.txt"
+# How long to wait for a server and how many servers to check at once
+probe_timeout = 2
+probe_threads = 24
+# Response time recorded for a server that didn't respond
+NO_RESPONSE = -1
+
+
+def probeServer(host, port):
+    # Return the time in milliseconds it takes to connect to a server, or NO_RESPONSE.  A refused
+    # connection still means the server responded, which is all that's needed for UDP servers
+    try:
+        address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+    except Exception as e:
+        return NO_RESPONSE
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(probe_timeout)
+    start = time.time()
+    try:
+        sock.connect(address)
+    except socket.error as e:
+        if not e.errno == errno.ECONNREFUSED:
+            sock.close()
+            return NO_RESPONSE
+    rtt = int((time.time() - start) * 1000)
+    sock.close()
+    return max(rtt, 1)
+
+
+class LatencyCache():
+
+    def __init__(self):
+        # Keyed by host:port, each is [response time, time checked]
+        self.results = {}
+        self.lock = threading.Lock()
+        self.loaded = 0
+
+    def load(self):
+        # Pick up anything else has written since we last looked
+        path = getUserDataPath(latency_file)
+        try:
+            modified = os.path.getmtime(path)
+            if modified == self.loaded: return
+            results_file = open(path, 'r')
+            results = json.load(results_file)
+            results_file.close()
+        except Exception as e:
+            return
+        self.lock.acquire()
+        for key in results:
+            if not key in self.results or results[key][1] > self.results[key][1]:
+                self.results[key.encode("utf-8")] = results[key]
+        self.loaded = modified
+        self.lock.release()
+
+    def save(self):
+        # Merge with anything saved elsewhere, throwing away old results while we're at it
+        self.load()
+        now = time.time()
+        self.lock.acquire()
+        for key in self.results.keys():
+            if now - self.results[key][1] > latency_ttl: del self.results[key]
+        data = json.dumps(self.results)
+        self.lock.release()
+        try:
+            path = getUserDataPath(latency_file)
+            results_file = open(path, 'w')
+            results_file.write(data)
+            results_file.close()
+            self.loaded = os.path.getmtime(path)
+        except Exception as e:
+            errorTrace("latency.py", "Couldn't write server response times to " + latency_file)
+            errorTrace("latency.py", str(e))
+
+    def get(self, server):
+        # Return the response time for a host:port, or None if it's not known
+        result = self.results.get(server)
+        if result == None or time.time() - result[1] > latency_ttl: return None
+        return result[0]
+
+    def set(self, server, rtt):
+        self.lock.acquire()
+        self.results[server] = [rtt, time.time()]
+        self.lock.release()
+
+
+cache = LatencyCache()
+
+
+def getServerKey(host, port):
+    return host + ":" + str(port)
+
+
+def getProfileServers(ovpn_connection):
+    # Return the host:port of every server in a profile
+    servers = []
+    try:
+        ovpn_file = open(ovpn_connection, 'r')
+        lines = ovpn_file.readlines()
+        ovpn_file.close()
+    except Exception as e:
+        errorTrace("latency.py", "Couldn't read the servers from " + ovpn_connection)
+        errorTrace("latency.py", str(e))
+        return servers
+    default_port = "1194"
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 1 and fields[0] == "port": default_port = fields[1]
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 1 and fields[0] == "remote":
+            if len(fields) > 2: port = fields[2]
+            else: port = default_port
+            servers.append(getServerKey(fields[1], port))
+    return servers
+
+
+def getLocationServers(vpn_provider):
+    # Return a dictionary of the servers for each profile generated from the locations file, which
+    # saves opening every profile.  Returns an empty dictionary if there's no locations file
+    servers = {}
+    addon = xbmcaddon.Addon("service.vpn.manager")
+    locations_name = getLocationsFileName(vpn_provider, addon.getSetting("vpn_locations_list"))
+    try:
+        locations_file = open(locations_name, 'r')
+        locations = locations_file.readlines()
+        locations_file.close()
+    except Exception as e:
+        return servers
+    # Any port override will be in the profiles too
+    port_override = {"udp" : "", "tcp" : ""}
+    if not getSettingValue("default_udp"): port_override["udp"] = getSettingValue("alternative_udp_port")
+    if not getSettingValue("default_tcp"): port_override["tcp"] = getSettingValue("alternative_tcp_port")
+    for location in locations:
+        location_values = location.split(",")
+        if len(location_values) < 4: continue
+        proto = location_values[2].strip()
+        ports = location_values[3].split()
+        if not port_override.get(proto, "") == "": ports = [port_override[proto]]
+        location_servers = []
+        for server in location_values[1].split():
+            for port in ports:
+                location_servers.append(getServerKey(server, port))
+        servers[getAddonPath(True, vpn_provider + "/" + location_values[0] + ".ovpn")] = location_servers
+    return servers
+
+
+def getServers(ovpn_connections, vpn_provider):
+    # Return a dictionary of the servers for each of the profiles
+    location_servers = getLocationServers(vpn_provider)
+    servers = {}
+    for connection in ovpn_connections:
+        if connection in location_servers:
+            servers[connection] = location_servers[connection]
+        else:
+            servers[connection] = getProfileServers(connection)
+    return servers
+
+
+def probeServers(servers, progress = None, progress_title = ""):
+    # Check the response time of all of the servers given that haven't been checked recently,
+    # using a pool of threads.  If a progress dialog is passed it's updated and can cancel
+    cache.load()
+    queue = Queue.Queue()
+    for server in set(servers):
+        if cache.get(server) == None: queue.put(server)
+    total = queue.qsize()
+    if total == 0: return
+    infoTrace("latency.py", "Checking response times of " + str(total) + " servers")
+
+    def worker():
+        while True:
+            try:
+                server = queue.get_nowait()
+            except Queue.Empty:
+                return
+            host, port = server.rsplit(":", 1)
+            try:
+                cache.set(server, probeServer(host, int(port)))
+            except Exception as e:
+                cache.set(server, NO_RESPONSE)
+            queue.task_done()
+
+    threads = []
+    for i in range(0, min(probe_threads, total)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    start = time.time()
+    while len(threads) > 0:
+        threads[0].join(0.5)
+        if not threads[0].is_alive(): threads.pop(0)
+        if not progress == None:
+            if progress.iscanceled():
+                # Stop anything else being checked, the ones in progress will finish on their own
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                break
+            done = total - queue.qsize()
+            progress.update(int(done * 100 / total), progress_title, "Checked " + str(done) + " of " + str(total) + " servers")
+    debugTrace("Checked server response times in " + str(int(time.time() - start)) + " seconds")
+    cache.save()
+
+
+def probeProfiles(ovpn_connections, vpn_provider, progress = None, progress_title = ""):
+    # Check the response time of the servers in all of the profiles given
+    servers = []
+    for connection_servers in getServers(ovpn_connections, vpn_provider).values():
+        servers.extend(connection_servers)
+    probeServers(servers, progress, progress_title)
+
+
+def getServersLatency(servers):
+    # Return the best response time of a list of servers, NO_RESPONSE if none of
+    # them responded or None if they've not been checked recently
+    best = None
+    for server in servers:
+        rtt = cache.get(server)
+        if rtt == None: continue
+        if best == None or best == NO_RESPONSE or (rtt < best and not rtt == NO_RESPONSE): best = rtt
+    return best
+
+
+def getProfileLatency(ovpn_connection):
+    cache.load()
+    return getServersLatency(getProfileServers(ovpn_connection))
+
+
+def getLatencyText(rtt):
+    # Return the response time to display next to a profile
+    if rtt == None: return ""
+    if rtt == NO_RESPONSE: return "[COLOR ff999999](no response)[/COLOR]"
+    return "[COLOR ff999999](" + str(rtt) + "ms)[/COLOR]"
+
+
+def getLatencyList(ovpn_connections, vpn_provider):
+    # Return the response time text for each of the profiles
+    cache.load()
+    servers = getServers(ovpn_connections, vpn_provider)
+    latency = []
+    for connection in ovpn_connections:
+        latency.append(getLatencyText(getServersLatency(servers[connection])))
+    return latency
+    
+
+def addLatencyToList(labels, ovpn_connections, vpn_provider, offset):
+    # Return a copy of the list of labels with the response time added for each profile.  The
+    # offset is the position in the labels of the first profile
+    labels = list(labels)
+    latency = getLatencyList(ovpn_connections, vpn_provider)
+    for i in range(0, len(latency)):
+        if not latency[i] == "": labels[i + offset] = labels[i + offset] + "  " + latency[i]
+    return labels
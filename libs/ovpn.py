@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Zomboided
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Reads, edits and writes .ovpn files for the VPN Manager for OpenVPN add-on.
+
+
+# The inline files that can be put in a profile.  Anything else in angle brackets, such as a
+# <connection> block, holds directives so its lines are treated like any others
+inline_blocks = ["<ca>", "<cert>", "<key>", "<tls-auth>", "<tls-crypt>", "<secret>", "<dh>", "<extra-certs>", "<pkcs12>", "<crl-verify>"]
+
+
+class OVPNDocument():
+
+    # Each entry is [name, text].  For a directive the name is the first word on the line, for
+    # a comment, blank line or the tags around a <connection> block it's empty.  An inline file
+    # such as <ca> is a single entry with the name in angle brackets and the lines between the
+    # tags as the text.
+
+    def __init__(self, data = ""):
+        self.original = data
+        self.entries = []
+        self.changed = False
+        self.parse(data)
+
+    def parse(self, data):
+        block_name = None
+        block_lines = []
+        for line in data.splitlines():
+            line = line.strip(' \t\n\r')
+            if not block_name == None:
+                if line == "</" + block_name[1:]:
+                    self.entries.append([block_name, block_lines])
+                    block_name = None
+                else:
+                    block_lines.append(line)
+            elif line in inline_blocks:
+                block_name = line
+                block_lines = []
+            else:
+                self.entries.append([getDirectiveName(line), line])
+        # A block that's never closed is left as it was
+        if not block_name == None:
+            self.entries.append(["", block_name])
+            for line in block_lines:
+                self.entries.append([getDirectiveName(line), line])
+
+    def getIndexes(self, name):
+        # Return the position of each directive or block with this name
+        indexes = []
+        for i in range(0, len(self.entries)):
+            if self.entries[i][0] == name: indexes.append(i)
+        return indexes
+
+    def hasDirective(self, name):
+        for entry in self.entries:
+            if entry[0] == name: return True
+        return False
+
+    def hasDirectiveStarting(self, prefix):
+        for entry in self.entries:
+            if not entry[0].startswith("<") and entry[0].startswith(prefix): return True
+        return False
+
+    def getValue(self, name, default = ""):
+        # Return everything after the name for the first directive with this name
+        for entry in self.entries:
+            if entry[0] == name: return entry[1][len(name):].strip()
+        return default
+
+    def getLine(self, index):
+        return self.entries[index][1]
+
+    def getLines(self):
+        # Return the position and text of every line that's not in a block
+        lines = []
+        for i in range(0, len(self.entries)):
+            if not self.entries[i][0].startswith("<"): lines.append([i, self.entries[i][1]])
+        return lines
+
+    def setLine(self, index, line):
+        if self.entries[index][1] == line: return
+        self.entries[index] = [getDirectiveName(line), line]
+        self.changed = True
+
+    def setDirective(self, name, line):
+        # Replace every directive with this name, returning how many there were
+        indexes = self.getIndexes(name)
+        for i in indexes:
+            self.setLine(i, line)
+        return len(indexes)
+
+    def append(self, line):
+        self.entries.append([getDirectiveName(line), line])
+        self.changed = True
+
+    def getBlock(self, name):
+        # Return the lines in an inline block, or None if there isn't one
+        for entry in self.entries:
+            if entry[0] == "<" + name + ">": return list(entry[1])
+        return None
+
+    def serialize(self):
+        # Return the text of the document, which is exactly what was read if nothing has changed
+        if not self.changed: return self.original
+        output = []
+        for name, text in self.entries:
+            if name.startswith("<"):
+                output.append(name + "\n")
+                for line in text:
+                    output.append(line + "\n")
+                output.append("</" + name[1:] + "\n")
+            else:
+                output.append(text + "\n")
+        return "".join(output)
+
+    def save(self, path):
+        # Write the document out if it's changed, returning True if it was written
+        if not self.changed: return False
+        data = self.serialize()
+        ovpn_file = open(path, 'w')
+        ovpn_file.write(data)
+        ovpn_file.close()
+        self.original = data
+        self.changed = False
+        return True
+
+
+def getDirectiveName(line):
+    # The name of a directive is the first word, comments, blank lines and tags don't have one
+    if line == "" or line.startswith("#") or line.startswith(";") or line.startswith("<"): return ""
+    return line.split()[0]
+
+
+def loadOVPN(path):
+    # Read a .ovpn file.  Any problem reading it is left for the caller to deal with
+    ovpn_file = open(path, 'r')
+    data = ovpn_file.read()
+    ovpn_file.close()
+    return OVPNDocument(data)
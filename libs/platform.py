@@ -19,14 +19,24 @@
 #    Platform specific calls used by VPN Manager for OpenVPN add-on.
 
 import os
+import errno
+import re
 import shlex
 import subprocess
 import sys
+import socket
+import select
+import struct
+import threading
+import time
 import xbmc
 import xbmcgui
 import xbmcvfs
 import xbmcaddon
 from libs.utility import debugTrace, errorTrace, infoTrace, newPrint, infoPrint, enum
+from libs.settings import getSettingValue
+from libs.state import getState, setState
+from libs.ovpn import loadOVPN
 from sys import platform
 
 
@@ -41,6 +51,14 @@ def fakeConnection():
     return xbmcvfs.exists(getUserDataPath("FAKECONNECTION.txt"))
 
     
+def fakeManagement():
+    # Return True to start a fake openvpn management interface when faking the connection, so that
+    # the connection state can be tested without openvpn.  This is governed by the existance of
+    # 'FAKEMANAGEMENT.txt' in the userdata directory.  If the file contains AUTH_FAILED, TLS_ERROR 
+    # or RECONNECTING then the fake connection will fail in that way rather than connecting.
+    return xbmcvfs.exists(getUserDataPath("FAKEMANAGEMENT.txt"))
+    
+    
 def fakeSystemd():
     # Return True to pretend that systemd exists, but not make OS calls to use it
     # This is governed by the existance of 'FAKESYSTEMD.txt' in the userdata directory.
@@ -82,13 +100,23 @@ def supportSystemd():
     
     
 def copySystemdFiles():
-    # Delete any existing openvpn.service and copy openvpn service file to config directory
+    # Delete any existing openvpn.service and copy openvpn service file to config directory.  The
+    # pid file is put where the add-on will look for it, which depends on the log location setting
     service_source = getAddonPath(True, "openvpn.service")
     service_dest = getSystemdPath("system.d/openvpn.service")
     debugTrace("Copying openvpn.service " + service_source + " to " + service_dest)
     if not fakeSystemd():
         if xbmcvfs.exists(service_dest): xbmcvfs.delete(service_dest)
-        xbmcvfs.copy(service_source, service_dest)
+        try:
+            service_file = open(service_source, 'r')
+            service = service_file.read()
+            service_file.close()
+            service_file = open(service_dest, 'w')
+            service_file.write(service.replace("#PIDFILE", getVPNPidFilePath(0)))
+            service_file.close()
+        except Exception as e:
+            errorTrace("platform.py", "Couldn't write " + service_dest)
+            errorTrace("platform.py", str(e))
     
     # Delete any existing openvpn.config and copy first VPN to openvpn.config
     config_source = sudo_setting = xbmcaddon.Addon("service.vpn.manager").getSetting("1_vpn_validated")
@@ -119,7 +147,7 @@ def removeSystemd():
     
   
 def useSudo():
-    sudo_setting = xbmcaddon.Addon("service.vpn.manager").getSetting("openvpn_sudo")
+    sudo_setting = getSettingValue("openvpn_sudo")
     if sudo_setting == "Always": return True
     if sudo_setting == "Never": return False
     if getPlatform() == platforms.LINUX:
@@ -129,11 +157,7 @@ def useSudo():
 
 
 def useBigHammer():
-    hammer = xbmcaddon.Addon("service.vpn.manager").getSetting("openvpn_killall")
-    if hammer == "true": 
-        return True
-    else:
-        return False
+    return getSettingValue("openvpn_killall")
     
     
 def getPlatformString():
@@ -141,17 +165,34 @@ def getPlatformString():
     return platforms_str[p]
 
 
-def getVPNLogFilePath():
+def getVPNInstance():
+    # Openvpn can be run twice when switching VPNs (see startStandbyVPN).  This is which of
+    # the two is being used for the current connection, 0 or 1
+    return getState("vpn_instance")
+    
+    
+def getStandbyInstance():
+    return 1 - getVPNInstance()
+    
+    
+def getInstanceName(name, instance):
+    # The first instance uses the original file names, the second has the instance number added
+    if instance == None: instance = getVPNInstance()
+    if instance == 0: return name
+    return name.replace(".", str(instance) + ".")
+
+
+def getVPNLogFilePath(instance = None):
     # Return the full filename for the VPN log file
     # It's platform dependent, but can be forced to the Kodi log location
-    use_kodi_dir = xbmcaddon.Addon("service.vpn.manager").getSetting("openvpn_log_location")
+    use_kodi_dir = getSettingValue("openvpn_log_location")
     p = getPlatform()
-    if p == platforms.WINDOWS or use_kodi_dir == "true" :
+    if p == platforms.WINDOWS or use_kodi_dir :
         # Putting this with the other logs on Windows
-        return xbmc.translatePath("special://logpath/openvpn.log")
+        return xbmc.translatePath("special://logpath/" + getInstanceName("openvpn.log", instance))
     if p == platforms.LINUX or p == platforms.RPI:
         # This should be a RAM drive so doesn't wear the media
-        return "/run/openvpn.log"
+        return "/run/" + getInstanceName("openvpn.log", instance)
         
     # **** ADD MORE PLATFORMS HERE ****
     
@@ -164,22 +205,37 @@ def getImportLogPath():
     
 def stopVPN():
     # Little hammer
-    stopVPNn("15")
-    return
+    return stopVPNn("15")
     
     
 def stopVPN9():
     # Big hammer
-    stopVPNn("9")
-    return
+    return stopVPNn("9")
 
     
-def stopVPNn(n):
-    # Stop the platform VPN task.
+def stopVPNn(n, instance = None):
+    # Stop the platform VPN task.  Returns True if it's known to have stopped
     if not fakeConnection():
         p = getPlatform()
         if p == platforms.LINUX or p == platforms.RPI:
             if useBigHammer(): n = "9"
+            pid = getVPNPid(instance)
+            if pid > 0:
+                # We know which openvpn is ours, so just stop that one and wait for it to go
+                reapVPNProcess(instance)
+                if not isProcessRunning(pid): return True
+                debugTrace("(Linux) Stopping VPN process " + str(pid) + " with signal " + n)
+                try:
+                    os.kill(pid, int(n))
+                except OSError as e:
+                    # Not allowed to signal it directly so it must have been started with sudo
+                    command = "kill -" + n + " " + str(pid)
+                    if useSudo(): command = "sudo " + command
+                    debugTrace("(Linux) Stopping VPN with " + command)
+                    os.system(command)
+                return waitForVPNProcess(pid, instance)
+            # Don't go killing everything when it's the standby that's being stopped
+            if not instance == None: return True
             command = "killall -" + n + " openvpn"
             if useSudo(): command = "sudo " + command
             debugTrace("(Linux) Stopping VPN with " + command)
@@ -195,20 +251,119 @@ def stopVPNn(n):
             
         # **** ADD MORE PLATFORMS HERE ****
         
-    return
+    else:
+        stopFakeManagement()
+    return False
+
+
+def getVPNPidFilePath(instance = None):
+    # Openvpn writes its process id here so it can be checked and stopped without searching for it.
+    # It goes alongside the log file as openvpn won't start if it can't write it
+    use_kodi_dir = getSettingValue("openvpn_log_location")
+    p = getPlatform()
+    if p == platforms.WINDOWS or use_kodi_dir :
+        return xbmc.translatePath("special://logpath/" + getInstanceName("openvpn.pid", instance))
+    if p == platforms.LINUX or p == platforms.RPI:
+        return "/run/" + getInstanceName("openvpn.pid", instance)
         
+    # **** ADD MORE PLATFORMS HERE ****
+    
+    return ""
+    
+    
+def getVPNPid(instance = None):
+    # Return the process id of openvpn, or 0 if it's not known
+    try:
+        pid_file = open(getVPNPidFilePath(instance), 'r')
+        pid = int(pid_file.read().strip())
+        pid_file.close()
+        return pid
+    except:
+        return 0
+
+        
+def setVPNProcess(instance, pid):
+    processes = list(getState("vpn_process"))
+    processes[instance] = pid
+    setState("vpn_process", processes)
+    
+    
+def reapVPNProcess(instance = None):
+    # Openvpn (or sudo) is started as a child of Kodi so has to be waited for once it's finished.
+    # Returns True if it was started by us and has finished
+    if instance == None: instance = getVPNInstance()
+    child = getState("vpn_process")[instance]
+    if child > 0:
+        try:
+            pid, _ = os.waitpid(child, os.WNOHANG)
+            # Still running
+            if pid == 0: return False
+        except OSError as e:
+            # Already waited for, or not started by this Kodi
+            pass
+        setVPNProcess(instance, 0)
+        return True
+    return False
+
+        
+def isProcessRunning(pid):
+    # Return True if the openvpn process is still there
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # If it's running as root we're not allowed to signal it, but it's there
+        if not e.errno == errno.EPERM: return False
+    # Check the process id hasn't been reused by something else.  A finished process
+    # that's not been waited for yet has an empty command line
+    try:
+        cmdline_file = open("/proc/" + str(pid) + "/cmdline", 'r')
+        cmdline = cmdline_file.read()
+        cmdline_file.close()
+        if not "openvpn" in cmdline: return False
+    except IOError as e:
+        pass
+    return True
+
+    
+def waitForVPNProcess(pid, instance = None):
+    # Wait up to 5 seconds for openvpn to end, return True if it did
+    for i in range(0, 50):
+        reapVPNProcess(instance)
+        if not isProcessRunning(pid): return True
+        xbmc.sleep(100)
+    debugTrace("(Linux) VPN process " + str(pid) + " still running")
+    return False
+        
+    
+def launchVPN(vpn_profile, instance, options):
+    # Start openvpn directly rather than via the shell, it'll tell us its process id
+    createManagementPassword(instance)
+    args = [getOpenVPNPath(), vpn_profile, "--writepid", getVPNPidFilePath(instance)] + shlex.split(getManagementParams(instance)) + options
+    if useSudo() : args = ["sudo"] + args
+    debugTrace("(Linux) Starting VPN with " + " ".join(args))
+    reapVPNProcess(instance)
+    try:
+        os.remove(getVPNPidFilePath(instance))
+    except OSError as e:
+        pass
+    outfile = open(getVPNLogFilePath(instance),'w')
+    proc = subprocess.Popen(args, stdout=outfile, close_fds=True)
+    outfile.close()
+    setVPNProcess(instance, proc.pid)
+
     
 def startVPN(vpn_profile):
     # Call the platform VPN to start the VPN
     if not fakeConnection():
+        resetManagement()
+        resetVPNLog()
         p = getPlatform()
         if p == platforms.RPI or p == platforms.LINUX:
-            command=getOpenVPNPath() + " \"" + vpn_profile + "\" > " + getVPNLogFilePath() + " &"
-            if useSudo() : command = "sudo " + command            
-            debugTrace("(Linux) Starting VPN with " + command)
-            os.system(command)
+            setState("switch_device", "")
+            launchVPN(vpn_profile, getVPNInstance(), [])
         if p == platforms.WINDOWS:   
-            command=getOpenVPNPath() + " \"" + vpn_profile + "\""
+            createManagementPassword(getVPNInstance())
+            command=getOpenVPNPath() + " \"" + vpn_profile + "\"" + getManagementParams()
             debugTrace("(Windows) Starting VPN with " + command)
             args = shlex.split(command)
             outfile = open(getVPNLogFilePath(),'w')
@@ -218,11 +373,193 @@ def startVPN(vpn_profile):
         
     else:
         # This bit is just to help with debug during development.
-        command=getOpenVPNPath() + " \"" + vpn_profile + "\" > " + getVPNLogFilePath()
+        command=getOpenVPNPath() + " \"" + vpn_profile + "\"" + getManagementParams() + " > " + getVPNLogFilePath()
         debugTrace("Faking starting VPN with " + command)
+        if fakeManagement():
+            resetManagement()
+            startFakeManagement(getVPNInstance())
     return
 
 
+# Switching between VPNs can be done by connecting the new VPN before disconnecting the old one
+# so that the connection is only lost for as long as it takes to change the routes.  The new VPN
+# is started as a second openvpn on its own tun device, with everything but the routes that take
+# over all of the traffic.  Once it's connected, those routes are moved over to it by hand and the
+# old openvpn is stopped.  The tun device is kept if openvpn restarts, and the routes are added
+# again whenever it reconnects.
+standby_device = "vpnm"
+# VPN routes, these cover everything without replacing the default route
+vpn_routes = ["0.0.0.0/1", "128.0.0.0/1"]
+
+
+def canSwitchVPN():
+    # Return True if the current platform can do a make before break switch
+    p = getPlatform()
+    return p == platforms.LINUX or p == platforms.RPI
+
+
+def runRouteCommand(command):
+    command = "ip route " + command
+    if useSudo(): command = "sudo " + command
+    debugTrace("(Linux) Updating routes with " + command)
+    return os.system(command) == 0
+    
+    
+def getNetGateway():
+    # Return the gateway and device of the default route that's not using a tun device
+    try:
+        route_file = open("/proc/net/route", 'r')
+        lines = route_file.readlines()
+        route_file.close()
+    except Exception as e:
+        errorTrace("platform.py", "Couldn't read the routing table")
+        errorTrace("platform.py", str(e))
+        return "", ""
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) < 8: continue
+        # Destination and mask of 0 is the default route, the gateway is little endian hex
+        if fields[1] == "00000000" and fields[7] == "00000000" and not fields[0].startswith("tun"):
+            gateway = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+            return gateway, fields[0]
+    return "", ""
+    
+    
+def getProfileRemotes(vpn_profile):
+    # Return the addresses of all of the servers that the profile could connect to
+    addresses = []
+    try:
+        profile_file = open(vpn_profile, 'r')
+        lines = profile_file.readlines()
+        profile_file.close()
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 1 and fields[0] == "remote":
+                for address in socket.gethostbyname_ex(fields[1])[2]:
+                    if not address in addresses: addresses.append(address)
+    except Exception as e:
+        errorTrace("platform.py", "Couldn't find the servers used by " + vpn_profile)
+        errorTrace("platform.py", str(e))
+        return []
+    return addresses
+
+    
+def removeSwitchRoutes(name):
+    for address in getState(name):
+        runRouteCommand("del " + address + "/32")
+    setState(name, [])
+
+
+def addVPNRoutes(device):
+    for route in vpn_routes:
+        runRouteCommand("replace " + route + " dev " + device)
+
+
+def restoreVPNRoutes(instance):
+    # Called when openvpn says it's connected.  If it's a VPN that's been switched to, the routes
+    # it doesn't add itself might have gone
+    device = standby_device + str(instance)
+    if fakeConnection() or not getState("switch_device") == device or not instance == getVPNInstance(): return
+    debugTrace("Restoring VPN routes for " + device)
+    addVPNRoutes(device)
+
+
+def writeStandbyProfile(vpn_profile, instance):
+    # Return a copy of the profile that doesn't take over all of the traffic when it connects
+    path = getUserDataPath("openvpn-standby" + str(instance) + ".ovpn")
+    ovpn = loadOVPN(vpn_profile)
+    for i, line in ovpn.getLines():
+        if line.startswith("redirect-gateway") or line.startswith("redirect-private"): ovpn.setLine(i, "# " + line)
+    ovpn_file = open(path, 'w')
+    ovpn_file.write(ovpn.serialize())
+    ovpn_file.close()
+    return path
+    
+    
+def startStandbyVPN(vpn_profile):
+    # Start a second openvpn alongside the current one.  Return False if it can't be done
+    instance = getStandbyInstance()
+    resetManagement(instance)
+    resetVPNLog(instance)
+    if fakeConnection():
+        debugTrace("Faking starting standby VPN " + vpn_profile + " as instance " + str(instance))
+        if fakeManagement(): startFakeManagement(instance)
+        return True
+    if not canSwitchVPN(): return False
+    # Need to know which openvpn is the current one so only that gets stopped
+    if getVPNPid() == 0: return False
+    gateway, device = getNetGateway()
+    if gateway == "":
+        errorTrace("platform.py", "Couldn't find the network gateway, can't switch VPN without disconnecting")
+        return False
+    addresses = getProfileRemotes(vpn_profile)
+    if len(addresses) == 0: return False
+    # The new VPN mustn't connect through the old VPN, otherwise it'll stop working when the old one goes
+    added = []
+    for address in addresses:
+        if runRouteCommand("replace " + address + "/32 via " + gateway + " dev " + device): added.append(address)
+    setState("switch_routes_standby", added)
+    try:
+        standby_profile = writeStandbyProfile(vpn_profile, instance)
+    except Exception as e:
+        errorTrace("platform.py", "Couldn't write the profile for the standby VPN")
+        errorTrace("platform.py", str(e))
+        removeSwitchRoutes("switch_routes_standby")
+        return False
+    # Any other routes, from the profile or pushed by the server, are added by openvpn as usual
+    launchVPN(standby_profile, instance, ["--dev-type", "tun", "--dev", standby_device + str(instance), "--persist-tun",
+                                          "--pull-filter", "ignore", "redirect-gateway", "--pull-filter", "ignore", "redirect-private"])
+    return True
+    
+    
+def getStandbyVPNStatus():
+    # Return the connection status of the standby VPN
+    instance = getStandbyInstance()
+    state = getManagementStatus(instance)
+    if state == None: state = vpn_logs[instance].getStatus()
+    if state == None or state == connection_status.RECONNECTING: state = connection_status.UNKNOWN
+    # If it's been started by us and has finished, it's not going to connect
+    if state == connection_status.UNKNOWN and not fakeConnection() and reapVPNProcess(instance): state = connection_status.ERROR
+    return state
+    
+    
+def stopStandbyVPN():
+    # Give up on the standby VPN and put everything back as it was
+    instance = getStandbyInstance()
+    if fakeConnection():
+        stopFakeManagement()
+        return
+    stopVPNn("15", instance)
+    resetManagement(instance)
+    removeSwitchRoutes("switch_routes_standby")
+
+    
+def promoteStandbyVPN():
+    # Move the VPN routes over to the standby VPN, stop the current VPN and make the standby current
+    instance = getStandbyInstance()
+    if not fakeConnection():
+        device = standby_device + str(instance)
+        addVPNRoutes(device)
+        setState("switch_device", device)
+        # Find the old VPN's servers before it goes, it'll have routed them round itself
+        old_addresses = getProfileRemotes(getState("connected_profile"))
+        remote = getManagementClient(None).remote
+        if not remote == "" and not remote in old_addresses: old_addresses.append(remote)
+        # The old openvpn is killed rather than asked to stop.  Stopping it would run its down script
+        # after the new one's up script, putting the DNS back to how it was before either of them.
+        # Its tun device, and the routes through it, go away with it anyway
+        stopVPNn("9")
+        # Being killed, it's not removed the routes to its servers, or they were added for the previous
+        # switch.  Either way they're not needed now, unless the new VPN is using the same servers
+        removeSwitchRoutes("switch_routes")
+        for address in old_addresses:
+            if not address in getState("switch_routes_standby"): runRouteCommand("del " + address + "/32")
+        setState("switch_routes", getState("switch_routes_standby"))
+        setState("switch_routes_standby", [])
+    resetManagement(getVPNInstance())
+    setState("vpn_instance", instance)
+
+
 def getOpenVPNPath():
     # Call the platform VPN to start the VPN
     if fakeConnection():
@@ -232,7 +569,7 @@ def getOpenVPNPath():
     if p == platforms.RPI:
         return getAddonPath(False, "network.openvpn/bin/openvpn")
     if p == platforms.LINUX:
-        if xbmcaddon.Addon("service.vpn.manager").getSetting("openvpn_no_path") == "true": return "openvpn"
+        if getSettingValue("openvpn_no_path"): return "openvpn"
         return "/usr/sbin/openvpn"
     if p == platforms.WINDOWS:
         # No path specified as install will update command path
@@ -332,17 +669,27 @@ def isVPNTaskRunning():
     # Return True if the VPN task is still running, or the VPN connection is still active
     # Return False if the VPN task is no longer running and the connection is not active
     
+    # If we're talking to openvpn then it's running, no need to go looking for it
+    if isManagementConnected(): return True
+    
     if fakeConnection(): return True
     
     p = getPlatform()
     if p == platforms.LINUX or p == platforms.RPI:
+        # If we know which openvpn is ours, just check it's still there
+        pid = getVPNPid()
+        if pid > 0:
+            reapVPNProcess()
+            if isProcessRunning(pid): return True
+            debugTrace("(Linux) VPN process " + str(pid) + " has finished")
+            return False
         try:
             command = "pidof openvpn"
             if useSudo() : command = "sudo " + command
             debugTrace("(Linux) Checking VPN task with " + command)
             pid = os.system(command)
             # This horrible call returns 0 if it finds a process, it's not returning the PID number
-            if xbmcaddon.Addon("service.vpn.manager").getSetting("alt_pid_check") == "true":
+            if getSettingValue("alt_pid_check"):
                 if pid > 0 : return True
             else:
                 if pid == 0 : return True
@@ -373,12 +720,19 @@ def isVPNTaskRunning():
     return False
 
 
-connection_status = enum(UNKNOWN=0, CONNECTED=1, AUTH_FAILED=2, NETWORK_FAILED=3, TIMEOUT=4, ROUTE_FAILED=5, ACCESS_DENIED=6, OPTIONS_ERROR=7, ERROR=8) 
+connection_status = enum(UNKNOWN=0, CONNECTED=1, AUTH_FAILED=2, NETWORK_FAILED=3, TIMEOUT=4, ROUTE_FAILED=5, ACCESS_DENIED=6, OPTIONS_ERROR=7, ERROR=8, RECONNECTING=9) 
     
 def getVPNConnectionStatus():
     # Open the openvpn output file and parse it for known phrases
     # Return 'connected', 'auth failed', 'network failed', 'error' or ''
 
+    # Use the state openvpn has told us about if we're able to talk to it
+    state = getManagementStatus()
+    if not state == None:
+        # Still trying to connect, so keep waiting
+        if state == connection_status.RECONNECTING: return connection_status.UNKNOWN
+        return state
+
     if fakeConnection(): return connection_status.UNKNOWN
 
     # **** ADD MORE PLATFORMS HERE ****
@@ -386,51 +740,525 @@ def getVPNConnectionStatus():
     
     p = getPlatform()
     if p == platforms.LINUX or p == platforms.RPI or p == platforms.WINDOWS:
-        path = getVPNLogFilePath()
-        state = connection_status.UNKNOWN
-        if xbmcvfs.exists(path):
-            debugTrace("Reading log file")
-            log = open(path,'r')
-            lines = log.readlines()
-            for line in lines:
-                if "Initialization Sequence Completed" in line:
-                    state = connection_status.CONNECTED
-                    break
-                if "AUTH_FAILED" in line:
-                    state = connection_status.AUTH_FAILED
-                if "private key password verification failed" in line:
-                    state = connection_status.AUTH_FAILED
-                if "TLS Error" in line:
-                    state = connection_status.NETWORK_FAILED
-                if "Connection timed out" in line:
-                    state = connection_status.TIMEOUT
-                #if (not p == platforms.WINDOWS) and "Options error" in line and "block-outside-dns" in line
-                    #state = connection_status.OPTIONS_ERROR
-                    # This has been updated to what should be the right check, but other checks elsewhere 
-                    # have make it unnecessary (block-outside-dns is not written for non Windows platform).
-                if p == platforms.WINDOWS and "ROUTE" in line and "Access is denied" in line:
-                    # This is a Windows, not running Kodi as administrator error
-                    state = connection_status.ACCESS_DENIED
-                    break
-                #if "ERROR: Linux route" in line:
-                    # state = connection_status.ROUTE_FAILED
-                    # This tests for a Linux route failure, only it's commented out as
-                    # it can legitimately fail if the route already exists.  If it fails
-                    # for other reasons, I can't tell the different just yet.
-                    # break
-            log.close()
-            # Haven't found what's expected so return an empty stream
-            if not state == connection_status.UNKNOWN: debugTrace("VPN connection status is " + str(state))
-            return state
-        else:
+        state = vpn_logs[getVPNInstance()].getStatus()
+        if state == None:
             errorTrace("platform.py", "Tried to get VPN connection status but log file didn't exist")
             return connection_status.ERROR
+        # Haven't found what's expected so return an empty stream
+        if not state == connection_status.UNKNOWN: debugTrace("VPN connection status is " + str(state))
+        return state
+
+
+# Phrases in the openvpn log that tell us what's happened to the connection.  They're checked in this
+# order and the last one found in a line wins, unless it's final in which case the log isn't looked at
+# any more.  Each is phrase, state, is final, platform (or None for all platforms)
+log_phrases = [("Initialization Sequence Completed", connection_status.CONNECTED, True, None),
+               ("AUTH_FAILED", connection_status.AUTH_FAILED, False, None),
+               ("private key password verification failed", connection_status.AUTH_FAILED, False, None),
+               ("TLS Error", connection_status.NETWORK_FAILED, False, None),
+               ("Connection timed out", connection_status.TIMEOUT, False, None),
+               # This is a Windows, not running Kodi as administrator error
+               ("ROUTE.*Access is denied|Access is denied.*ROUTE", connection_status.ACCESS_DENIED, True, platforms.WINDOWS)]
+               #("Options error.*block-outside-dns", connection_status.OPTIONS_ERROR, False, None)
+               # This has been updated to what should be the right check, but other checks elsewhere 
+               # have make it unnecessary (block-outside-dns is not written for non Windows platform).
+               #("ERROR: Linux route", connection_status.ROUTE_FAILED, True, None)
+               # This tests for a Linux route failure, only it's commented out as
+               # it can legitimately fail if the route already exists.  If it fails
+               # for other reasons, I can't tell the different just yet.
+
+
+class VPNLogTailer():
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.phrases = None
+        self.any_phrase = None
+        self.reset()
+
+    def reset(self):
+        # Start again from the beginning of the log
+        self.inode = None
+        self.offset = 0
+        self.partial = ""
+        self.state = connection_status.UNKNOWN
+        self.final = False
+        
+    def compile(self):
+        # The phrases are compiled the first time they're needed as the platform is needed to pick them
+        p = getPlatform()
+        self.phrases = []
+        patterns = []
+        for phrase, state, final, platform in log_phrases:
+            if platform == None or platform == p:
+                self.phrases.append((re.compile(phrase), state, final))
+                patterns.append(phrase)
+        # Most lines don't match anything, so check all of the phrases in one go first
+        self.any_phrase = re.compile("|".join(patterns))
+
+    def getStatus(self):
+        # Read whatever has been added to the log since the last time and return the state, or None if
+        # there's no log.  If the log has been replaced or truncated, it's read again from the start
+        path = getVPNLogFilePath(self.instance)
+        try:
+            stats = os.stat(path)
+        except Exception as e:
+            self.reset()
+            return None
+        # Windows doesn't have inodes (they're always 0) so only the size tells us if it's been replaced
+        if not stats.st_ino == self.inode or stats.st_size < self.offset:
+            self.reset()
+            self.inode = stats.st_ino
+        if self.final or stats.st_size == self.offset: return self.state
+        try:
+            log = open(path, 'rb')
+            log.seek(self.offset)
+            data = log.read()
+            self.offset = log.tell()
+            log.close()
+        except Exception as e:
+            errorTrace("platform.py", "Couldn't read VPN log file " + path)
+            errorTrace("platform.py", str(e))
+            return self.state
+        if self.phrases == None: self.compile()
+        lines = (self.partial + data).split("\n")
+        # The last line might not have been finished yet, so keep it until it is
+        self.partial = lines.pop()
+        for line in lines:
+            if self.any_phrase.search(line) == None: continue
+            for phrase, state, final in self.phrases:
+                if not phrase.search(line) == None:
+                    self.state = state
+                    if final: 
+                        self.final = True
+                        break
+            if self.final: break
+        return self.state
+
+
+vpn_logs = [VPNLogTailer(0), VPNLogTailer(1)]
+
+
+def resetVPNLog(instance = None):
+    # Called when openvpn is started as it'll write a new log
+    if instance == None: instance = getVPNInstance()
+    vpn_logs[instance].reset()
+
+
+# OpenVPN is started with a management interface so that the state of the connection is pushed to
+# the add-on rather than having to look for the task and read the log file.  Only one client can use
+# the interface at a time, so whichever part of the add-on gets there first uses it and the rest fall
+# back to the log file.  The service is long running so will normally be the one holding it.
+# On Linux the interface is a local socket in the add-on's userdata, elsewhere (or if openvpn is
+# run as root, which would leave Kodi unable to use the socket) it's a local port.  Either way a
+# password is needed to use it, which is generated each time openvpn is started.
+management_host = "127.0.0.1"
+management_port = 7515
+# How long to wait for openvpn to say hello, and how often to try again if it doesn't
+management_timeout = 1
+management_retry = 2
+# If openvpn doesn't answer, something else is using the interface and won't let go of it for
+# a while, so leave it longer each time (up to this) before trying again
+management_retry_max = 60
+# Interval at which openvpn sends the byte counts
+management_bytecount = 5
+
+
+def getManagementSocketPath(instance):
+    # Return the path of the management socket, or "" if a port should be used
+    if not hasattr(socket, "AF_UNIX") or useSudo(): return ""
+    if fakeConnection():
+        p = platforms.LINUX
+    else:
+        p = getPlatform()
+    if p == platforms.LINUX or p == platforms.RPI:
+        path = getUserDataPath("openvpn-mgmt" + str(instance) + ".sock")
+        # Socket paths can't be very long
+        if len(path) < 100: return path
+    return ""
+
+
+def getManagementPasswordPath(instance):
+    return getUserDataPath("openvpn-mgmt" + str(instance) + ".pwd")
+
+
+def createManagementPassword(instance):
+    # Write out a new password for openvpn to read when it starts, only readable by Kodi's user (and root)
+    path = getManagementPasswordPath(instance)
+    try:
+        os.remove(path)
+    except OSError as e:
+        pass
+    password = os.urandom(16).encode("hex")
+    pw_file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w')
+    pw_file.write(password + "\n")
+    pw_file.close()
+
+
+def getManagementPassword(instance):
+    try:
+        pw_file = open(getManagementPasswordPath(instance), 'r')
+        password = pw_file.read().strip()
+        pw_file.close()
+        return password
+    except:
+        return ""
+
+
+def getManagementParams(instance = None):
+    if instance == None: instance = getVPNInstance()
+    password_path = "\"" + getManagementPasswordPath(instance) + "\""
+    socket_path = getManagementSocketPath(instance)
+    if not socket_path == "":
+        return " --management \"" + socket_path + "\" unix " + password_path
+    return " --management " + management_host + " " + str(management_port + instance) + " " + password_path
+
+
+class ManagementClient():
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.sock = None
+        self.buffer = ""
+        self.last_attempt = 0
+        self.reset()
+        
+    def reset(self):
+        # Forget everything about the last connection
+        self.seen = False
+        self.auth_failed = False
+        self.state = ""
+        self.reason = ""
+        # The address of the server it's connected to
+        self.remote = ""
+        self.status = connection_status.UNKNOWN
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_attempt = 0
+        self.retry = management_retry
+        # Set once openvpn says it's connected
+        self.connected = False
+
+    def connect(self):
+        # Connect to openvpn if we're not already, giving up quickly if it's not there
+        if not self.sock == None: return True
+        now = time.time()
+        if now - self.last_attempt < self.retry: return False
+        self.last_attempt = now
+        sock = None
+        try:
+            socket_path = getManagementSocketPath(self.instance)
+            if not socket_path == "":
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(management_timeout)
+                sock.connect(socket_path)
+            else:
+                sock = socket.create_connection((management_host, management_port + self.instance), management_timeout)
+                sock.settimeout(management_timeout)
+            # Openvpn asks for the password (without ending the line), then says hello.  If something
+            # else is already talking to openvpn, nothing will come
+            buffer = ""
+            while True:
+                if buffer.startswith("ENTER PASSWORD:"):
+                    sock.sendall(getManagementPassword(self.instance) + "\n")
+                    buffer = buffer[15:]
+                if "\n" in buffer:
+                    line, buffer = buffer.split("\n", 1)
+                    line = line.strip()
+                    if line.startswith(">INFO:"): break
+                    if not line.startswith("SUCCESS:"): raise socket.error("Unexpected greeting " + line)
+                    continue
+                data = sock.recv(1024)
+                if data == "": raise socket.error("Connection closed")
+                buffer = buffer + data
+            sock.sendall("state on\nbytecount " + str(management_bytecount) + "\nstate\n")
+        except socket.timeout as e:
+            if not sock == None: sock.close()
+            self.retry = min(self.retry * 2, management_retry_max)
+            debugTrace("Openvpn management interface didn't answer, trying again in " + str(self.retry) + " seconds")
+            return False
+        except Exception as e:
+            if not sock == None: sock.close()
+            return False
+        debugTrace("Connected to openvpn management interface")
+        self.retry = management_retry
+        self.sock = sock
+        self.buffer = buffer
+        self.seen = True
+        return True
+        
+    def close(self):
+        if not self.sock == None:
+            debugTrace("Disconnected from openvpn management interface")
+            try:
+                self.sock.close()
+            except:
+                pass
+        self.sock = None
+        self.buffer = ""
+
+    def poll(self):
+        # Process everything openvpn has sent since we last looked, without waiting
+        if self.sock == None: return
+        try:
+            while True:
+                readable, _, _ = select.select([self.sock], [], [], 0)
+                if len(readable) == 0: break
+                data = self.sock.recv(4096)
+                if data == "":
+                    # Openvpn has gone away
+                    self.close()
+                    break
+                self.buffer = self.buffer + data
+        except Exception as e:
+            self.close()
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.parse(line.strip())
+            
+    def parse(self, line):
+        if line.startswith(">STATE:"):
+            self.parseState(line[7:])
+        elif line.startswith(">BYTECOUNT:"):
+            counts = line[11:].split(",")
+            try:
+                self.bytes_in = int(counts[0])
+                self.bytes_out = int(counts[1])
+            except:
+                pass
+        elif line.startswith(">PASSWORD:Verification Failed"):
+            self.auth_failed = True
+            self.setStatus(connection_status.AUTH_FAILED)
+        elif line.startswith(">FATAL:"):
+            errorTrace("platform.py", "Openvpn reported " + line)
+        elif len(line) > 0 and line[0].isdigit():
+            # Response to the state command, same as a state notification without the prefix
+            self.parseState(line)
+            
+    def parseState(self, data):
+        # State lines are time,state,description,local ip,remote ip,...
+        fields = data.split(",")
+        if len(fields) < 3: return
+        self.state = fields[1]
+        self.reason = fields[2]
+        if self.state == "CONNECTED":
+            if len(fields) > 4: self.remote = fields[4]
+            if self.reason == "SUCCESS": status = connection_status.CONNECTED
+            # Connected with errors, the log file will say why
+            else: status = None
+        elif self.state == "RECONNECTING" or self.state == "EXITING":
+            if self.reason == "auth-failure" or self.auth_failed: status = connection_status.AUTH_FAILED
+            elif self.reason == "tls-error": status = connection_status.NETWORK_FAILED
+            elif self.state == "RECONNECTING": status = connection_status.RECONNECTING
+            else: status = connection_status.UNKNOWN
+        else:
+            # All of the other states are on the way to being connected
+            status = connection_status.UNKNOWN
+        self.setStatus(status)
+        
+    def setStatus(self, status):
+        if not status == self.status:
+            debugTrace("Openvpn management state is " + self.state + ", " + self.reason)
+            if status == connection_status.CONNECTED: restoreVPNRoutes(self.instance)
+        self.status = status
+        if status == connection_status.CONNECTED: self.connected = True
+        
+    def getStatus(self):
+        # Return the connection status, or None if it needs to come from somewhere else
+        self.connect()
+        self.poll()
+        if not self.seen: return None
+        if self.sock == None and self.connected:
+            # Openvpn has gone away since it connected, so it's not connected now whatever the log
+            # file says.  If it said why, that's still worth knowing
+            if self.status == None or self.status == connection_status.CONNECTED or self.status == connection_status.RECONNECTING:
+                return connection_status.UNKNOWN
+            return self.status
+        # Openvpn went away without saying why
+        if self.sock == None and self.status == connection_status.UNKNOWN: return None
+        return self.status
+
+
+# One client for each openvpn instance
+management = [ManagementClient(0), ManagementClient(1)]
+
+
+def getManagementClient(instance):
+    if instance == None: instance = getVPNInstance()
+    return management[instance]
+
+
+def resetManagement(instance = None):
+    # Called when openvpn is being started, so that nothing is remembered from the last connection
+    client = getManagementClient(instance)
+    client.close()
+    client.reset()
+    
+
+def getManagementStatus(instance = None):
+    return getManagementClient(instance).getStatus()
+    
+
+def isManagementConnected():
+    # Return True if we're currently talking to openvpn
+    client = getManagementClient(None)
+    client.connect()
+    client.poll()
+    return not client.sock == None
+    
+
+def getManagementByteCount():
+    # Return the bytes in and out of the current connection
+    client = getManagementClient(None)
+    client.poll()
+    return client.bytes_in, client.bytes_out
+
+
+# This is just to help with debug during development.  It pretends to be the openvpn management
+# interface and plays through the states of a connection, as directed by FAKEMANAGEMENT.txt.
+class FakeManagementServer(threading.Thread):
+
+    def __init__(self, outcome, instance):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.outcome = outcome
+        self.running = True
+        self.password = getManagementPassword(instance)
+        socket_path = getManagementSocketPath(instance)
+        if not socket_path == "":
+            try:
+                os.remove(socket_path)
+            except OSError as e:
+                pass
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(socket_path)
+        else:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((management_host, management_port + instance))
+        self.listener.listen(1)
+        self.listener.settimeout(0.5)
+        
+    def getStates(self):
+        states = ["CONNECTING,,,,", "WAIT,,,,", "AUTH,,,,", "GET_CONFIG,,,,", "ASSIGN_IP,,10.8.0.6,,", "ADD_ROUTES,,,,"]
+        if self.outcome == "AUTH_FAILED":
+            return states[:3] + [">PASSWORD:Verification Failed: 'Auth'", "EXITING,auth-failure,,,"]
+        if self.outcome == "TLS_ERROR":
+            return states[:2] + ["RECONNECTING,tls-error,,,"]
+        if self.outcome == "RECONNECTING":
+            return states[:3] + ["RECONNECTING,ping-restart,,,"]
+        return states + ["CONNECTED,SUCCESS,10.8.0.6,127.0.0.1,1194"]
+        
+    def stop(self):
+        self.running = False
+        
+    def run(self):
+        while self.running:
+            try:
+                client, _ = self.listener.accept()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                break
+            self.serve(client)
+        self.listener.close()
+        
+    def serve(self, client):
+        client.settimeout(0.2)
+        history = []
+        pending = self.getStates()
+        bytecount = 0
+        last_bytecount = time.time()
+        try:
+            buffer = ""
+            client.sendall("ENTER PASSWORD:")
+            while self.running and not "\n" in buffer:
+                try:
+                    data = client.recv(1024)
+                    if data == "": break
+                    buffer = buffer + data
+                except socket.timeout:
+                    pass
+            password, _, buffer = buffer.partition("\n")
+            if not password.strip() == self.password:
+                client.sendall("ERROR: bad password\n")
+                client.close()
+                return
+            client.sendall("SUCCESS: password is correct\n")
+            client.sendall(">INFO:OpenVPN Management Interface Version 1 -- fake\n")
+            while self.running:
+                try:
+                    data = client.recv(1024)
+                    if data == "": break
+                    buffer = buffer + data
+                except socket.timeout:
+                    pass
+                while "\n" in buffer:
+                    command, buffer = buffer.split("\n", 1)
+                    command = command.strip()
+                    if command == "state":
+                        for state in history: client.sendall(state + "\n")
+                        client.sendall("END\n")
+                    elif command.startswith("bytecount "):
+                        bytecount = int(command[10:])
+                        client.sendall("SUCCESS: bytecount interval changed\n")
+                    else:
+                        client.sendall("SUCCESS: " + command + "\n")
+                # Move on to the next state each time round
+                if len(pending) > 0:
+                    state = pending.pop(0)
+                    if state.startswith(">"):
+                        client.sendall(state + "\n")
+                    else:
+                        state = str(int(time.time())) + "," + state
+                        history.append(state)
+                        client.sendall(">STATE:" + state + "\n")
+                if bytecount > 0 and time.time() - last_bytecount >= bytecount:
+                    last_bytecount = time.time()
+                    client.sendall(">BYTECOUNT:" + str(len(history) * 1024) + "," + str(len(history) * 256) + "\n")
+            if not self.running:
+                client.sendall(">STATE:" + str(int(time.time())) + ",EXITING,SIGTERM,,,\n")
+        except Exception as e:
+            pass
+        client.close()
+        
+
+fake_management = None
+
+
+def startFakeManagement(instance):
+    global fake_management
+    stopFakeManagement()
+    outcome = ""
+    try:
+        fake_file = open(getUserDataPath("FAKEMANAGEMENT.txt"), 'r')
+        outcome = fake_file.read().strip()
+        fake_file.close()
+    except:
+        pass
+    try:
+        createManagementPassword(instance)
+        fake_management = FakeManagementServer(outcome, instance)
+        fake_management.start()
+        debugTrace("Started fake openvpn management interface " + outcome)
+    except Exception as e:
+        errorTrace("platform.py", "Couldn't start fake openvpn management interface")
+        errorTrace("platform.py", str(e))
+        fake_management = None
+        
+        
+def stopFakeManagement():
+    global fake_management
+    if not fake_management == None:
+        fake_management.stop()
+        fake_management.join(2)
+        fake_management = None
 
             
-def writeVPNLog():
+def writeVPNLog(instance = None):
     # Write the openvpn output log to the error file
     try:
-        log_file = open(getVPNLogFilePath(), 'r')
+        log_file = open(getVPNLogFilePath(instance), 'r')
         log_output = log_file.readlines()
         log_file.close()
         infoTrace("platform.py", "VPN log file start >>>")
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Zomboided
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Cached copy of the settings used by the VPN Manager for OpenVPN add-on.
+
+import xbmcaddon
+
+
+# Each call to getSetting goes off into Kodi, so the settings that are read regularly are loaded
+# once and then refreshed when the service sees them change.  Anything not listed here is read
+# so infrequently that it can be fetched from the add-on directly.
+BOOL = 0
+STRING = 1
+INT = 2
+
+# **** ADD ANY SETTINGS THAT ARE READ A LOT HERE ****
+cached_settings = {"vpn_enable_debug" : BOOL,
+                   "openvpn_sudo" : STRING,
+                   "openvpn_killall" : BOOL,
+                   "openvpn_log_location" : BOOL,
+                   "openvpn_no_path" : BOOL,
+                   "alt_pid_check" : BOOL,
+                   "user_def_keys" : STRING,
+                   "user_def_credentials" : BOOL,
+                   "use_default_up_down" : BOOL,
+                   "up_down_script" : BOOL,
+                   "force_ping" : BOOL,
+                   "block_outside_dns" : BOOL,
+                   "default_udp" : BOOL,
+                   "alternative_udp_port" : STRING,
+                   "default_tcp" : BOOL,
+                   "alternative_tcp_port" : STRING,
+                   "openvpn_verb" : STRING,
+                   "lazy_ovpn_files" : BOOL,
+                   "vpn_reconnect" : BOOL,
+                   "vpn_reconnect_freq" : INT,
+                   "vpn_reconnect_while_playing" : BOOL,
+                   "vpn_reconnect_filtering" : BOOL,
+                   "vpn_reconnect_reboot" : BOOL,
+                   "display_location_on_connect" : BOOL,
+                   "vpn_make_before_break" : BOOL,
+                   "vpn_best_server" : BOOL,
+                   "reboot_file_enabled" : BOOL,
+                   "reboot_file" : STRING,
+                   "reboot_day" : STRING,
+                   "reboot_time" : STRING}
+
+
+class SettingsSnapshot():
+
+    def __init__(self):
+        self.values = None
+
+    def load(self):
+        # Read all of the cached settings in one go.  The new set of values replaces
+        # the old so anything reading them at the same time sees one or the other
+        addon = xbmcaddon.Addon("service.vpn.manager")
+        values = {}
+        for name in cached_settings:
+            values[name] = self.convert(name, addon.getSetting(name))
+        self.values = values
+
+    def convert(self, name, value):
+        type = cached_settings[name]
+        if type == BOOL: return value == "true"
+        if type == INT:
+            try:
+                return int(value)
+            except:
+                return 0
+        return value
+
+    def get(self, name):
+        values = self.values
+        if values == None:
+            self.load()
+            values = self.values
+        return values[name]
+
+    def set(self, name, value):
+        # Write the setting through to Kodi and update the cached copy
+        xbmcaddon.Addon("service.vpn.manager").setSetting(name, value)
+        values = self.values
+        if not values == None and name in cached_settings:
+            values[name] = self.convert(name, value)
+
+    def refresh(self):
+        # Throw away the cached values, they'll be loaded again when next needed
+        self.values = None
+
+
+snapshot = SettingsSnapshot()
+
+
+def getSettingValue(name):
+    # Return the cached, typed value of a setting
+    return snapshot.get(name)
+
+
+def setSettingValue(name, value):
+    # Update a setting and the cached value
+    snapshot.set(name, value)
+
+
+def refreshSettings():
+    # Called when the settings have changed
+    snapshot.refresh()
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Zomboided
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#    State shared between the service and the rest of the VPN Manager for OpenVPN add-on.
+
+import xbmcgui
+import json
+import random
+import threading
+from libs.utility import errorTrace
+
+
+# All of the state is held in one serialized window property so that it can be shared with the
+# service and the scripts, which all run in their own interpreter.  A second, short, property
+# holds the generation of the state and changes every time the state is written.  A copy of the
+# state is kept in memory and it's only loaded again if the generation has moved on.
+state_property = "VPN_Manager_State"
+generation_property = "VPN_Manager_State_Generation"
+
+# Bump this if the meaning of any of the values changes, any state stored using an old
+# version will be ignored and the defaults used instead
+state_version = 2
+
+# **** ADD MORE STATE HERE ****
+default_state = {"connected_profile" : "",
+                 "connected_profile_friendly" : "",
+                 "requested_profile" : "",
+                 "requested_profile_friendly" : "",
+                 "last_profile" : "",
+                 "last_profile_friendly" : "",
+                 "vpn_state" : "",
+                 "connection_errors" : 0,
+                 "service_control" : "",
+                 "service_update" : "",
+                 "cycle" : "",
+                 "cycle_lock" : "",
+                 "cycle_lock_queued" : "",
+                 "api_command" : "",
+                 "monitor_state" : "",
+                 "user_directory" : "",
+                 "vpn_process" : [0, 0],
+                 "vpn_instance" : 0,
+                 "switch_routes" : [],
+                 "switch_routes_standby" : [],
+                 "switch_device" : "",
+                 "tunnel_generation" : 0,
+                 "ip_info" : []}
+
+
+class StateStore():
+
+    def __init__(self):
+        self.values = dict(default_state)
+        self.generation = None
+        self.count = 0
+        # Each thread has its own batch, so one thread's batch doesn't hold up another's changes
+        self.local = threading.local()
+        # The names of the values changed here that haven't been written out yet
+        self.dirty = set()
+        # The service looks things up on a worker thread which can change the state too
+        self.lock = threading.RLock()
+
+    def read(self):
+        # Read the state as it currently is in the window property.  Anything that's been
+        # changed here but not written out yet is kept
+        window = xbmcgui.Window(10000)
+        generation = window.getProperty(generation_property)
+        if generation == self.generation: return
+        values = dict(default_state)
+        count = 0
+        data = window.getProperty(state_property)
+        if not data == "":
+            try:
+                record = json.loads(data)
+                if record["version"] == state_version:
+                    count = record["generation"]
+                    for name, value in record["values"].items():
+                        name = name.encode("utf-8")
+                        if not name in values: continue
+                        if isinstance(value, unicode): value = value.encode("utf-8")
+                        values[name] = value
+            except Exception as e:
+                errorTrace("state.py", "Couldn't load the VPN Manager state, using the defaults")
+                errorTrace("state.py", str(e))
+        for name in self.dirty:
+            values[name] = self.values[name]
+        self.values = values
+        self.count = count
+        self.generation = generation
+
+    def load(self):
+        # Load the state if something else has changed it since it was last looked at.  Whilst
+        # a batch of changes is being made the in memory copy is used without checking
+        if self.getBatching() > 0 and not self.generation == None: return
+        self.read()
+
+    def save(self):
+        # Merge the values changed here into the latest copy of the state, so changes made by another
+        # interpreter to other values aren't lost, then write it out and move the generation on so any
+        # other copies get reloaded.  The generation includes a random part as two interpreters could
+        # be writing the same count
+        self.read()
+        self.count = self.count + 1
+        self.generation = str(self.count) + "-" + str(random.randint(0, 999999))
+        record = {"version" : state_version, "generation" : self.count, "values" : self.values}
+        window = xbmcgui.Window(10000)
+        window.setProperty(state_property, json.dumps(record))
+        window.setProperty(generation_property, self.generation)
+        self.dirty = set()
+
+    def get(self, name):
+        self.lock.acquire()
+        try:
+            self.load()
+            return self.values[name]
+        finally:
+            self.lock.release()
+
+    def set(self, name, value):
+        # Pick up any changes before making this one so they don't get lost
+        self.lock.acquire()
+        try:
+            self.load()
+            if self.values[name] == value: return
+            self.values[name] = value
+            self.dirty.add(name)
+            if self.getBatching() == 0: self.save()
+        finally:
+            self.lock.release()
+
+    def getBatching(self):
+        return getattr(self.local, "batching", 0)
+
+    def startBatch(self):
+        self.lock.acquire()
+        self.load()
+        self.local.batching = self.getBatching() + 1
+        self.lock.release()
+
+    def endBatch(self):
+        self.lock.acquire()
+        self.local.batching = self.getBatching() - 1
+        if self.local.batching == 0 and len(self.dirty) > 0: self.save()
+        self.lock.release()
+
+
+store = StateStore()
+
+
+def getState(name):
+    # Return a value from the shared state
+    return store.get(name)
+
+
+def setState(name, value):
+    # Update a value in the shared state, writing it out unless a batch is being built up
+    store.set(name, value)
+
+
+def startStateBatch():
+    # Hold any changes to the state in memory until endStateBatch is called, so several
+    # values can be changed with a single write.  Batches can be nested.
+    store.startBatch()
+
+
+def endStateBatch():
+    # Write out any changes made since the matching startStateBatch
+    store.endBatch()
@@ -33,6 +33,8 @@ from libs.utility import debugTrace, errorTrace, infoTrace, newPrint
 from libs.vpnproviders import getUserDataPathWrapper, removeGeneratedFiles, cleanPassFiles
 from libs.platform import getUserDataPath, getPlatform, platforms, getSeparator, getImportLogPath
 from libs.logbox import popupImportLog
+from libs.settings import setSettingValue
+from libs.ovpn import loadOVPN
 
 # Delete any existing files
 def clearUserData():
@@ -204,13 +206,9 @@ def importWizard():
                         auth = False
                         infoTrace("import.py", "Updating " + dest_name)
                         detail.append("Updating " + dest_name + "\n")
-                        source_file = open(dest_name, 'r')
-                        source = source_file.readlines()
-                        source_file.close()
-                        dest_file = open(dest_name, 'w')
+                        source = loadOVPN(dest_name)
                         proto = "UDP"
-                        for line in source:
-                            line = line.strip(' \t\n\r')
+                        for index, line in source.getLines():
                             old_line = line
                             i = 0
                             # Look for each non ovpn file uploaded and update it to make sure the path is good
@@ -256,12 +254,13 @@ def importWizard():
                                         last_key_found = old_line
                                 if line.startswith("proto "):
                                     if "tcp" in (line.lower()): proto = "TCP"
-                                if line.startswith("<cert>"):
-                                    ecert_count += 1
-                                if line.startswith("<key>"):
-                                    ekey_count += 1
-                            dest_file.write(line+"\n")
-                        dest_file.close()
+                            source.setLine(index, line)
+                        # Count the embedded certificates and keys
+                        if not source.getBlock("cert") == None:
+                            ecert_count += 1
+                        if not source.getBlock("key") == None:
+                            ekey_count += 1
+                        source.save(dest_name)
                         
                         if rename:
                             proto = " (" + proto + ").ovpn"
@@ -301,19 +300,19 @@ def importWizard():
                 if auth_count > 0:
                     if auth_found > 0:
                         # Not using a password as resolved by file
-                        addon.setSetting("user_def_credentials", "false")
+                        setSettingValue("user_def_credentials", "false")
                         summary.append("The auth-user-pass tag was found " + str(auth_count) + " times, but was resolved using a supplied file so user name and password don't need to be entered.\n")
                         if not auth_found == auth_count:
                             summary.append("  WARNING : The auth-user-pass tag was found " + str(auth_count) + " times, but only resolved using a supplied file " + str(auth_found) + " times. Some connections may not work.\n")
                     else:
                         # Using a password as auth-user-pass tag was found
-                        addon.setSetting("user_def_credentials", "true")
+                        setSettingValue("user_def_credentials", "true")
                         summary.append("The auth-user-pass tag was found " + str(auth_count) + " times so assuming user name and password authentication is used.\n")
                     if auth_count < len(ovpn_files):
                         summary.append("  WARNING : The auth-user-pass tag was only found in " + str(auth_count) + " .ovpn files, out of " + str(len(ovpn_files)) + ". Some connections may not work.\n")
                 else:
                     # Not using a password as no auth-user-pass tag was found
-                    addon.setSetting("user_def_credentials", "false")
+                    setSettingValue("user_def_credentials", "false")
                     summary.append("No auth-user-pass tag was found, so assuming user name and password is not needed.\n")
                 
                 # Report on how keys and certs will be handled
@@ -321,24 +320,24 @@ def importWizard():
                     summary.append("The key tag was found " + str(key_count) + " times, and the cert tag was found " + str(cert_count) + " times.\n")
                     if cert_found > 0 or key_found > 0:
                         # Key and cert resolved by file so not asking user for them
-                        addon.setSetting("user_def_keys", "None")
+                        setSettingValue("user_def_keys", "None")
                         summary.append("The key and certificate don't need to be requested as the key tags were resolved using a supplied file " + str(key_found) + " times, and the cert tags were resolved using a supplied file " + str(cert_found) + " times.\n")
                         if (not cert_found == cert_count) or (not key_found == key_count):
                             summary.append("  WARNING : The key or cert tags were not resolved by a supplied file for all occurrences. Some connections may not work.\n")
                     else:
                         if multiple_certs or multiple_keys:
                             # Key and cert tags found with different file names, but no files supplied.  Assume multiple files, user supplied
-                            addon.setSetting("user_def_keys", "Multiple")
+                            setSettingValue("user_def_keys", "Multiple")
                             summary.append("Found key and cert tags with multiple filenames, but no key or certificate files were supplied. These will be requested during connection.\n")
                         else:
                             # Key and cert tags found with same file names, but no files supplied.  Assume single file, user supplied
-                            addon.setSetting("user_def_keys", "Single")
+                            setSettingValue("user_def_keys", "Single")
                             summary.append("Found key and cert tags all with the same filename, but no key or certificate files were supplied. These will be requested during connection.\n")
                     if cert_count < len(ovpn_files) or key_count < len(ovpn_files):
                         summary.append("  WARNING : The key tag was found " + str(key_count) + " times, and the cert tag was found " + str(cert_count) + " times. Expected to find one of each in all " + str(len(ovpn_files)) + " .ovpn files. Some connections may not work.\n") 
                 else:
                     # Embedded key and certs found, so not asking user for them
-                    addon.setSetting("user_def_keys", "None")
+                    setSettingValue("user_def_keys", "None")
                     if (ekey_count > 0 or ecert_count > 0):
                         if ekey_count == ecert_count and key_count == len(ovpn_files):
                             summary.append("Using embedded user keys and certificates so keys and certs don't need to be entered.\n")
@@ -19,13 +19,11 @@
 #    Shared code fragments used by the VPN Manager for OpenVPN add-on.
 
 import xbmc
-import xbmcaddon
+from libs.settings import getSettingValue
 
 
 def ifDebug():
-    if xbmcaddon.Addon("service.vpn.manager").getSetting("vpn_enable_debug") == "true":
-        return True
-    return False
+    return getSettingValue("vpn_enable_debug")
 
     
 def debugTrace(data):    
@@ -24,33 +24,86 @@ import xbmcgui
 import xbmcvfs
 import xbmcaddon
 import glob
+import hashlib
 from libs.utility import debugTrace, errorTrace, infoTrace, newPrint
 from libs.platform import getAddonPath, getUserDataPath, fakeConnection, getSeparator, getPlatform, platforms, useSudo
+from libs.settings import getSettingValue, setSettingValue
+from libs.ovpn import loadOVPN
 
 
 # **** ADD MORE VPN PROVIDERS HERE ****
-# Display names for each of the providers (matching the guff in strings.po)
-provider_display = ["Private Internet Access", "IPVanish", "VyperVPN", "Invisible Browsing VPN", "NordVPN", "tigerVPN", "Hide My Ass", "PureVPN", "LiquidVPN", "AirVPN", "CyberGhost", "Perfect Privacy", "TorGuard", "User Defined", "LimeVPN", "HideIPVPN", "VPN Unlimited", "Hide.Me", "BTGuard", "ExpressVPN", "SaferVPN", "Celo", "VPN.ht", "TotalVPN", "WiTopia", "proXPN", "IVPN", "SecureVPN.to", "VPNSecure", "RA4W VPN", "Windscribe", "Smart DNS Proxy", "VPN.ac"]
+# Each provider has a directory in the root of the addon containing a PROVIDER.txt file which
+# describes it.  The display name must match the guff in strings.po.  For example:
+#   display=Private Internet Access
+#   auth=pass          (pass if it uses a username and password, none if it doesn't)
+#   keys=none          (none, single for one user key and cert, or multiple for one per connection)
+#   locations=Default Encryption,Strong Encryption   (the LOCATIONS files, Default for LOCATIONS.txt,
+#                                                     empty or missing for whichever are there)
+provider_manifest = "PROVIDER.txt"
 
-# **** ADD MORE VPN PROVIDERS HERE ****
-# Directory names for each of the providers (in the root of the addon)
-# Must be in the same order as the provider display name above
-providers = ["PIA", "IPVanish", "VyprVPN", "ibVPN", "NordVPN", "tigerVPN", "HMA", "PureVPN", "LiquidVPN", "AirVPN", "CyberGhost", "PerfectPrivacy", "TorGuard", "UserDefined", "LimeVPN", "HideIPVPN", "VPNUnlimited", "HideMe", "BTGuard", "ExpressVPN", "SaferVPN", "Celo", "VPN.ht", "TotalVPN", "WiTopia", "proXPN", "IVPN", "SecureVPN", "VPNSecure", "RA4WVPN", "Windscribe", "SmartDNSProxy", "VPN.ac"]
-
-# **** ADD VPN PROVIDERS HERE IF THEY USE A KEY ****
-# List of providers which use user keys and certs, either a single one, or one per connection
-# Names must match the directory names as used in providers, just above
-providers_with_multiple_keys = ["PerfectPrivacy", "Celo", "SecureVPN", "VPNUnlimited"]
-providers_with_single_keys = ["AirVPN", "CyberGhost", "HideIPVPN", "ExpressVPN", "WiTopia", "VPNSecure"]
-
-# *** ADD VPN PROVIDERS HERE IF THEY DON'T USE USERNAME AND PASSWORD ****
-# List of providers which don't use auth-user-pass.
-# Names must match the directory names as used in providers, just above
-providers_no_pass = ["AirVPN", "VPNUnlimited", "WiTopia", "VPNSecure"]
-
-# Leave this alone...it must match the text in providers
+# Leave this alone...the user defined provider doesn't have a directory until something's
+# been imported, and its auth and keys depend on the settings
 user_def_disp_str = "User Defined"
 user_def_str = "UserDefined"
+
+# The manifests are loaded the first time they're needed.  The registry is keyed on
+# the directory name, the display and directory names are both keys into the names
+provider_registry = None
+provider_names = None
+
+
+def loadProviderRegistry():
+    global provider_registry, provider_names
+    registry = {user_def_str : {"display" : user_def_disp_str, "auth" : "user", "keys" : "user", "locations" : []}}
+    for path in glob.glob(getAddonPath(True, "*/" + provider_manifest)):
+        vpn_provider = os.path.basename(os.path.dirname(path))
+        entry = {"display" : vpn_provider, "auth" : "pass", "keys" : "none", "locations" : None}
+        try:
+            manifest_file = open(path, 'r')
+            lines = manifest_file.readlines()
+            manifest_file.close()
+        except Exception as e:
+            errorTrace("vpnproviders.py", "Couldn't read " + path)
+            errorTrace("vpnproviders.py", str(e))
+            continue
+        for line in lines:
+            if not "=" in line: continue
+            name, value = line.split("=", 1)
+            entry[name.strip()] = value.strip(' \t\n\r')
+        if not entry["locations"] == None:
+            entry["locations"] = [location.strip() for location in entry["locations"].split(",") if not location.strip() == ""]
+        registry[vpn_provider] = entry
+    names = {}
+    for vpn_provider in registry:
+        names[registry[vpn_provider]["display"]] = vpn_provider
+        names[vpn_provider] = vpn_provider
+    # Swap both over at once
+    provider_names = names
+    provider_registry = registry
+
+
+def getProviderRegistry():
+    if provider_registry == None: loadProviderRegistry()
+    return provider_registry
+
+
+def getProviders():
+    # Return the directory names of all of the providers
+    return sorted(getProviderRegistry().keys())
+
+
+def getProviderDisplayList():
+    # Return the display names of all of the providers, sorted for showing to the user
+    registry = getProviderRegistry()
+    return sorted([registry[vpn_provider]["display"] for vpn_provider in registry])
+
+
+def getProviderValue(vpn_provider, name):
+    # Return a value from the manifest for a provider (aka directory name...), or None if it's not a provider
+    entry = getProviderRegistry().get(vpn_provider)
+    if entry == None: return None
+    return entry.get(name)
+
         
 def getAddonPathWrapper(path):
     # This function resets the VPN profiles to the standard VPN Manager install
@@ -80,21 +133,15 @@ def getUserDataPathWrapper(path):
                 
 def getVPNLocation(vpn_provider):
     # This function translates between the display name and the directory name
-    i=0
-    for provider in provider_display:
-        if vpn_provider == provider: return providers[i]
-        if vpn_provider == providers[i]: return providers[i]
-        i = i + 1
-    return ""
+    getProviderRegistry()
+    return provider_names.get(vpn_provider, "")
 
     
 def getVPNDisplay(vpn_provider):    
     # This function translates between the directory name and the display name
-    i=0
-    for provider in providers:
-        if vpn_provider == provider: return provider_display[i]
-        i = i + 1
-    return vpn_provider
+    entry = getProviderRegistry().get(vpn_provider)
+    if entry == None: return vpn_provider
+    return entry["display"]
     
 
 def getAddonList(vpn_provider, filter):
@@ -119,15 +166,15 @@ def usesUserKeys(vpn_provider):
     
 def usesSingleKey(vpn_provider):
     if isUserDefined(vpn_provider):
-        if xbmcaddon.Addon("service.vpn.manager").getSetting("user_def_keys") == "Single": return True
-    if vpn_provider in providers_with_single_keys: return True
+        if getSettingValue("user_def_keys") == "Single": return True
+    if getProviderValue(vpn_provider, "keys") == "single": return True
     return False
 
     
 def usesMultipleKeys(vpn_provider):
     if isUserDefined(vpn_provider):
-        if xbmcaddon.Addon("service.vpn.manager").getSetting("user_def_keys") == "Multiple": return True
-    if vpn_provider in providers_with_multiple_keys: return True
+        if getSettingValue("user_def_keys") == "Multiple": return True
+    if getProviderValue(vpn_provider, "keys") == "multiple": return True
     return False
     
 
@@ -181,9 +228,7 @@ def copyKeyAndCert(vpn_provider, ovpn_name, user_key, user_cert):
         # This means that a .ovpn was selected
         try:
             debugTrace("Extracing key and cert from " + key_source + " to " + key_dest + " and " + cert_dest)
-            ovpn_file = open(key_source, 'r')
-            ovpn = ovpn_file.readlines()
-            ovpn_file.close()
+            ovpn = loadOVPN(key_source)
             debugTrace("Checking directory path exists for key and cert " + os.path.dirname(key_dest))
             if not os.path.exists(os.path.dirname(key_dest)):
                 infoTrace("vpnprovider.py", "Creating " + os.path.dirname(key_dest))
@@ -198,27 +243,20 @@ def copyKeyAndCert(vpn_provider, ovpn_name, user_key, user_cert):
                         break
                     xbmc.sleep(1000)
                     t += 1
+            key = ovpn.getBlock("key")
+            if key == None: key = []
+            cert = ovpn.getBlock("cert")
+            if cert == None: cert = []
             key_file = open(key_dest, 'w')
-            cert_file = open(cert_dest, 'w')
-            key = False
-            cert = False
-            key_count = 0
-            cert_count = 0
-            for line in ovpn:
-                line = line.strip(' \t\n\r')
-                if line.startswith("<key>"): key = True
-                elif line.startswith("</key>"): key = False
-                elif line.startswith("<cert>"): cert = True
-                elif line.startswith("</cert>"): cert = False
-                else:
-                    if key: 
-                        key_file.write(line + "\n")
-                        key_count += 1
-                    if cert: 
-                        cert_file.write(line + "\n")
-                        cert_count += 1
+            for line in key:
+                key_file.write(line + "\n")
             key_file.close()
+            cert_file = open(cert_dest, 'w')
+            for line in cert:
+                cert_file.write(line + "\n")
             cert_file.close()
+            key_count = len(key)
+            cert_count = len(cert)
             if key_count > 0 and cert_count > 0:
                 return True
             else:
@@ -268,9 +306,9 @@ def getCertName(vpn_provider, ovpn_name):
 def usesPassAuth(vpn_provider):
     # Determine if we're using a user name and password or not
     if isUserDefined(vpn_provider):
-        if not (xbmcaddon.Addon("service.vpn.manager").getSetting("user_def_credentials") == "true"): 
+        if not getSettingValue("user_def_credentials"): 
             return False
-    elif vpn_provider in providers_no_pass: return False
+    elif getProviderValue(vpn_provider, "auth") == "none": return False
     return True
 
     
@@ -282,7 +320,7 @@ def getUpParam(provider):
     if xbmcvfs.exists(filename): return "up " + filename
     filename = getAddonPathWrapper(getVPNLocation(provider) + "/up." + ext)
     if xbmcvfs.exists(filename): return "up " + filename
-    if xbmcaddon.Addon("service.vpn.manager").getSetting("use_default_up_down") == "true":
+    if getSettingValue("use_default_up_down"):
         filename = getAddonPathWrapper("up." + ext)
         if xbmcvfs.exists(filename): return "up " + filename
     return ""
@@ -296,33 +334,30 @@ def getDownParam(provider):
     if xbmcvfs.exists(filename): return "down " + filename
     filename = getAddonPathWrapper(getVPNLocation(provider) + "/down." + ext)
     if xbmcvfs.exists(filename): return "down " + filename
-    if xbmcaddon.Addon("service.vpn.manager").getSetting("use_default_up_down") == "true":
+    if getSettingValue("use_default_up_down"):
         filename = getAddonPathWrapper("down." + ext)
         if xbmcvfs.exists(filename): return "down " + filename
     return ""
     
     
-def getRegexPattern():
-    # Return a regex expression to make a file name look good.
-    return r'(?s).*/(.*).ovpn'
-
-    
 def cleanPassFiles():
     # Delete the pass.txt file from all of the VPN provider directorys
-    for provider in providers:
+    for provider in getProviders():
         filename = getAddonPath(True, provider + "/pass.txt")
         if xbmcvfs.exists(filename) : xbmcvfs.delete(filename)   
 
 
 def cleanGeneratedFiles():
     # Delete the GENERATED.txt file from all of the VPN provider directorys    
-    for provider in providers:
+    for provider in getProviders():
         filename = getAddonPath(True, provider + "/GENERATED.txt")
         if xbmcvfs.exists(filename) : xbmcvfs.delete(filename)         
 
 
 def removeGeneratedFiles():
-    for provider in providers:
+    global generation_count
+    generation_count = generation_count + 1
+    for provider in getProviders():
         if ovpnGenerated(provider):
             if isUserDefined(provider):
                 # If this is the user defined provider, delete everything
@@ -355,13 +390,32 @@ def isUserDefined(vpn_provider):
     
     
 def getLocationFiles(vpn_provider):
-    # Return the locations files, add any user version to the end of the list
-    locations = glob.glob(getAddonPath(True, vpn_provider + "/LOCATIONS*.txt"))
+    # Return the locations files, add any user version to the end of the list.  If the manifest
+    # doesn't name any then whatever's there is used, the generators can write them later
+    variants = getProviderValue(vpn_provider, "locations")
+    if variants == None or len(variants) == 0:
+        locations = glob.glob(getAddonPath(True, vpn_provider + "/LOCATIONS*.txt"))
+    else:
+        locations = []
+        for variant in variants:
+            if variant == "Default": locations.append(getAddonPath(True, vpn_provider + "/LOCATIONS.txt"))
+            else: locations.append(getAddonPath(True, vpn_provider + "/LOCATIONS " + variant + ".txt"))
     user_locations = getUserDataPath(vpn_provider + "/LOCATIONS.txt")
     if xbmcvfs.exists(user_locations): locations.append(user_locations.replace(".txt", " User.txt"))
     return locations
     
 
+def getLocationsFileName(vpn_provider, alternative_locations_name):
+    # Return the locations file being used to generate the profiles
+    if not alternative_locations_name == "":
+        if alternative_locations_name == "User":
+            return getUserDataPath(vpn_provider + "/LOCATIONS.txt")
+        else:
+            return getAddonPath(True, vpn_provider + "/LOCATIONS " + alternative_locations_name + ".txt")
+    else:
+        return getAddonPath(True, vpn_provider + "/LOCATIONS.txt")
+        
+
 def fixOVPNFiles(vpn_provider, alternative_locations_name):
     debugTrace("Fixing OVPN files for " + vpn_provider + " using list " + alternative_locations_name)
     writeDefaultUpFile()
@@ -378,133 +432,360 @@ def fixOVPNFiles(vpn_provider, alternative_locations_name):
         return updateVPNFiles(vpn_provider)
     
     
-def generateOVPNFiles(vpn_provider, alternative_locations_name):
-    # Generate the OVPN files for a VPN provider using the template and update with location info
-    
-    infoTrace("vpnproviders.py", "Generating OVPN files for " + vpn_provider + " using list " + alternative_locations_name)
+# The tags that can be used in a template.  A value from a location can contain tags that
+# come later in this list (#USERCERT=#PATHuser.crt for example) which are filled in too
+template_tag_order = ["#PROTO", "#SERVPROT", "#SERVER", "#PORT", "#PASS", "#CERT", "#TLSKEY", "#CRLVERIFY", "#DH",
+                      "#USERKEY", "#USERCERT", "#PATH", "#USER1", "#USER2", "#PINGSPEED", "#PINGEXIT"]
+# Longest first so that where one tag starts with another (#SERVPROT and #SERVER) the longer one is found
+template_tags = sorted(template_tag_order, key=len, reverse=True)
 
-    # See if there's a port override going on
-    addon = xbmcaddon.Addon("service.vpn.manager")
-    if addon.getSetting("default_udp") == "true":
-        portUDP = ""
-    else:
-        portUDP = addon.getSetting("alternative_udp_port")
-        
-    if addon.getSetting("default_tcp") == "true":
-        portTCP = ""
+# Change this if the format of the manifest in GENERATED.txt changes
+manifest_version = "1"
+# Counts the times the profiles have been generated or removed, so anything holding on to
+# information about the profiles knows to throw it away
+generation_count = 0
+# The location to server translations, keyed on the provider.  Each is
+# [generation count, TRANSLATE.txt modified time, translations]
+translate_cache = {}
+
+# The types of template line that need dealing with differently
+TEMPLATE_LINE = 0
+TEMPLATE_REMOTE = 1
+TEMPLATE_VERB = 2
+TEMPLATE_EXIT_NOTIFY = 3
+
+
+def compileTemplateLine(line):
+    # Turn a line from a template into [line type, remove flag, segments].  The segments alternate
+    # between literal text and tags, starting and ending with (possibly empty) text
+    output_line = line.strip(' \t\n\r')
+    remove_flag = ""
+    # A line can be removed by a location, otherwise the tag is just deleted
+    if "#REMOVE" in output_line:
+        remove_flag = output_line[output_line.index("#REMOVE")+7]
+        output_line = output_line.replace("#REMOVE" + remove_flag, "")
+    if output_line.startswith("remote "):
+        line_type = TEMPLATE_REMOTE
+    elif output_line.startswith("verb "):
+        line_type = TEMPLATE_VERB
+    # This is a little hack to remove a tag that doesn't work with TCP but is needed for UDP
+    # Could do this with a #REMOVE, but doing it here is less error prone.
+    elif "explicit-exit-notify" in line:
+        line_type = TEMPLATE_EXIT_NOTIFY
     else:
-        portTCP = addon.getSetting("alternative_tcp_port")
+        line_type = TEMPLATE_LINE
+    segments = []
+    text = ""
+    i = 0
+    while i < len(output_line):
+        tag = None
+        if output_line[i] == "#":
+            for template_tag in template_tags:
+                if output_line.startswith(template_tag, i):
+                    tag = template_tag
+                    break
+        if tag == None:
+            text = text + output_line[i]
+            i = i + 1
+        else:
+            segments.append(text)
+            segments.append(tag)
+            text = ""
+            i = i + len(tag)
+    segments.append(text)
+    return [line_type, remove_flag, segments]
 
-    # Get the logging level
-    verb_value = addon.getSetting("openvpn_verb")
-    if verb_value == "":
-        verb_value = "1"
-        addon.setSetting("openvpn_verb", verb_value)
+    
+def compileTemplate(template):
+    compiled_template = []
+    for line in template:
+        compiled_template.append(compileTemplateLine(line))
+    return compiled_template
+
+
+def expandTemplateValues(values):
+    # Fill in any tags used in the values themselves
+    for i in range(0, len(template_tag_order)):
+        value = values[template_tag_order[i]]
+        if not "#" in value: continue
+        for tag in template_tag_order[i+1:]:
+            value = value.replace(tag, values[tag])
+        values[template_tag_order[i]] = value
+    return values
+
+
+def fillTemplateLine(segments, values):
+    # Put the values into the tag slots of a template line
+    if len(segments) == 1: return segments[0]
+    output = []
+    for i in range(0, len(segments)):
+        if i % 2 == 0: output.append(segments[i])
+        else: output.append(values[segments[i]])
+    return "".join(output)
+
+
+def renderTemplate(compiled_template, values, remove_flags, servers, ports, verb_value):
+    # Return the profile for a location from the compiled template and the values for each tag
+    output = []
+    for line_type, remove_flag, segments in compiled_template:
+        # Remove the line if it's a flag this location doesn't care about
+        if not remove_flag == "" and remove_flag in remove_flags: continue
+        if line_type == TEMPLATE_REMOTE:
+            # If there are multiple servers then we'll need to duplicate the server
+            # line and fix the server.  If the port's not been set from the settings
+            # or the location then each server has its own port
+            server_values = dict(values)
+            server_lines = []
+            for i in range(0, len(servers)):
+                server_values["#SERVER"] = servers[i]
+                if values["#PORT"] == "": server_values["#PORT"] = ports[i]
+                server_lines.append(fillTemplateLine(segments, server_values))
+            output_line = "\n".join(server_lines)
+        elif line_type == TEMPLATE_VERB:
+            # Overwrite the verb value with the one in the settings
+            output_line = "verb " + verb_value
+        elif line_type == TEMPLATE_EXIT_NOTIFY and values["#PROTO"] == "tcp":
+            output_line = ""
+        else:
+            output_line = fillTemplateLine(segments, values)
+        if not output_line == "": output.append(output_line + "\n")
+    return "".join(output)
+
+
+def getPath(paths, path_function, vpn_provider, name):
+    # Return the full path of a file for a provider, remembering it for next time
+    if not name in paths: paths[name] = path_function(vpn_provider + "/" + name)
+    return paths[name]
+    
+    
+class ProfileGenerator():
+
+    def __init__(self, vpn_provider):
+        self.vpn_provider = vpn_provider
+        self.compiled_template = None
+        # The paths used in the profiles are the same for most locations, so only work them out once
+        self.addon_paths = {}
+        self.user_paths = {}
+
+    def load(self):
+        # Load the template for the provider and the settings that affect it.  Returns False if it can't be used
+        vpn_provider = self.vpn_provider
         
-    # Load ovpn template
-    try:
-        debugTrace("Opening template file for " + vpn_provider)
-        template_file = open(getAddonPath(True, vpn_provider + "/TEMPLATE.txt"), 'r')
-        debugTrace("Opened template file for " + vpn_provider)
-        template = template_file.readlines()
-        template_file.close()
-    except Exception as e:
-        errorTrace("vpnproviders.py", "Couldn't open the template file for " + vpn_provider)
-        errorTrace("vpnproviders.py", str(e))
-        return False
+        # See if there's a port override going on
+        if getSettingValue("default_udp"):
+            self.portUDP = ""
+        else:
+            self.portUDP = getSettingValue("alternative_udp_port")
+            
+        if getSettingValue("default_tcp"):
+            self.portTCP = ""
+        else:
+            self.portTCP = getSettingValue("alternative_tcp_port")
 
-    # Open a translate file
-    try:
-        debugTrace("Opening translate file for " + vpn_provider)
-        translate_file = open(getAddonPath(True, vpn_provider + "/TRANSLATE.txt"), 'w')
-        debugTrace("Opened translate file for " + vpn_provider)
-    except Exception as e:
-        errorTrace("vpnproviders.py", "Couldn't open the translate file for " + vpn_provider)
-        errorTrace("vpnproviders.py", str(e))
-        return False
+        # Get the logging level
+        self.verb_value = getSettingValue("openvpn_verb")
+        if self.verb_value == "":
+            self.verb_value = "1"
+            setSettingValue("openvpn_verb", self.verb_value)
+            
+        # Load ovpn template
+        try:
+            debugTrace("Opening template file for " + vpn_provider)
+            template_file = open(getAddonPath(True, vpn_provider + "/TEMPLATE.txt"), 'r')
+            debugTrace("Opened template file for " + vpn_provider)
+            template = template_file.readlines()
+            template_file.close()
+        except Exception as e:
+            errorTrace("vpnproviders.py", "Couldn't open the template file for " + vpn_provider)
+            errorTrace("vpnproviders.py", str(e))
+            return False
+
+        if getPlatform() == platforms.WINDOWS and getSettingValue("block_outside_dns"):
+            template.append("block-outside-dns")
         
-    if getPlatform() == platforms.WINDOWS and addon.getSetting("block_outside_dns") == "true":
-        template.append("block-outside-dns")
-    
-    if addon.getSetting("force_ping") == "true":
-        template.append("ping #PINGSPEED")
-        template.append("ping-exit #PINGEXIT")
-        template.append("ping-timer-rem")
-    
-    if addon.getSetting("up_down_script") == "true":
-        template.append("script-security 2")
-        template.append(getUpParam(vpn_provider))
-        template.append(getDownParam(vpn_provider))
+        if getSettingValue("force_ping"):
+            template.append("ping #PINGSPEED")
+            template.append("ping-exit #PINGEXIT")
+            template.append("ping-timer-rem")
         
-    # Load locations file
-    if not alternative_locations_name == "":
-        if alternative_locations_name == "User":
-            locations_name = getUserDataPath(vpn_provider + "/LOCATIONS.txt")
+        if getSettingValue("up_down_script"):
+            template.append("script-security 2")
+            template.append(getUpParam(vpn_provider))
+            template.append(getDownParam(vpn_provider))
+
+        # Work out what each line of the template needs doing to it once, rather than for every location
+        self.template = template
+        try:
+            self.compiled_template = compileTemplate(template)
+        except Exception as e:
+            errorTrace("vpnproviders.py", "Template file for " + vpn_provider + " is invalid")
+            errorTrace("vpnproviders.py", str(e))
+            return False
+        return True
+
+    def getLocationValues(self, location):
+        # Parse a line from the locations file, returning [geo, proto, servers, ports, values, remove flags]
+        vpn_provider = self.vpn_provider
+        location_values = location.split(",")
+        geo = location_values[0]
+        servers = location_values[1].split()
+        proto = location_values[2]
+        ports = (location_values[3].strip(' \t\n\r')).split()
+        port = ""
+
+        # Initialise the set of values that can be modified by the location file tuples
+        ca_cert = "ca.crt"
+        ta_key = "ta.key"
+        crl_pem = "crl.pem"
+        dh_parm = "dh.pem"
+        user1 = ""
+        user2 = ""
+        user_key = getPath(self.user_paths, getUserDataPathWrapper, vpn_provider, getKeyName(vpn_provider, geo))
+        user_cert = getPath(self.user_paths, getUserDataPathWrapper, vpn_provider, getCertName(vpn_provider, geo))
+        remove_flags = ""
+        if proto == "udp":
+            ping_speed = "5"
+            ping_exit = "30"
         else:
-            locations_name = getAddonPath(True, vpn_provider + "/LOCATIONS " + alternative_locations_name + ".txt")
-    else:
-        locations_name = getAddonPath(True, vpn_provider + "/LOCATIONS.txt")
+            ping_speed = "10"
+            ping_exit = "60"
+        
+        if len(location_values) > 4: 
+            # The final location value is a list of multiple x=y declarations.
+            # These need to be parsed out and modified.
+            modifier_tuples = (location_values[4].strip(' \t\n\r')).split()
+            # Loop through all of the values splitting them into name value pairs
+            for modifier in modifier_tuples:
+                pair = modifier.split("=")
+                if "#CERT" in pair[0]: ca_cert = pair[1].strip()
+                if "#REMOVE" in pair[0]: remove_flags = pair[1].strip()
+                if "#TLSKEY" in pair[0]: ta_key = pair[1].strip()
+                if "#USERKEY" in pair[0]: user_key = pair[1].strip()
+                if "#USERCERT" in pair[0]: user_cert = pair[1].strip()
+                if "#CRLVERIFY" in pair[0]: crl_pem = pair[1].strip()
+                if "#DH" in pair[0]: dh_parm = pair[1].strip()
+                if "#USER1" in pair[0]: user1 = pair[1].strip()
+                if "#USER2" in pair[0]: user2 = pair[1].strip()
+                if "#PINGSPEED" in pair[0]: ping_speed = pair[1].strip()
+                if "#PINGEXIT" in pair[0]: ping_exit = pair[1].strip()
+        if proto == "udp" and not self.portUDP == "": port = self.portUDP
+        if proto == "tcp" and not self.portTCP == "": port = self.portTCP
+        if port == "" and len(ports) == 1: port = ports[0]
+
+        if proto == "tcp":
+            servprot = "tcp-client"
+        else:
+            servprot = proto
+        addon_paths = self.addon_paths
+        values = expandTemplateValues({"#PROTO" : proto,
+                                        "#SERVPROT" : servprot,
+                                        "#SERVER" : servers[0],
+                                        "#PORT" : port,
+                                        "#PASS" : getPath(addon_paths, getAddonPathWrapper, vpn_provider, "pass.txt"),
+                                        "#CERT" : getPath(addon_paths, getAddonPathWrapper, vpn_provider, ca_cert),
+                                        "#TLSKEY" : getPath(addon_paths, getAddonPathWrapper, vpn_provider, ta_key),
+                                        "#CRLVERIFY" : getPath(addon_paths, getAddonPathWrapper, vpn_provider, crl_pem),
+                                        "#DH" : getPath(addon_paths, getAddonPathWrapper, vpn_provider, dh_parm),
+                                        "#USERKEY" : user_key,
+                                        "#USERCERT" : user_cert,
+                                        "#PATH" : getPath(addon_paths, getAddonPathWrapper, vpn_provider, ""),
+                                        "#USER1" : user1,
+                                        "#USER2" : user2,
+                                        "#PINGSPEED" : ping_speed,
+                                        "#PINGEXIT" : ping_exit})
+        return [geo, proto, servers, ports, values, remove_flags]
+
+    def getHashes(self, locations):
+        # Return the hashes of everything that goes into the profiles, to record in the manifest
+        vpn_provider = self.vpn_provider
+        template = list(self.template)
+        template.append(getAddonPathWrapper(vpn_provider + "/"))
+        template.append(getUserDataPathWrapper(vpn_provider + "/"))
+        settings = [self.portUDP, self.portTCP, self.verb_value, str(usesSingleKey(vpn_provider)), str(usesMultipleKeys(vpn_provider))]
+        return {"template" : getHash("\n".join(template)),
+                "settings" : getHash("\n".join(settings)),
+                "locations_hash" : getHash("".join(locations))}
+
+    def getTranslation(self, geo, proto, servers):
+        # Return the line for the location to server translation file
+        if len(servers) > 1:
+            translate_server = servers[0] + " & " + str(len(servers) - 1) + " more"
+        else:
+            translate_server = servers[0]
+        return geo + "," + translate_server + " (" + proto.upper() + ")\n"
+
+    def render(self, servers, ports, values, remove_flags):
+        return renderTemplate(self.compiled_template, values, remove_flags, servers, ports, self.verb_value)
+
+    def write(self, geo, profile):
+        ovpn_file = open(getAddonPath(True, self.vpn_provider + "/" + geo + ".ovpn"), 'w')
+        ovpn_file.write(profile)
+        ovpn_file.close()
+        debugTrace("Wrote location " + geo)
 
+
+def loadLocations(vpn_provider, alternative_locations_name):
+    # Return the lines from the locations file, or None if it can't be read
+    locations_name = getLocationsFileName(vpn_provider, alternative_locations_name)
     try:
         debugTrace("Opening locations file for " + vpn_provider + "\n" + locations_name)
         locations_file = open(locations_name, 'r')
         debugTrace("Opened locations file for " + vpn_provider)
         locations = locations_file.readlines()
         locations_file.close()
+        return locations
     except Exception as e:
         errorTrace("vpnproviders.py", "Couldn't open the locations file for " + vpn_provider + "\n" + locations_name)
         errorTrace("vpnproviders.py", str(e))
-        translate_file.close()
+        return None
+
+    
+def generateOVPNFiles(vpn_provider, alternative_locations_name):
+    # Generate the OVPN files for a VPN provider using the template and update with location info.  If
+    # the profiles are only being created when they're used, just the translate file is written here.
+    # Profiles that were generated last time from exactly the same template, settings and location
+    # are left alone, using the manifest written at the end
+    
+    infoTrace("vpnproviders.py", "Generating OVPN files for " + vpn_provider + " using list " + alternative_locations_name)
+    lazy = getSettingValue("lazy_ovpn_files")
+
+    generator = ProfileGenerator(vpn_provider)
+    if not generator.load(): return False
+
+    # Load locations file
+    locations = loadLocations(vpn_provider, alternative_locations_name)
+    if locations == None: return False
+
+    # Only use what was generated before if it was generated the same way
+    hashes = generator.getHashes(locations)
+    manifest = getGeneratedInfo(vpn_provider)
+    if manifest.get("version") == manifest_version and manifest.get("template") == hashes["template"] and manifest.get("settings") == hashes["settings"] and manifest.get("lazy") == str(lazy).lower():
+        old_profiles = manifest["profiles"]
+    else:
+        old_profiles = {}
+
+    # Open a translate file
+    try:
+        debugTrace("Opening translate file for " + vpn_provider)
+        translate_file = open(getAddonPath(True, vpn_provider + "/TRANSLATE.txt"), 'w')
+        debugTrace("Opened translate file for " + vpn_provider)
+    except Exception as e:
+        errorTrace("vpnproviders.py", "Couldn't open the translate file for " + vpn_provider)
+        errorTrace("vpnproviders.py", str(e))
         return False
 
+    # If a location appears more than once the last one is used
+    last_location = {}
+    for i in range(0, len(locations)):
+        last_location[locations[i].split(",")[0]] = i
+        
     # For each location, generate an OVPN file using the template
-    for location in locations:
+    profiles = {}
+    skipped = 0
+    for i in range(0, len(locations)):
+        location = locations[i]
         try:
-            location_values = location.split(",")
-            geo = location_values[0]
-            servers = location_values[1].split()
-            proto = location_values[2]
-            ports = (location_values[3].strip(' \t\n\r')).split()
-            port = ""
-
-            # Initialise the set of values that can be modified by the location file tuples
-            ca_cert = "ca.crt"
-            ta_key = "ta.key"
-            crl_pem = "crl.pem"
-            dh_parm = "dh.pem"
-            user1 = ""
-            user2 = ""
-            user_key = getUserDataPathWrapper(vpn_provider + "/" + getKeyName(vpn_provider, geo))
-            user_cert = getUserDataPathWrapper(vpn_provider + "/" + getCertName(vpn_provider, geo))
-            remove_flags = ""
-            if proto == "udp":
-                ping_speed = "5"
-                ping_exit = "30"
-            else:
-                ping_speed = "10"
-                ping_exit = "60"
-            
-            if len(location_values) > 4: 
-                # The final location value is a list of multiple x=y declarations.
-                # These need to be parsed out and modified.
-                modifier_tuples = (location_values[4].strip(' \t\n\r')).split()
-                # Loop through all of the values splitting them into name value pairs
-                for modifier in modifier_tuples:
-                    pair = modifier.split("=")
-                    if "#CERT" in pair[0]: ca_cert = pair[1].strip()
-                    if "#REMOVE" in pair[0]: remove_flags = pair[1].strip()
-                    if "#TLSKEY" in pair[0]: ta_key = pair[1].strip()
-                    if "#USERKEY" in pair[0]: user_key = pair[1].strip()
-                    if "#USERCERT" in pair[0]: user_cert = pair[1].strip()
-                    if "#CRLVERIFY" in pair[0]: crl_pem = pair[1].strip()
-                    if "#DH" in pair[0]: dh_parm = pair[1].strip()
-                    if "#USER1" in pair[0]: user1 = pair[1].strip()
-                    if "#USER2" in pair[0]: user2 = pair[1].strip()
-                    if "#PINGSPEED" in pair[0]: ping_speed = pair[1].strip()
-                    if "#PINGEXIT" in pair[0]: ping_exit = pair[1].strip()
-            if proto == "udp" and not portUDP == "": port = portUDP
-            if proto == "tcp" and not portTCP == "": port = portTCP
-            if port == "" and len(ports) == 1: port = ports[0]
+            geo, proto, servers, ports, values, remove_flags = generator.getLocationValues(location)
         except Exception as e:
             errorTrace("vpnproviders.py", "Location file for " + vpn_provider + " invalid on line\n" + location)
             errorTrace("vpnproviders.py", str(e))
@@ -512,68 +793,22 @@ def generateOVPNFiles(vpn_provider, alternative_locations_name):
             return False
             
         try:
-            ovpn_file = open(getAddonPath(True, vpn_provider + "/" + geo + ".ovpn"), 'w')
-            translate_location = geo
-            if proto == "tcp":
-                servprot = "tcp-client"
+            translate_file.write(generator.getTranslation(geo, proto, servers))
+            if not last_location[geo] == i: continue
+            input_hash = getHash(hashes["template"] + hashes["settings"] + location)
+            ovpn_connection = getAddonPath(True, vpn_provider + "/" + geo + ".ovpn")
+            old_profile = old_profiles.get(geo)
+            if not old_profile == None and old_profile[0] == input_hash and (lazy or xbmcvfs.exists(ovpn_connection)):
+                profiles[geo] = old_profile
+                skipped = skipped + 1
+            elif lazy:
+                # Get rid of anything out of date, it'll be created again when it's needed
+                if xbmcvfs.exists(ovpn_connection): xbmcvfs.delete(ovpn_connection)
+                profiles[geo] = [input_hash, ""]
             else:
-                servprot = proto
-
-            # Do a replace on the tags in the template with data from the location file
-            for line in template:
-                output_line = line.strip(' \t\n\r')
-                # Must check to see if there's a remove tag on the line before looking for other tags
-                if "#REMOVE" in output_line:
-                    if output_line[output_line.index("#REMOVE")+7] in remove_flags:
-                        # Remove the line if it's a flag this location doesn't care about
-                        output_line = ""
-                    else:
-                        # Delete the tag if this location doesn't want this line removed
-                        output_line = output_line.replace("#REMOVE" + output_line[output_line.index("#REMOVE")+7], "")
-                output_line = output_line.replace("#PROTO", proto)
-                output_line = output_line.replace("#SERVPROT", servprot)
-                # If there are multiple servers then we'll need to duplicate the server
-                # line (which starts with 'remote ') and fix the server.  The rest of the
-                # code will deal with the port which is the same for all lines (although
-                # this assumption might not be true for all VPN providers...)
-                if output_line.startswith("remote "):
-                    server_template = output_line
-                    server_lines = ""
-                    i = 0
-                    for server in servers:
-                        if i == 0: translate_server = server
-                        if not server_lines == "" : server_lines = server_lines + "\n"
-                        server_lines = server_lines + server_template.replace("#SERVER", server)
-                        if port == "":
-                            server_lines = server_lines.replace("#PORT", ports[i])
-                        i = i + 1
-                    if i > 1: translate_server = translate_server + " & " + str(i - 1) + " more"
-                    output_line = server_lines
-                # There might be other places we use server and port, so still the do the replace
-                output_line = output_line.replace("#SERVER", servers[0])
-                output_line = output_line.replace("#PORT", port)
-                output_line = output_line.replace("#PASS", getAddonPathWrapper(vpn_provider + "/" + "pass.txt"))
-                output_line = output_line.replace("#CERT", getAddonPathWrapper(vpn_provider + "/" + ca_cert))
-                output_line = output_line.replace("#TLSKEY", getAddonPathWrapper(vpn_provider + "/" + ta_key))
-                output_line = output_line.replace("#CRLVERIFY", getAddonPathWrapper(vpn_provider + "/" + crl_pem))
-                output_line = output_line.replace("#DH", getAddonPathWrapper(vpn_provider + "/" + dh_parm))
-                output_line = output_line.replace("#USERKEY", user_key)
-                output_line = output_line.replace("#USERCERT", user_cert)
-                output_line = output_line.replace("#PATH", getAddonPathWrapper(vpn_provider + "/"))
-                output_line = output_line.replace("#USER1", user1)
-                output_line = output_line.replace("#USER2", user2)
-                output_line = output_line.replace("#PINGSPEED", ping_speed)
-                output_line = output_line.replace("#PINGEXIT", ping_exit)
-                # Overwrite the verb value with the one in the settings
-                if output_line.startswith("verb "):
-                    output_line = "verb " + verb_value
-                # This is a little hack to remove a tag that doesn't work with TCP but is needed for UDP
-                # Could do this with a #REMOVE, but doing it here is less error prone.
-                if "explicit-exit-notify" in line and proto == "tcp": output_line = ""
-                if not output_line == "" : ovpn_file.write(output_line + "\n")
-            ovpn_file.close()
-            debugTrace("Wrote location " + geo + " " + proto)
-            translate_file.write(translate_location + "," + translate_server + " (" + proto.upper() + ")\n")
+                profile = generator.render(servers, ports, values, remove_flags)
+                generator.write(geo, profile)
+                profiles[geo] = [input_hash, getHash(profile)]
         except Exception as e:
             errorTrace("vpnproviders.py", "Can't write a location file for " + vpn_provider + " failed on line\n" + location)
             errorTrace("vpnproviders.py", str(e))
@@ -582,13 +817,77 @@ def generateOVPNFiles(vpn_provider, alternative_locations_name):
     
     # Write the location to server translation file
     translate_file.close()
+
+    # Delete the profiles for any locations that have gone
+    for geo in manifest["profiles"]:
+        if not geo in profiles:
+            ovpn_connection = getAddonPath(True, vpn_provider + "/" + geo + ".ovpn")
+            if xbmcvfs.exists(ovpn_connection): xbmcvfs.delete(ovpn_connection)
+    infoTrace("vpnproviders.py", "Updated " + str(len(profiles) - skipped) + " of " + str(len(profiles)) + " OVPN files, the rest were up to date")
     
-    # Flag that the files have been generated
-    writeGeneratedFile(vpn_provider)
+    # Record how the files have been generated
+    hashes["lazy"] = str(lazy).lower()
+    hashes["locations"] = alternative_locations_name
+    writeGeneratedFile(vpn_provider, hashes, profiles)
 
     return True
-    
-    
+
+
+def ovpnFilesCurrent(vpn_provider, alternative_locations_name):
+    # Check the generated profiles were made from the current template, locations and settings
+    # without having to look at any of the profiles.  Only generated profiles can be out of date
+    if isUserDefined(vpn_provider) or not xbmcvfs.exists(getAddonPath(True, vpn_provider + "/TEMPLATE.txt")): return True
+    manifest = getGeneratedInfo(vpn_provider)
+    if not manifest.get("version") == manifest_version: return False
+    if not manifest.get("locations") == alternative_locations_name: return False
+    if not manifest.get("lazy") == str(getSettingValue("lazy_ovpn_files")).lower(): return False
+    generator = ProfileGenerator(vpn_provider)
+    if not generator.load(): return False
+    locations = loadLocations(vpn_provider, alternative_locations_name)
+    if locations == None: return False
+    hashes = generator.getHashes(locations)
+    for name in hashes:
+        if not manifest.get(name) == hashes[name]: return False
+    return True
+
+
+def generateOVPNFile(ovpn_connection):
+    # Make sure a profile exists, creating it if the profiles for the provider are only
+    # created when they're used.  Return False if the profile isn't available
+    vpn_provider = os.path.basename(os.path.dirname(ovpn_connection))
+    generated = getGeneratedInfo(vpn_provider)
+    geo = os.path.basename(ovpn_connection)[:-len(".ovpn")]
+    if xbmcvfs.exists(ovpn_connection):
+        # A profile that's been changed since it was generated is used as it is, as it might have been
+        # edited on purpose, but it's worth knowing about if it doesn't work.  Profiles that weren't
+        # generated, or were created when used, don't have a hash to check
+        profile = generated["profiles"].get(geo)
+        if not profile == None and not profile[1] == "" and not profile[1] == getFileHash(ovpn_connection):
+            errorTrace("vpnproviders.py", "OVPN file for " + geo + " from " + vpn_provider + " has changed since it was generated, using it anyway")
+        return True
+    if not generated.get("lazy") == "true": return False
+    infoTrace("vpnproviders.py", "Generating OVPN file for " + geo + " from " + vpn_provider)
+    generator = ProfileGenerator(vpn_provider)
+    if not generator.load(): return False
+    locations = loadLocations(vpn_provider, generated.get("locations", ""))
+    if locations == None: return False
+    # If a location appears more than once the last one is used, as it would overwrite the others
+    found = None
+    for location in locations:
+        if location.split(",")[0] == geo: found = location
+    if found == None:
+        errorTrace("vpnproviders.py", "Couldn't find " + geo + " in the locations file for " + vpn_provider)
+        return False
+    try:
+        geo, proto, servers, ports, values, remove_flags = generator.getLocationValues(found)
+        generator.write(geo, generator.render(servers, ports, values, remove_flags))
+        return True
+    except Exception as e:
+        errorTrace("vpnproviders.py", "Can't write a location file for " + vpn_provider + " failed on line\n" + found)
+        errorTrace("vpnproviders.py", str(e))
+        return False
+
+
 def updateVPNFiles(vpn_provider):
     # If the OVPN files aren't generated then they need to be updated with location info    
     
@@ -597,22 +896,21 @@ def updateVPNFiles(vpn_provider):
     ovpn_connections = getAddonList(vpn_provider, "*.ovpn")
 
     # See if there's a port override going on
-    addon = xbmcaddon.Addon("service.vpn.manager")
-    if addon.getSetting("default_udp") == "true":
+    if getSettingValue("default_udp"):
         portUDP = ""
     else:
-        portUDP = addon.getSetting("alternative_udp_port")
+        portUDP = getSettingValue("alternative_udp_port")
         
-    if addon.getSetting("default_tcp") == "true":
+    if getSettingValue("default_tcp"):
         portTCP = ""
     else:
-        portTCP = addon.getSetting("alternative_tcp_port")
+        portTCP = getSettingValue("alternative_tcp_port")
 
     # Get the logging level
-    verb_value = addon.getSetting("openvpn_verb")
+    verb_value = getSettingValue("openvpn_verb")
     if verb_value == "":
         verb_value = "1"
-        addon.setSetting("openvpn_verb", verb_value)
+        setSettingValue("openvpn_verb", verb_value)
 
     # Open a translate file
     try:
@@ -626,53 +924,38 @@ def updateVPNFiles(vpn_provider):
         
     for connection in ovpn_connections:
         try:
-            f = open(connection, 'r+')
             debugTrace("Processing file " + connection)
-            lines = f.readlines()
-            f.seek(0)
-            f.truncate()
+            ovpn = loadOVPN(connection)
             # Get the profile friendly name in case we need to generate key/cert names
             name = connection[connection.rfind(getSeparator())+1:connection.rfind(".ovpn")]
             translate_location = name
-            translate_server = ""
-            server_count = 0
             
-            found_up = False
-            found_down = False
-            found_script_sec = False
-            found_block_dns = False
-            found_ping = False
+            # The protocol is needed for the port and ping settings.  The port is
+            # only changed if the protocol is set by a proto line
             proto = "udp"
+            proto_found = False
+            for i in ovpn.getIndexes("proto"):
+                if "tcp" in ovpn.getLine(i): proto = "tcp"
+                elif not "udp" in ovpn.getLine(i): continue
+                proto_found = True
+                break
             
             # Update the necessary values in the ovpn file
-            for line in lines:
-                
-                line = line.strip(' \t\n\r')
+            for i, line in ovpn.getLines():
                 
                 # Update path to pass.txt
-                if not isUserDefined(vpn_provider) or addon.getSetting("user_def_credentials") == "true":
+                if not isUserDefined(vpn_provider) or getSettingValue("user_def_credentials"):
                     if line.startswith("auth-user-pass"):
                         line = "auth-user-pass " + getAddonPathWrapper(vpn_provider + "/" + "pass.txt")        
                         
                 # Update port numbers
                 if line.startswith("remote "):
-                    server_count += 1
                     tokens = line.split()
                     port = ""
-                    for newline in lines:
-                        if newline.startswith("proto "):
-                            if "tcp" in newline:
-                                proto = "tcp"
-                                if not portTCP == "": port = portTCP
-                                break
-                            if "udp" in newline:
-                                proto = "udp"
-                                if not portUDP == "": port = portUDP
-                                break
+                    if proto_found and proto == "tcp": port = portTCP
+                    if proto_found and proto == "udp": port = portUDP
                     if not port == "":
-                        line = "remote " + tokens[1] + " " + port + "\n"
-                    if translate_server == "": translate_server = tokens[1]
-
+                        line = "remote " + tokens[1] + " " + port
                         
                 # Update user cert and key                
                 if usesUserKeys(vpn_provider):
@@ -688,41 +971,33 @@ def updateVPNFiles(vpn_provider):
                 # Set the logging level
                 if line.startswith("verb "):
                     line = "verb " + verb_value
-    
-                if line.startswith("up "):
-                    found_up = True
-                if line.startswith("down "):
-                    found_down = True
-                if line.startswith("script-security "):
-                    found_script_sec = True
-                if line.startswith("block-outside-dns"):
-                    found_block_dns = True
-            
-                if line.startswith("ping"):
-                    found_ping = True
-                
-                f.write(line + "\n")
+
+                ovpn.setLine(i, line)
             
-            if not found_block_dns and getPlatform() == platforms.WINDOWS and addon.getSetting("block_outside_dns") == "true":
-                f.write("block-outside-dns\n")
+            if not ovpn.hasDirective("block-outside-dns") and getPlatform() == platforms.WINDOWS and getSettingValue("block_outside_dns"):
+                ovpn.append("block-outside-dns")
                 
-            if addon.getSetting("up_down_script") == "true":
-                if not found_script_sec: f.write("script-security 2\n")
-                if not found_up: f.write(getUpParam(vpn_provider)+"\n")
-                if not found_down: f.write(getDownParam(vpn_provider)+"\n")
+            if getSettingValue("up_down_script"):
+                if not ovpn.hasDirective("script-security"): ovpn.append("script-security 2")
+                if not ovpn.hasDirective("up"): ovpn.append(getUpParam(vpn_provider))
+                if not ovpn.hasDirective("down"): ovpn.append(getDownParam(vpn_provider))
             
-            if not found_ping and addon.getSetting("force_ping") == "true":
+            if not ovpn.hasDirectiveStarting("ping") and getSettingValue("force_ping"):
                 if proto == "tcp":
-                    f.write("ping 10\n")
-                    f.write("ping-exit 60\n")
+                    ovpn.append("ping 10")
+                    ovpn.append("ping-exit 60")
                 else:
-                    f.write("ping 5\n")
-                    f.write("ping-exit 30\n")
-                f.write("ping-timer-rem\n")
+                    ovpn.append("ping 5")
+                    ovpn.append("ping-exit 30")
+                ovpn.append("ping-timer-rem")
+            
+            # Only write the file out if something's changed
+            ovpn.save(connection)
             
-            f.close()
-                                
-            if server_count > 1: translate_server = translate_server + " & " + str(server_count - 1) + " more"
+            servers = ovpn.getIndexes("remote")
+            if len(servers) > 0: translate_server = ovpn.getLine(servers[0]).split()[1]
+            else: translate_server = ""
+            if len(servers) > 1: translate_server = translate_server + " & " + str(len(servers) - 1) + " more"
             translate_file.write(translate_location + "," + translate_server + " (" + proto.upper() + ")\n")
             
         except Exception as e:
@@ -762,11 +1037,88 @@ def copyUserDefinedFiles():
         return False
 
 
-def writeGeneratedFile(vpn_provider):
-    # Write a file to indicate successful generation of the ovpn files
+def writeGeneratedFile(vpn_provider, values = None, profiles = None):
+    # Write the manifest that shows the ovpn files have been generated.  It records how they were
+    # generated and, for each profile, the hash of what went into it and of the profile itself
+    global generation_count
+    generation_count = generation_count + 1
+    if values == None: values = {}
+    if profiles == None: profiles = {}
     ovpn_file = open(getAddonPath(True, vpn_provider + "/GENERATED.txt"), 'w')
+    ovpn_file.write("version=" + manifest_version + "\n")
+    for name in sorted(values):
+        ovpn_file.write(name + "=" + values[name] + "\n")
+    for geo in sorted(profiles):
+        ovpn_file.write("profile=" + profiles[geo][0] + "," + profiles[geo][1] + "," + geo + "\n")
     ovpn_file.close()
     
+
+def getGeneratedInfo(vpn_provider):
+    # Return the values in the manifest written when the ovpn files were generated, with the
+    # profiles held as a dictionary of [input hash, profile hash] keyed on the location
+    info = {"profiles" : {}}
+    try:
+        generated_file = open(getAddonPath(True, vpn_provider + "/GENERATED.txt"), 'r')
+        lines = generated_file.readlines()
+        generated_file.close()
+    except Exception as e:
+        return info
+    for line in lines:
+        if not "=" in line: continue
+        name, value = line.split("=", 1)
+        value = value.strip(' \t\n\r')
+        if name == "profile":
+            input_hash, profile_hash, geo = value.split(",", 2)
+            info["profiles"][geo] = [input_hash, profile_hash]
+        else:
+            info[name.strip()] = value
+    return info
+
+
+def getTranslations(vpn_provider):
+    # Return the server names for each location, keyed on the location name, or None if there's no
+    # translate file.  The file is only read again if it's changed since it was last read
+    path = getAddonPath(True, vpn_provider + "/TRANSLATE.txt")
+    try:
+        modified = os.path.getmtime(path)
+    except:
+        return None
+    cached = translate_cache.get(vpn_provider)
+    if not cached == None and cached[0] == generation_count and cached[1] == modified: return cached[2]
+    try:
+        translate_file = open(path, 'r')
+        translate = translate_file.readlines()
+        translate_file.close()
+    except Exception as e:
+        errorTrace("vpnproviders.py", "Couldn't open the translate file for " + vpn_provider)
+        errorTrace("vpnproviders.py", str(e))
+        return None
+    translations = {}
+    for entry in translate:
+        try:
+            server, dns = entry.split(",")
+            # The first entry for a location is the one that's used
+            if not server in translations: translations[server] = dns
+        except:
+            pass
+    translate_cache[vpn_provider] = [generation_count, modified, translations]
+    return translations
+
+
+def getHash(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def getFileHash(path):
+    # Return the hash of a file, or "" if it can't be read
+    try:
+        hash_file = open(path, 'r')
+        data = hash_file.read()
+        hash_file.close()
+        return getHash(data)
+    except:
+        return ""
+    
     
 def writeDefaultUpFile():
     p = getPlatform()
@@ -29,7 +29,7 @@ import xbmcgui
 import xbmcvfs
 import datetime
 import os
-from libs.vpnproviders import removeGeneratedFiles, cleanPassFiles, providers, usesUserKeys, usesMultipleKeys, getUserKeys
+from libs.vpnproviders import removeGeneratedFiles, cleanPassFiles, getProviders, usesUserKeys, usesMultipleKeys, getUserKeys
 from libs.vpnproviders import getUserCerts, getVPNDisplay, getVPNLocation
 from libs.utility import debugTrace, errorTrace, infoTrace
 from libs.platform import getLogPath, getUserDataPath, writeVPNLog, copySystemdFiles, addSystemd, removeSystemd
@@ -101,7 +101,7 @@ elif action == "user":
     
         # Select the provider
         provider_list = []
-        for provider in providers:
+        for provider in getProviders():
             if usesUserKeys(provider):
                 provider_list.append(getVPNDisplay(provider))
         provider_list.sort()
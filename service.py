@@ -24,6 +24,8 @@ import xbmcaddon
 import xbmcvfs
 import os
 import time
+import threading
+import Queue
 import urllib2
 import re
 import string
@@ -33,19 +35,26 @@ from libs.common import setVPNState, getVPNState, stopRequested, ackStop, startR
 from libs.common import getVPNLastConnectedProfile, setVPNLastConnectedProfile, getVPNLastConnectedProfileFriendly, setVPNLastConnectedProfileFriendly
 from libs.common import getVPNCycle, clearVPNCycle, writeCredentials, getCredentialsPath, getFriendlyProfileName, isVPNMonitorRunning, setVPNMonitorState
 from libs.common import getConnectionErrorCount, setConnectionErrorCount, getAddonPath, isVPNConnected, resetVPNConfig, forceCycleLock, freeCycleLock
-from libs.common import getAPICommand, clearAPICommand, fixKeymaps
-from libs.platform import getPlatform, connection_status, getAddonPath, writeVPNLog, supportSystemd, addSystemd, removeSystemd, copySystemdFiles
-from libs.platform import isVPNTaskRunning
+from libs.common import getAPICommand, clearAPICommand, fixKeymaps, startStateBatch, endStateBatch, switchVPNConnection
+from libs.common import getBestServers, clearBestServers, recordServerResult
+from libs.platform import getPlatform, connection_status, getAddonPath, writeVPNLog, getStandbyInstance, supportSystemd, addSystemd, removeSystemd, copySystemdFiles
+from libs.platform import isVPNTaskRunning, canSwitchVPN
 from libs.utility import debugTrace, errorTrace, infoTrace, ifDebug, newPrint
-from libs.vpnproviders import removeGeneratedFiles, cleanPassFiles, fixOVPNFiles, getVPNLocation, usesPassAuth, clearKeysAndCerts
+from libs.settings import getSettingValue, setSettingValue, refreshSettings
+from libs.vpnproviders import removeGeneratedFiles, cleanPassFiles, fixOVPNFiles, getVPNLocation, usesPassAuth, clearKeysAndCerts, generateOVPNFile
+from libs.vpnproviders import ovpnFilesCurrent
+from libs.ipinfo import saveIPServices
+from libs.httpclient import closeConnections
+from libs.state import getState
 
 debugTrace("-- Entered service.py --")
 
 # Window property constants
 last_addon = 'VPN_Manager_Last_Addon'
 
-# Filtered addons
-filtered_addons = []
+# Filtered addons, indexed by addon id.  Each entry is a tuple of the filter slots the addon
+# appears in, in slot order.  Slot 0 is the disconnect (excluded) list, 1 to 10 are the VPNs
+addon_filter_index = {}
 
 # Lists of primary VPNs and their friendly names (so we don't have to keep pattern matching it)
 primary_vpns = []
@@ -58,16 +67,139 @@ addon_name = addon.getAddonInfo('name')
 accepting_changes = False
 
 
+# Deadline based scheduler used by the main loop so that it only wakes up when there's something
+# to do rather than polling everything every couple of seconds.  Time is advanced by how long we
+# actually waited so a change to the system clock doesn't stop the checks from happening.
+class ServiceScheduler():
+
+    def __init__(self):
+        self.deadlines = {}
+        self.clock = 0
+        self.last_time = time.time()
+        self.woken = False
+        # The shortest wait, so the loop doesn't spin if a task is overdue but can't run yet
+        self.min_wait = 0.5
+        # waitForAbort only returns early if Kodi is shutting down, so the wait is done in slices
+        # this long to see if one of the callbacks has woken the scheduler in the meantime
+        self.wake_check = 1
+        
+    def schedule(self, task, seconds):
+        # Run the task after the given number of seconds, replacing any existing deadline
+        self.deadlines[task] = self.clock + seconds
+        
+    def cancel(self, task):
+        if task in self.deadlines: del self.deadlines[task]
+        
+    def isScheduled(self, task):
+        return task in self.deadlines
+        
+    def isDue(self, task):
+        return task in self.deadlines and self.deadlines[task] <= self.clock
+    
+    def wake(self):
+        # Called from the Kodi callbacks to cut short any wait that's in progress
+        self.woken = True
+        
+    def tick(self, waited):
+        # Move the clock on by however long it's been since the last time we looked
+        now = time.time()
+        elapsed = now - self.last_time
+        if elapsed < 0 or elapsed > waited + 3600: elapsed = waited
+        self.clock = self.clock + elapsed
+        self.last_time = now
+        
+    def wait(self, monitor, max_wait, use_deadlines):
+        # Sleep until the next deadline, max_wait seconds or until something wakes us up.
+        # Return True if Kodi wants the service to shut down.
+        self.tick(0)
+        wait = max_wait
+        if use_deadlines:
+            for task in self.deadlines:
+                if self.deadlines[task] - self.clock < wait: wait = self.deadlines[task] - self.clock
+        if wait < self.min_wait: wait = self.min_wait
+        # If something's already asked for the service to wake up, don't wait at all
+        waited = 0
+        while waited < wait and not self.woken:
+            step = min(self.wake_check, wait - waited)
+            if monitor.waitForAbort(step): return True
+            waited = waited + step
+        self.woken = False
+        self.tick(waited)
+        return False
+
+        
+scheduler = ServiceScheduler()
+
+
+# Finds out where the connection appears to be on a worker thread so the main loop can carry on,
+# then shows a notification with the details.  Each lookup is tagged with the tunnel generation
+# at the time it was asked for and is thrown away if the VPN connection has changed since
+class LocationNotifier():
+
+    def __init__(self):
+        self.requests = Queue.Queue()
+        self.thread = None
+        self.stopping = False
+
+    def notify(self, message, icon, profile = ""):
+        # The message can have #PROFILE, #ISP, #COUNTRY and #IP in it, which are filled in with
+        # the profile name and what the lookup finds
+        if self.thread == None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.worker)
+            self.thread.daemon = True
+            self.thread.start()
+        self.requests.put([getState("tunnel_generation"), message, icon, profile])
+
+    def worker(self):
+        while True:
+            request = self.requests.get()
+            # Only the latest request matters, anything older is out of date
+            while not request == None:
+                try:
+                    request = self.requests.get_nowait()
+                except Queue.Empty:
+                    break
+            # Told to stop
+            if request == None: return
+            generation, message, icon, profile = request
+            if not generation == getState("tunnel_generation"): continue
+            try:
+                _, ip, country, isp = getIPInfo(xbmcaddon.Addon("service.vpn.manager"))
+            except Exception as e:
+                errorTrace("service.py", "Couldn't look up the location of the connection")
+                errorTrace("service.py", str(e))
+                continue
+            if not generation == getState("tunnel_generation") or self.stopping:
+                debugTrace("Connection changed whilst looking up its location, ignoring it")
+                continue
+            # All of the tags are replaced in one go so a tag in the profile name or the details is left alone
+            values = {"#PROFILE" : profile, "#ISP" : isp, "#COUNTRY" : country, "#IP" : ip}
+            message = re.sub("#PROFILE|#ISP|#COUNTRY|#IP", lambda match: values[match.group(0)], message)
+            xbmcgui.Dialog().notification(addon_name, message, icon, 20000, False)
+
+    def stop(self):
+        self.stopping = True
+        if not self.thread == None:
+            self.requests.put(None)
+            self.thread.join(5)
+
+
+location_notifier = LocationNotifier()
+
+
 def refreshAddonFilterLists():
-    # Fetch the list of excluded or filtered addons
-    del filtered_addons[:]
+    # Fetch the list of excluded or filtered addons and build the index used to look them up
+    addon_filter_index.clear()
     # # Adjust 11 below if changing number of conn_max
     for i in range (0, 11):
         filtered_string = ""
         if i == 0 : filtered_string = addon.getSetting("vpn_excluded_addons")
         else : filtered_string = addon.getSetting(str(i)+"_vpn_addons")
-        if not filtered_string == "" : filtered_addons.append(filtered_string.split(","))
-        else : filtered_addons.append(None)   
+        if not filtered_string == "":
+            for filtered_addon in filtered_string.split(","):
+                if filtered_addon == "": continue
+                slots = addon_filter_index.get(filtered_addon, ())
+                if not i in slots: addon_filter_index[filtered_addon] = slots + (i,)
     return
 
         
@@ -80,20 +212,61 @@ def isAddonFiltered(path, current):
     # Filter out local sources (files) being passed in and return not found
     if not ("://" in path): return -1
     # Strip out the leading 'plugin://' or 'addons://' string, and anything trailing the plugin name
-    found = -1
     filtered_addon_path = path[path.index("://")+3:]
     if "/" in filtered_addon_path:
         filtered_addon_path = filtered_addon_path[:filtered_addon_path.index("/")]
     if filtered_addon_path == "": return -1
-    # # Adjust 11 below if changing number of conn_max
-    for i in range (0, 11):
-        if not filtered_addons[i] == None:
-            for filtered_string in filtered_addons[i]: 
-                if filtered_addon_path == filtered_string:
-                    if found == -1 : found = i
-                    if i > 0 and i == current : found = i
-    return found
+    slots = addon_filter_index.get(filtered_addon_path)
+    if slots == None: return -1
+    # The slots are in order so the first is either the disconnect slot or the lowest VPN
+    if current > 0 and current in slots: return current
+    return slots[0]
         
+
+def switchPrimaryVPN():
+    # When moving between primary VPNs, connect to the new one before disconnecting from the
+    # old one if that's been asked for.  Return True if the switch has happened
+    if not getSettingValue("vpn_make_before_break") or not canSwitchVPN(): return False
+    requested = getVPNRequestedProfile()
+    if requested == "" or not requested in primary_vpns or not getVPNProfile() in primary_vpns: return False
+    if not getVPNState() == "started" or not isVPNConnected(): return False
+    infoTrace("service.py", "Switching to VPN profile " + requested + " before disconnecting from " + getVPNProfile())
+    xbmcgui.Dialog().notification(addon_name, "Switching to "+ getVPNRequestedProfileFriendly(), getAddonPath(True, "/resources/locked.png"), 5000, False)
+    server = requested
+    if getSettingValue("vpn_best_server"):
+        server = getBestServers(requested, addon.getSetting("vpn_provider_validated"))[0]
+        if not server == requested: infoTrace("service.py", "Using server " + server + " for VPN profile " + requested)
+    state = switchVPNConnection(server)
+    recordServerResult(server, state == connection_status.CONNECTED)
+    if not state == connection_status.CONNECTED:
+        # The original connection will still be there, so fall back to disconnecting and then connecting
+        writeVPNLog(getStandbyInstance())
+        return False
+    if ifDebug(): writeVPNLog()
+    xbmcgui.Dialog().notification(addon_name, "Connected to "+ getVPNProfileFriendly(), getAddonPath(True, "/resources/connected.png"), 5000, False)
+    if getSettingValue("display_location_on_connect"):
+        location_notifier.notify("Connected to #PROFILE via Service Provider #ISP in #COUNTRY. IP is #IP.", getAddonPath(True, "/resources/connected.png"), getVPNProfileFriendly())
+    return True
+    
+
+def connectBestServer(vpn_profile):
+    # Connect to a VPN profile.  For a primary VPN where the best server is wanted, similar
+    # servers are tried best first, moving down the list if they fail to connect
+    if not getSettingValue("vpn_best_server") or not vpn_profile in primary_vpns:
+        return startVPNConnection(vpn_profile)
+    servers = getBestServers(vpn_profile, addon.getSetting("vpn_provider_validated"))
+    for server in servers:
+        if not server == vpn_profile: infoTrace("service.py", "Using server " + server + " for VPN profile " + vpn_profile)
+        state = startVPNConnection(server)
+        recordServerResult(server, state == connection_status.CONNECTED)
+        # Bad credentials will fail on every server so don't bother trying any more
+        if state == connection_status.CONNECTED or state == connection_status.AUTH_FAILED: break
+        if not server == servers[-1]:
+            errorTrace("service.py", "VPN connect to " + server + " has failed, VPN error was " + str(state) + ", trying the next server")
+            writeVPNLog()
+            stopVPNConnection()
+    return state
+    
    
 def refreshPrimaryVPNs():
     # Fetch the list of excluded or filtered addons
@@ -105,6 +278,7 @@ def refreshPrimaryVPNs():
     for i in range (1, 11):
         primary_vpns.append(addon.getSetting(str(i)+"_vpn_validated"))
         primary_vpns_friendly.append(addon.getSetting(str(i)+"_vpn_validated_friendly"))
+    clearBestServers()
     return
 
     
@@ -126,7 +300,7 @@ def checkConnections():
     # Adjust 11 below if changing number of conn_max
     for i in range (1, 11):        
         next_conn = (addon.getSetting(str(i)+"_vpn_validated"))
-        if not next_conn == "" and not xbmcvfs.exists(next_conn):
+        if not next_conn == "" and not generateOVPNFile(next_conn):
             return False
     return True
     
@@ -151,31 +325,41 @@ class KodiMonitor(xbmc.Monitor):
     # work refreshing things, but there are a few calls that will happen anyway (and better to do this)
     # than to miss out on an update that a user makes via the GUI.
     def onSettingsChanged( self ):
+        # The cached settings are always thrown away, they're read by more than the service
+        refreshSettings()
         if accepting_changes:
             debugTrace("Requested update to service process via settings monitor")
             updateService("KodiMonitor")
+            scheduler.wake()
+
+    # The rest of the add-on uses NotifyAll to tell the service it's got something to do
+    def onNotification( self, sender, method, data ):
+        if sender == "service.vpn.manager":
+            scheduler.wake()
 
 
 # Player class which will be called when the playback state changes           
-#class KodiPlayer(xbmc.Player):
-#    def __init__ (self):
-#        xbmc.Player.__init__(self)
-#        self.logger = None
-#
-#    def onPlayBackStarted(self, *arg):
-#        newPrint("Playback started " + self.getPlayingFile())
+class KodiPlayer(xbmc.Player):
+    def __init__ (self):
+        xbmc.Player.__init__(self)
+
+    # Wake the service up so that it can validate the connection once playback is done
+    def onPlayBackStopped(self):
+        scheduler.wake()
+        
+    def onPlayBackEnded(self):
+        scheduler.wake()
 
         
 if __name__ == '__main__':   
 
     # Initialise some variables we'll be using repeatedly
     monitor = xbmc.Monitor()
-    player = xbmc.Player() 
+    player = KodiPlayer()
     addon = xbmcaddon.Addon()
     
     # Create a monitor to look out for settings changes
     settingsMonitor = KodiMonitor()
-    #playerMonitor = KodiPlayer()
     
     if not xbmcvfs.exists(getAddonPath(True, "connect.py")):
         xbmcgui.Dialog().ok(addon_name, "You've installed VPN Manager incorrectly and the add-on won't work.  Check the log, install a Github released build or install from the repository")
@@ -221,7 +405,7 @@ if __name__ == '__main__':
             # VPN Unlim went from being single key to multiple keys in 2.3.1
             if addon.getSetting("vpn_provider_validated") == "VPNUnlimited" and last_version < 240:
                 addon.setSetting("1_vpn_validated", "reset")
-                addon.setSetting("user_def_keys", "None")
+                setSettingValue("user_def_keys", "None")
                 clearKeysAndCerts("VPNUnlimited")
             # VyprVPN added encryption levels in 2.4.2 and fiddled with some of the names
             if addon.getSetting("vpn_provider_validated") == "VyprVPN" and last_version < 242:
@@ -233,11 +417,13 @@ if __name__ == '__main__':
     addon.setSetting("version_number", addon.getAddonInfo("version"))
    
     # If the addon was running happily previously (like before an uninstall/reinstall or update)
-    # then regenerate the OVPNs for the validated provider.
+    # then regenerate the OVPNs for the validated provider.  The same goes if the template, the
+    # locations or the settings used to generate the OVPNs have changed, which the manifest
+    # written when they were generated shows without having to look at every file.
     primary_path = addon.getSetting("1_vpn_validated")
 
-    if not primary_path == "" and not xbmcvfs.exists(primary_path):
-        infoTrace("service.py", "New install, but was using good VPN previously.  Regenerate OVPNs")
+    if not primary_path == "" and (not xbmcvfs.exists(primary_path) or not ovpnFilesCurrent(getVPNLocation(addon.getSetting("vpn_provider_validated")), addon.getSetting("vpn_locations_list"))):
+        infoTrace("service.py", "New install or update, but was using good VPN previously.  Regenerate OVPNs")
         if not fixOVPNFiles(getVPNLocation(addon.getSetting("vpn_provider_validated")), addon.getSetting("vpn_locations_list")) or not checkConnections():
             xbmcgui.Dialog().ok(addon_name, "One of the VPN connections you were using previously is no longer available.  Please re-validate all connections.") 
             cleanPassFiles()
@@ -270,21 +456,27 @@ if __name__ == '__main__':
     connect_on_boot_ovpn = addon.getSetting("1_vpn_validated")
         
     # Timer values in seconds
-    connection_retry_time_min = int(addon.getSetting("vpn_reconnect_freq"))
+    connection_retry_time_min = getSettingValue("vpn_reconnect_freq")
     connection_retry_time = connection_retry_time_min
-    timer = 0
-    cycle_timer = 0
-    reboot_timer = 0
+    scheduler.schedule("reconnect", connection_retry_time)
+    reboot_deferred = False
     seconds_to_reboot_check = 3600
     reboot_time = ""
     reboot_day = ""
     last_file_check_time = 0
     
     last_cycle = ""
+    # Time between add-on filter checks, or when the service is stopped, in seconds
     delay_min = 2
     delay_max = 2
     delay = delay_max
+    # Longest time to sleep when there's nothing else scheduled
+    idle_max = 10
+    # Time to wait after the last cycle request before connecting
+    cycle_wait = 10
     connection_errors = 0
+    current_name = ""
+    filtering = False
     stop = False
 
     vpn_setup = True
@@ -322,6 +514,7 @@ if __name__ == '__main__':
             if updateServiceRequested():
                 # Need to get the addon again to ensure the updated settings are picked up
                 addon = xbmcaddon.Addon()
+                refreshSettings()
                 debugTrace("VPN monitor service was requested to run an update")
                 accepting_changes = False
 				# Acknowledge update needs to happen
@@ -360,11 +553,13 @@ if __name__ == '__main__':
                         writeCredentials(addon)
                 
                 # Force a reboot timer check
-                reboot_timer = 3600
+                scheduler.schedule("reboot", 0)
+                reboot_deferred = False
 
 				# Refresh filter lists
                 debugTrace("Update filter lists from settings")
                 refreshAddonFilterLists()
+                filtering = len(addon_filter_index) > 0
 
 				# If the VPN is not deliberately disconnected, then connect it
                 if vpn_setup and not getVPNState() == "off":
@@ -393,11 +588,9 @@ if __name__ == '__main__':
                                     setVPNLastConnectedProfile("")
                                     setVPNLastConnectedProfileFriendly("")
                                     setConnectionErrorCount(0)
-                                    if addon.getSetting("display_location_on_connect") == "true":
-                                        _, ip, country, isp = getIPInfo(addon)
-                                        xbmcgui.Dialog().notification(addon_name, "Connected during boot to "+ getVPNProfileFriendly() + " via Service Provider " + isp + " in " + country + ". IP is " + ip + ".", getAddonPath(True, "/resources/connected.png"), 20000, False)
-                                    else:
-                                        xbmcgui.Dialog().notification(addon_name, "Connected during boot to "+ getVPNProfileFriendly(), getAddonPath(True, "/resources/connected.png"), 5000, False)
+                                    xbmcgui.Dialog().notification(addon_name, "Connected during boot to "+ getVPNProfileFriendly(), getAddonPath(True, "/resources/connected.png"), 5000, False)
+                                    if getSettingValue("display_location_on_connect"):
+                                        location_notifier.notify("Connected during boot to #PROFILE via Service Provider #ISP in #COUNTRY. IP is #IP.", getAddonPath(True, "/resources/connected.png"), getVPNProfileFriendly())
                                 else:
                                     # No connect on boot (or it didn't work), so force a connect
                                     debugTrace("Connecting to primary VPN at Kodi start up")
@@ -420,40 +613,47 @@ if __name__ == '__main__':
                 playing = True
             elif playing:
                 playing = False
-                timer = connection_retry_time + 1
+                scheduler.schedule("reconnect", 0)
+                if reboot_deferred:
+                    scheduler.schedule("reboot", 0)
+                    reboot_deferred = False
                                         
 			# This checks the connection is still good.  It will always do it whilst there's 
             # no playback but there's an option to suppress this during playback
-            addon = xbmcaddon.Addon()
-            if (not playing) or addon.getSetting("vpn_reconnect_while_playing") == "true":
-                if vpn_setup and timer > connection_retry_time:
-                    addon = xbmcaddon.Addon()
-                    if addon.getSetting("vpn_reconnect") == "true":
+            if scheduler.isDue("reconnect"):
+                # If the check is suppressed during playback it'll get forced when playback stops
+                scheduler.schedule("reconnect", connection_retry_time)
+                if (not playing) or getSettingValue("vpn_reconnect_while_playing"):
+                    if vpn_setup and getSettingValue("vpn_reconnect"):
                         if not isVPNConnected() and not (getVPNState() == "off"):
                             # Don't know why we're disconnected, but reconnect to the last known VPN
                             errorTrace("service.py", "VPN monitor service detected VPN connection " + getVPNProfile() + " is not running when it should be")
                             writeVPNLog()
+                            startStateBatch()
                             if getVPNRequestedProfile() == "":
                                 setVPNRequestedProfile(getVPNProfile())
                                 setVPNRequestedProfileFriendly(getVPNProfileFriendly())
                             setVPNProfile("")
                             setVPNProfileFriendly("")
+                            endStateBatch()
                             reconnect_vpn = True
-                    connection_retry_time_min = int(addon.getSetting("vpn_reconnect_freq"))
-                    timer = 0
-                    
+                    connection_retry_time_min = getSettingValue("vpn_reconnect_freq")
+
 
             # Check to see if it's time for a reboot (providing we need to, and nothing is playing)
-            if (not playing) and reboot_timer >= seconds_to_reboot_check:
+            if playing and scheduler.isDue("reboot"):
+                # Check again as soon as playback stops
+                scheduler.cancel("reboot")
+                reboot_deferred = True
+            if (not playing) and scheduler.isDue("reboot"):
                 debugTrace("Checking if a timer or file reboot is required")
-                reboot_timer = 0
                 # Assume the next check is in an hour
                 seconds_to_reboot_check = 3600
                 # Check reboot check file if there is one
                 reboot_system = False
                 reboot_reason = ""
-                if addon.getSetting("reboot_file_enabled") == "true":
-                    reboot_file_name = addon.getSetting("reboot_file")
+                if getSettingValue("reboot_file_enabled"):
+                    reboot_file_name = getSettingValue("reboot_file")
                     if xbmcvfs.exists(reboot_file_name):
                         found_reboot_file = True
                         stats = xbmcvfs.Stat(reboot_file_name)
@@ -491,8 +691,8 @@ if __name__ == '__main__':
                             infoTrace("service.py", "Server rebooted, system reboot aborted by user")
                             last_file_check_time = file_check_time
                 # Refresh the reboot timer if it's changed in the seconds
-                new_reboot_day = addon.getSetting("reboot_day")
-                new_reboot_time = addon.getSetting("reboot_time")
+                new_reboot_day = getSettingValue("reboot_day")
+                new_reboot_time = getSettingValue("reboot_time")
                 if not (new_reboot_day == reboot_day and new_reboot_time == reboot_time):
                     # Time has changed
                     reboot_day = new_reboot_day
@@ -528,8 +728,9 @@ if __name__ == '__main__':
                             debugTrace("Same day reboot, check again in " + str(seconds_to_reboot_check))
                 else:
                     # Reboot on a different day, check status again in an hour.
-                    setReboot("waiting")      
-    
+                    setReboot("waiting")
+                scheduler.schedule("reboot", seconds_to_reboot_check)
+
 			# Fetch the path and name of the current addon
             current_path = xbmc.getInfoLabel("Container.FolderPath")
             current_name = xbmc.getInfoLabel("Container.FolderName")          
@@ -553,6 +754,8 @@ if __name__ == '__main__':
                     # See if we should be filtering this addon
                     # -1 is no, 0 is disconnect, >0 is specific VPN
                     filter = isAddonFiltered(current_path, primary_found)                
+                    # Any changes to the connection state are written out together
+                    startStateBatch()
                     if filter == 0:
                         infoTrace("service.py", "Disconnect filter found for addon " + current_name)
                         setVPNRequestedProfile("Disconnect")
@@ -585,10 +788,9 @@ if __name__ == '__main__':
                                 debugTrace("Alternative VPN, previous VPN stored as " + getVPNLastConnectedProfile())
                             reconnect_vpn = True
                     else:
-                        addon = xbmcaddon.Addon()
-                        reconnect_filtering = addon.getSetting("vpn_reconnect_filtering")
+                        reconnect_filtering = getSettingValue("vpn_reconnect_filtering")
                         debugTrace("No filter found, reconnect to previous is " + str(reconnect_filtering) + " reconnect state is " + getVPNState())
-                        if reconnect_filtering == "true":
+                        if reconnect_filtering:
                             if not getVPNState() == "started":
                                 # if we're not connected, reconnect to last known
                                 if not getVPNLastConnectedProfile() == "":
@@ -638,6 +840,7 @@ if __name__ == '__main__':
                                             setVPNRequestedProfileFriendly(getVPNProfileFriendly())                                                                                
                                             setVPNProfile("")
                                             setVPNProfileFriendly("")                                     
+                    endStateBatch()
                 else:
                     # Monitor is paused, warn user if not done so previously
                     if not warned_monitor:
@@ -646,26 +849,28 @@ if __name__ == '__main__':
                     
             # See if the addon is requesting to cycle through the VPNs
             cycle_requested = getVPNCycle()
+            if cycle_requested == "":
+                last_cycle = ""
+                scheduler.cancel("cycle")
             if vpn_setup and not cycle_requested == "":
 
                 # Wait a short period, and then just grab the lock anyway.
                 forceCycleLock()
                 debugTrace("Got forced cycle lock in cycle part of service")
                 
-                # Reset the timer if this is a different request than last time we looked
+                # Reset the timer if this is a different request than last time we looked.  The
+                # wait gives the user the chance to cycle multiple times before connection
                 if not cycle_requested == last_cycle:
                     debugTrace("New Cycling VPN connection " + cycle_requested)
                     last_cycle = cycle_requested
-                    cycle_timer = 0
-                
-                # Increment cycle counter so that user has the chance to cycle multiple times before connection
-                cycle_timer = cycle_timer + delay
+                    scheduler.schedule("cycle", cycle_wait)
 
                 # Let's connect!
-                if cycle_timer > 9:
+                if scheduler.isDue("cycle"):
                     debugTrace("Running VPN cycle request " + cycle_requested + ", current VPN is " + getVPNProfile())
                     if not (cycle_requested == "Disconnect" and getVPNProfile() == "") and (not cycle_requested == getVPNProfile()):
                         infoTrace("service.py", "Cycle requested connection to " + cycle_requested)
+                        startStateBatch()
                         setVPNRequestedProfile(cycle_requested)
                         if cycle_requested == "Disconnect":
                             setVPNRequestedProfileFriendly("Disconnect")
@@ -673,14 +878,14 @@ if __name__ == '__main__':
                             setVPNRequestedProfileFriendly(getFriendlyProfileName(cycle_requested))
                         setVPNLastConnectedProfile("")
                         setVPNLastConnectedProfileFriendly("")
+                        endStateBatch()
                         reconnect_vpn = True
                     else:
                         # Display the full details for those with this option switched on otherwise just let the notification box disappear
-                        if addon.getSetting("display_location_on_connect") == "true":
-                            _, ip, country, isp = getIPInfo(addon)
-                            xbmcgui.Dialog().notification(addon_name, "Connected to "+ getVPNProfileFriendly() + " via Service Provider " + isp + " in " + country + ". IP is " + ip + ".", getAddonPath(True, "/resources/connected.png"), 20000, False)
+                        if getSettingValue("display_location_on_connect"):
+                            location_notifier.notify("Connected to #PROFILE via Service Provider #ISP in #COUNTRY. IP is #IP.", getAddonPath(True, "/resources/connected.png"), getVPNProfileFriendly())
                     clearVPNCycle()
-                    cycle_timer = 0
+                    scheduler.cancel("cycle")
                 
                 freeCycleLock()
 
@@ -688,64 +893,67 @@ if __name__ == '__main__':
             api_command = getAPICommand()
             if vpn_setup and not api_command == "":
                 infoTrace("service.py", "API command found, " + api_command)
+                startStateBatch()
                 setVPNRequestedProfile(api_command)
                 if api_command == "Disconnect":
                     setVPNRequestedProfileFriendly("Disconnect")
                 else:
                     setVPNRequestedProfileFriendly(getFriendlyProfileName(api_command))
                 clearAPICommand()
+                endStateBatch()
                 reconnect_vpn = True
                 
 			# Somewhere above we've requested we mess with the connection...
             if vpn_setup and reconnect_vpn:
-                addon = xbmcaddon.Addon()
                 debugTrace("Running VPN (dis)connect request " + getVPNRequestedProfile() + ", current is " + getVPNProfile())
                 
                 # Wait a short period, and then just grab the lock anyway.
                 forceCycleLock()
                 debugTrace("Got forced cycle lock in connection part of service")
+                connection_reset = False
                 
+                # Switch between primary VPNs without dropping the connection first if that's possible
+                if (not getVPNRequestedProfile() == getVPNProfile()) and switchPrimaryVPN():
+                    connection_reset = True
 				# Stop the VPN and reset the connection timer
                 # Surpress a reconnection to the same unless it's become disconnected
-                if (not getVPNRequestedProfile() == getVPNProfile()) or (getVPNRequestedProfile() == getVPNProfile() and not isVPNConnected()):                    
+                elif (not getVPNRequestedProfile() == getVPNProfile()) or (getVPNRequestedProfile() == getVPNProfile() and not isVPNConnected()):                    
 
                     # Stop any media playing before switching VPNs around   
                     if player.isPlaying(): player.stop()
                     
+                    connection_reset = True
+
                     # Stop any existing VPN
                     debugTrace("Stopping VPN before any new connection attempt")
                     if getVPNState() == "started":
                         stopVPNConnection()
-                        if getVPNRequestedProfile() == "Disconnect" and addon.getSetting("display_location_on_connect") == "true":
-                            _, ip, country, isp = getIPInfo(addon)
-                            xbmcgui.Dialog().notification(addon_name, "Disconnected from VPN. Service Provider is " + isp + " in " + country + ". IP is " + ip + ".", getAddonPath(True, "/resources/disconnected.png"), 20000, False)
-                        else:
-                            xbmcgui.Dialog().notification(addon_name, "Disconnected", getAddonPath(True, "/resources/disconnected.png"), 3000, False)
+                        xbmcgui.Dialog().notification(addon_name, "Disconnected", getAddonPath(True, "/resources/disconnected.png"), 3000, False)
+                        if getVPNRequestedProfile() == "Disconnect" and getSettingValue("display_location_on_connect"):
+                            location_notifier.notify("Disconnected from VPN. Service Provider is #ISP in #COUNTRY. IP is #IP.", getAddonPath(True, "/resources/disconnected.png"))
                         infoTrace("service.py", "Disconnect from VPN")
                     else:
                         # Just incase we're in a weird unknown state, this should clear things up
                         stopVPNConnection()
                         debugTrace("Unconnected state, " + getVPNState() + " so disconnected anyway")
-                    
-                    timer = 0
                 
                     # Don't reconnect if this is a disconnect request, or there is nothing to connect to (primary not set)
                     if not getVPNRequestedProfile() == "Disconnect":
                         if not getVPNRequestedProfile() == "":
                             infoTrace("service.py", "Connecting to VPN profile " + getVPNRequestedProfile())
                             xbmcgui.Dialog().notification(addon_name, "Connecting to "+ getVPNRequestedProfileFriendly(), getAddonPath(True, "/resources/locked.png"), 5000, False)
-                            state = startVPNConnection(getVPNRequestedProfile())
+                            state = connectBestServer(getVPNRequestedProfile())
                             if not state == connection_status.CONNECTED:
                                 if state == connection_status.AUTH_FAILED:
                                     # If authentication fails we don't want to try and reconnect
-                                    # Everything will get reset below if timer is 0 but we'll make
+                                    # Everything will get reset below as the connection is being reset but we'll make
                                     # like the VPN state is off deliberately to avoid reconnect
                                     xbmcgui.Dialog().notification(addon_name, "Error authenticating with VPN, retry or update credentials.", xbmcgui.NOTIFICATION_ERROR, 10000, True)
                                     setVPNState("off")
                                 else:
                                     connection_errors = getConnectionErrorCount() + 1
                                     if connection_errors > 9:
-                                        if addon.getSetting("vpn_reconnect_reboot") == "true" and connection_errors == 10:
+                                        if getSettingValue("vpn_reconnect_reboot") and connection_errors == 10:
                                             if not xbmcgui.Dialog().yesno(addon_name, "Cannot connect to VPN, rebooting system.\nClick cancel within 30 seconds to abort.", "", "", "Reboot", "Cancel", 30000):
                                                 infoTrace("service.py", "Reboot because of VPN connection errors.")
                                                 addon.setSetting("boot_reason", "VPN errors")
@@ -759,7 +967,7 @@ if __name__ == '__main__':
                                         connection_retry_time = 60 * connection_errors
                                     setConnectionErrorCount(connection_errors)
                                     xbmcgui.Dialog().notification(addon_name, "Error connecting to VPN, check network. Retrying in " + str((connection_retry_time/60)) + " minutes.", xbmcgui.NOTIFICATION_ERROR, 10000, True)
-                                    timer = 1
+                                    connection_reset = False
                                 # Want to kill any running process if it's not completed successfully
                                 stopVPNConnection()
                                 errorTrace("service.py", "VPN connect to " + getVPNLastConnectedProfile() + " has failed, VPN error was " + str(state))
@@ -767,24 +975,28 @@ if __name__ == '__main__':
                                 debugTrace("VPN connection failed, errors count is " + str(connection_errors) + " connection timer is " + str(connection_retry_time))
                             else:
                                 if ifDebug(): writeVPNLog()
-                                if addon.getSetting("display_location_on_connect") == "true":
-                                    _, ip, country, isp = getIPInfo(addon)
-                                    xbmcgui.Dialog().notification(addon_name, "Connected to "+ getVPNProfileFriendly() + " via Service Provider " + isp + " in " + country + ". IP is " + ip + ".", getAddonPath(True, "/resources/connected.png"), 20000, False)
-                                else:
-                                    xbmcgui.Dialog().notification(addon_name, "Connected to "+ getVPNProfileFriendly(), getAddonPath(True, "/resources/connected.png"), 5000, False)
+                                xbmcgui.Dialog().notification(addon_name, "Connected to "+ getVPNProfileFriendly(), getAddonPath(True, "/resources/connected.png"), 5000, False)
+                                if getSettingValue("display_location_on_connect"):
+                                    location_notifier.notify("Connected to #PROFILE via Service Provider #ISP in #COUNTRY. IP is #IP.", getAddonPath(True, "/resources/connected.png"), getVPNProfileFriendly())
                         else:
                             xbmcgui.Dialog().notification(addon_name, "Filtering " + current_name + " but no validated connection available.", getAddonPath(True, "/resources/warning.png"), 10000, False)
                     else:                                               
+                        startStateBatch()
                         setConnectionErrorCount(0)
                         setVPNState("off")
+                        endStateBatch()
                 
                 # Reset a bunch of things if we've connected/disconnected successfully
-                if timer == 0:                    
+                if connection_reset:
+                    startStateBatch()
                     setConnectionErrorCount(0)
                     setVPNRequestedProfile("")
                     setVPNRequestedProfileFriendly("")
                     clearVPNCycle()
+                    endStateBatch()
                     connection_retry_time = connection_retry_time_min
+                # Check the connection again once the retry time has passed
+                scheduler.schedule("reconnect", connection_retry_time)
 				
                 # Let the cycle code run again
                 freeCycleLock()
@@ -792,12 +1004,19 @@ if __name__ == '__main__':
                 reconnect_vpn = False          
 
 			                    
-        # Sleep/wait for abort
-        if monitor.waitForAbort(delay):
+        # Sleep until the next thing needs doing, or wait for abort.  Add-on filtering needs
+        # the current add-on checking regularly, otherwise there's no need to keep waking up
+        if stop or (vpn_setup and filtering):
+            max_wait = delay
+        else:
+            max_wait = idle_max
+        if scheduler.wait(monitor, max_wait, not stop):
             # Abort was requested while waiting. We should exit
             infoTrace("service.py", "Abort received, shutting down service")
             break
-            
-        timer = timer + delay
-        reboot_timer = reboot_timer + delay
-        
\ No newline at end of file
+        
+
+    # Write out anything that's only been kept in memory
+    location_notifier.stop()
+    saveIPServices()
+    closeConnections()